@@ -77,44 +77,33 @@ int main(void) {
 		.mode_registers = {
 			0x320, 0x6, 0x200, 0x0
 		},
-		.rdly_p0 = 2,
-		.rdly_p1 = 2,
+		.dqs_groups = 2,
+		.rdly = { 2, 2 },
 	};
 	struct gramProfile profile2;
 	gram_init(&ctx, &profile, (void*)0x10000000, (void*)0x00009000, (void*)0x00008000);
 	uart_writestr("done\n");
 
-	uart_writestr("Rdly\np0: ");
-	for (size_t i = 0; i < 8; i++) {
-		profile2.rdly_p0 = i;
-		gram_load_calibration(&ctx, &profile2);
-		gram_reset_burstdet(&ctx);
-		for (size_t j = 0; j < 128; j++) {
-			tmp = ram[j];
-		}
-		if (gram_read_burstdet(&ctx, 0)) {
-			uart_writestr("1");
-		} else {
-			uart_writestr("0");
-		}
-	}
-	uart_writestr("\n");
-
-	uart_writestr("Rdly\np1: ");
-	for (size_t i = 0; i < 8; i++) {
-		profile2.rdly_p1 = i;
-		gram_load_calibration(&ctx, &profile2);
-		gram_reset_burstdet(&ctx);
-		for (size_t j = 0; j < 128; j++) {
-			tmp = ram[j];
-		}
-		if (gram_read_burstdet(&ctx, 1)) {
-			uart_writestr("1");
-		} else {
-			uart_writestr("0");
+	profile2 = profile;
+	for (size_t group = 0; group < profile.dqs_groups; group++) {
+		uart_writestr("Rdly\np");
+		uart_writeuint32(group);
+		uart_writestr(": ");
+		for (size_t i = 0; i < 8; i++) {
+			profile2.rdly[group] = i;
+			gram_load_calibration(&ctx, &profile2);
+			gram_reset_burstdet(&ctx);
+			for (size_t j = 0; j < 128; j++) {
+				tmp = ram[j];
+			}
+			if (gram_read_burstdet(&ctx, group)) {
+				uart_writestr("1");
+			} else {
+				uart_writestr("0");
+			}
 		}
+		uart_writestr("\n");
 	}
-	uart_writestr("\n");
 
 	uart_writestr("Auto calibrating... ");
 	res = gram_generate_calibration(&ctx, &profile2);
@@ -127,10 +116,12 @@ int main(void) {
 	uart_writestr("done\n");
 
 	uart_writestr("Auto calibration profile:");
-	uart_writestr("p0 rdly:");
-	uart_writeuint32(profile2.rdly_p0);
-	uart_writestr(" p1 rdly:");
-	uart_writeuint32(profile2.rdly_p1);
+	for (size_t group = 0; group < profile2.dqs_groups; group++) {
+		uart_writestr(" p");
+		uart_writeuint32(group);
+		uart_writestr(" rdly:");
+		uart_writeuint32(profile2.rdly[group]);
+	}
 	uart_writestr("\n");
 
 	uart_writestr("DRAM test... \n");
@@ -106,8 +106,8 @@ int main(int argc, char *argv[]) {
 		.mode_registers = {
 			0x320, 0x6, 0x200, 0x0
 		},
-		.rdly_p0 = 2,
-		.rdly_p1 = 2,
+		.dqs_groups = 2,
+		.rdly = { 2, 2 },
 	};
 
 	if (argc < 3) {
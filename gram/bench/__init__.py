@@ -0,0 +1,4 @@
+from gram.bench.generators import *
+from gram.bench.metrics import BenchmarkMetrics
+from gram.bench.runner import default_phy_settings, Benchmark
+from gram.bench.replay import *
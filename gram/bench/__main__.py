@@ -0,0 +1,106 @@
+# This file is Copyright (c) 2020 LambdaConcept <contact@lambdaconcept.com>
+# License: BSD
+
+"""Run a controller benchmark and print its metrics as JSON.
+
+    python -m gram.bench --pattern random --count 2000 --ports 2 --read-ratio 0.7 \
+        --outstanding 16 --setting cmd_buffer_depth=16 --output random.json
+
+    python -m gram.bench --workload soc.trace --ports 3 --latency-output soc.lat
+"""
+
+import argparse
+import ast
+import json
+
+from gram.core.controller import ControllerSettings
+from gram.bench import PATTERNS, Benchmark, WorkloadReplay, read_workload
+
+
+def _setting(arg):
+    name, sep, value = arg.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("Expected NAME=VALUE, not {!r}".format(arg))
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m gram.bench", description=__doc__.splitlines()[0])
+    parser.add_argument("--pattern", choices=sorted(PATTERNS), default="sequential",
+        help="traffic pattern (default: %(default)s)")
+    parser.add_argument("--count", type=int, default=1000,
+        help="accesses per port (default: %(default)s)")
+    parser.add_argument("--ports", type=int, default=1,
+        help="native ports, each one running the pattern (default: %(default)s)")
+    parser.add_argument("--read-ratio", type=float, default=1.0,
+        help="fraction of reads (default: %(default)s)")
+    parser.add_argument("--outstanding", type=int, default=8,
+        help="transactions in flight per port (default: %(default)s)")
+    parser.add_argument("--stride", type=int, default=64,
+        help="stride of the strided pattern, in port words (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+        help="random seed (default: %(default)s)")
+    parser.add_argument("--clk-freq", type=float, default=100e6,
+        help="system clock frequency (default: %(default)s)")
+    parser.add_argument("--setting", type=_setting, action="append", default=[],
+        metavar="NAME=VALUE", help="controller setting, can be repeated")
+    parser.add_argument("--workload", metavar="FILE",
+        help="replay a workload trace instead of a pattern (see gram.bench.replay)")
+    parser.add_argument("--latency-output", metavar="FILE",
+        help="write the latency of each workload transaction to a file")
+    parser.add_argument("--vcd", help="write a VCD file")
+    parser.add_argument("--output", "-o", help="write the JSON results to a file")
+    args = parser.parse_args(argv)
+
+    settings = ControllerSettings()
+    for name, value in args.setting:
+        if not hasattr(settings, name):
+            parser.error("unknown controller setting {!r}".format(name))
+        setattr(settings, name, value)
+
+    bench = Benchmark(clk_freq=args.clk_freq, nports=args.ports, controller_settings=settings,
+                      max_outstanding=args.outstanding)
+
+    if args.workload:
+        latency_file = open(args.latency_output, "w") if args.latency_output else None
+        try:
+            with open(args.workload) as f:
+                replay = WorkloadReplay(bench, read_workload(f), latency_file)
+                results = replay.run(vcd_file=args.vcd)
+        finally:
+            if latency_file is not None:
+                latency_file.close()
+    else:
+        workloads = []
+        for n in range(args.ports):
+            kwargs = {"read_ratio": args.read_ratio, "seed": args.seed + n}
+            if args.pattern == "strided":
+                kwargs["stride"] = args.stride
+            if args.pattern in ("sequential", "strided"):
+                # Ports work on separate regions
+                kwargs["start"] = n*(2**bench.layout.address_width//args.ports)
+            elif args.pattern == "bank-conflict":
+                # One bank per port
+                kwargs["bank"] = n % 2**bench.layout.bank_bits
+            workloads.append(PATTERNS[args.pattern](bench.layout, args.count, **kwargs))
+        results = bench.run(workloads, vcd_file=args.vcd)
+
+    results = {
+        "config": dict(vars(args), setting=dict(args.setting)),
+        "results": results,
+    }
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# This file is Copyright (c) 2020 LambdaConcept <contact@lambdaconcept.com>
+# License: BSD
+
+"""Synthetic traffic generators for benchmarks.
+
+Generators yield `Access`es addressed in native port words (one controller data width word
+each). They take the `AddressLayout` of the port to wrap addresses and place rows and banks.
+"""
+
+import random
+from collections import namedtuple
+
+__ALL__ = ["Access", "AddressLayout", "sequential", "random_access", "strided", "bank_conflict",
+           "PATTERNS"]
+
+Access = namedtuple("Access", ["we", "addr"])
+
+
+class AddressLayout(namedtuple("AddressLayout", ["col_bits", "bank_bits", "row_bits"])):
+    """Native port address layout (ROW_BANK_COL, from the LSB)
+
+    col_bits : int
+        Column bits, in port words
+    bank_bits : int
+        Bank bits (including rank bits)
+    row_bits : int
+        Row bits
+    """
+    __slots__ = ()
+
+    @property
+    def address_width(self):
+        return self.col_bits + self.bank_bits + self.row_bits
+
+    def address(self, row, bank, col):
+        return (row << (self.col_bits + self.bank_bits)) | (bank << self.col_bits) | col
+
+
+def _writes(count, read_ratio, seed):
+    # Deterministic read/write mix: a fraction `read_ratio` of the accesses are reads
+    rng = random.Random(seed)
+    for i in range(count):
+        yield rng.random() >= read_ratio
+
+
+def sequential(layout, count, read_ratio=1.0, start=0, seed=0):
+    """Consecutive addresses from `start`"""
+    mask = 2**layout.address_width - 1
+    for i, we in enumerate(_writes(count, read_ratio, seed)):
+        yield Access(we, (start + i) & mask)
+
+
+def random_access(layout, count, read_ratio=1.0, seed=0):
+    """Uniformly random addresses"""
+    rng = random.Random(seed + 1)
+    for we in _writes(count, read_ratio, seed):
+        yield Access(we, rng.getrandbits(layout.address_width))
+
+
+def strided(layout, count, stride, read_ratio=1.0, start=0, seed=0):
+    """Addresses `stride` words apart from `start`"""
+    mask = 2**layout.address_width - 1
+    for i, we in enumerate(_writes(count, read_ratio, seed)):
+        yield Access(we, (start + i*stride) & mask)
+
+
+def bank_conflict(layout, count, read_ratio=1.0, bank=0, nrows=2, seed=0):
+    """Accesses cycling through `nrows` rows of the same bank, each one is a row miss"""
+    for i, we in enumerate(_writes(count, read_ratio, seed)):
+        yield Access(we, layout.address(row=i % nrows, bank=bank, col=0))
+
+
+PATTERNS = {
+    "sequential":    sequential,
+    "random":        random_access,
+    "strided":       strided,
+    "bank-conflict": bank_conflict,
+}
@@ -0,0 +1,136 @@
+# This file is Copyright (c) 2020 LambdaConcept <contact@lambdaconcept.com>
+# License: BSD
+
+"""Benchmark metrics."""
+
+import math
+from collections import Counter
+
+__ALL__ = ["BenchmarkMetrics"]
+
+
+def _percentile(histogram, p):
+    # Nearest-rank percentile of a {value: count} histogram
+    rank = max(math.ceil(p/100*sum(histogram.values())), 1)
+    for value in sorted(histogram):
+        rank -= histogram[value]
+        if rank <= 0:
+            return value
+    return None
+
+
+def _latency_summary(histogram):
+    count = sum(histogram.values())
+    return {
+        "count": count,
+        "mean":  sum(v*n for v, n in histogram.items())/count if count else None,
+        "p50":   _percentile(histogram, 50),
+        "p99":   _percentile(histogram, 99),
+        "max":   max(histogram) if histogram else None,
+    }
+
+
+class BenchmarkMetrics:
+    """Benchmark metrics collector
+
+    Transactions are reported by the port drivers with `transaction`, DFI commands by a
+    `DFIMonitor` with `command`. Times are in system clock cycles. Latencies are kept as
+    histograms, so that memory does not grow with the number of transactions.
+
+    The open row of each bank is tracked from the commands: a column command is a row hit when
+    its bank has an open row that an earlier column command already accessed, i.e. when it did
+    not need an activate.
+
+    Parameters
+    ----------
+    data_width : int
+        Native port data width, the controller transfers at most one such word per cycle
+    clk_freq : float
+        System clock frequency, to report the bandwidth in MB/s
+    """
+    def __init__(self, data_width, clk_freq=None):
+        self.data_width = data_width
+        self.clk_freq = clk_freq
+
+        self.latencies = {"read": Counter(), "write": Counter()}
+        self.port_latencies = {}
+        self.words = 0
+        self.first_cycle = None
+        self.last_cycle = None
+
+        self.commands = Counter()
+        self.turnarounds = Counter()
+        self.row_hits = 0
+        self._last_cas = None
+        # Banks with an open row: whether a column command accessed it since the activate
+        self._open_banks = {}
+
+    def transaction(self, port, we, issued, completed, words=1):
+        """Record a transaction of `words` data words, presented at cycle `issued` and completed
+        at cycle `completed`"""
+        latency = completed - issued
+        self.latencies["write" if we else "read"][latency] += 1
+        self.port_latencies.setdefault(port, Counter())[latency] += 1
+        self.words += words
+        if self.first_cycle is None or issued < self.first_cycle:
+            self.first_cycle = issued
+        if self.last_cycle is None or completed > self.last_cycle:
+            self.last_cycle = completed
+
+    def command(self, cmd):
+        """`DFIMonitor` sink"""
+        self.commands[cmd.name] += 1
+        if cmd.name == "ACT":
+            self._open_banks[cmd.bank] = False
+        elif cmd.name == "PRE":
+            # A10 set: Precharge All
+            if cmd.address & 2**10:
+                self._open_banks.clear()
+            else:
+                self._open_banks.pop(cmd.bank, None)
+        elif cmd.name == "REF":
+            self._open_banks.clear()
+        elif cmd.name in ("RD", "WR"):
+            if self._open_banks.get(cmd.bank):
+                self.row_hits += 1
+            if cmd.bank in self._open_banks:
+                self._open_banks[cmd.bank] = True
+            if self._last_cas is not None and cmd.name != self._last_cas:
+                self.turnarounds["read_to_write" if cmd.name == "WR" else "write_to_read"] += 1
+            self._last_cas = cmd.name
+
+    def summary(self):
+        """Metrics as a JSON serializable dict"""
+        transactions = sum(sum(l.values()) for l in self.latencies.values())
+        cycles = 0
+        if transactions:
+            cycles = self.last_cycle - self.first_cycle + 1
+
+        cas = self.commands["RD"] + self.commands["WR"]
+
+        nbytes = self.words*self.data_width//8
+        summary = {
+            "cycles":       cycles,
+            "transactions": transactions,
+            "reads":        sum(self.latencies["read"].values()),
+            "writes":       sum(self.latencies["write"].values()),
+            "bytes":        nbytes,
+            # One data word per cycle at most
+            "bandwidth_efficiency": 100*self.words/cycles if cycles else None,
+            "bandwidth_mbps":       None,
+            "latency": dict(_latency_summary(self.latencies["read"] + self.latencies["write"]),
+                            read=_latency_summary(self.latencies["read"]),
+                            write=_latency_summary(self.latencies["write"])),
+            "row_hit_rate": self.row_hits/cas if cas else None,
+            "turnarounds": {
+                "read_to_write": self.turnarounds["read_to_write"],
+                "write_to_read": self.turnarounds["write_to_read"],
+            },
+            "commands": dict(sorted(self.commands.items())),
+            "ports": {str(port): _latency_summary(latencies)
+                      for port, latencies in sorted(self.port_latencies.items())},
+        }
+        if cycles and self.clk_freq is not None:
+            summary["bandwidth_mbps"] = nbytes/(cycles/self.clk_freq)/1e6
+
+        return summary
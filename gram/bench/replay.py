@@ -0,0 +1,218 @@
+# This file is Copyright (c) 2020 LambdaConcept <contact@lambdaconcept.com>
+# License: BSD
+
+"""Trace-driven workload replay into native ports.
+
+Workload traces are text files with one transaction per line:
+
+    # cycle port op address size [dep]
+    0    0 R 0x1000 64
+    10   1 W 0x8000 16
+    12   0 R 0x2000 32 1
+
+`cycle` is the arrival time of the transaction in system clock cycles (non decreasing), `op` is
+R or W, `address` and `size` are in bytes. `dep` is the index (from 0, in trace order) of an
+earlier transaction that must have completed before this one is issued.
+"""
+
+from collections import namedtuple, deque
+
+from nmigen.sim import Settle
+
+__ALL__ = ["Transaction", "read_workload", "write_workload", "WorkloadReplay"]
+
+Transaction = namedtuple("Transaction", ["cycle", "port", "we", "address", "size", "dep"])
+Transaction.__doc__ = """Workload transaction
+
+cycle : int
+    Arrival time in system clock cycles
+port : int
+    Native port
+we : bool
+    Write transaction
+address : int
+    Byte address
+size : int
+    Size in bytes
+dep : int or None
+    Index of the transaction this one depends on
+"""
+
+
+def read_workload(f):
+    """Read `Transaction`s from a workload trace, lazily"""
+    index = 0
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            cycle, port, op, address, size, *dep = line.split()
+            if op not in ("R", "W") or len(dep) > 1:
+                raise ValueError
+            dep = None if not dep or dep[0] == "-" else int(dep[0])
+            txn = Transaction(int(cycle), int(port), op == "W", int(address, 0), int(size, 0), dep)
+        except ValueError:
+            raise ValueError("Line {}: invalid transaction {!r}".format(lineno, line)) from None
+        if txn.size < 1:
+            raise ValueError("Line {}: empty transaction".format(lineno))
+        if txn.dep is not None and not (0 <= txn.dep < index):
+            raise ValueError("Line {}: transaction {} depends on transaction {}, which is not an "
+                             "earlier one".format(lineno, index, txn.dep))
+        index += 1
+        yield txn
+
+
+def write_workload(transactions, f):
+    """Write `Transaction`s to a workload trace"""
+    f.write("# cycle port op address size [dep]\n")
+    for txn in transactions:
+        f.write("{} {} {} {:#x} {}{}\n".format(txn.cycle, txn.port, "W" if txn.we else "R",
+            txn.address, txn.size, "" if txn.dep is None else " {}".format(txn.dep)))
+
+
+class _Transaction:
+    __slots__ = ("id", "port", "we", "addr", "words", "dep", "arrival", "issued", "sent", "left")
+
+    def __init__(self, id, txn, word_bytes):
+        self.id = id
+        self.port = txn.port
+        self.we = txn.we
+        self.addr = txn.address // word_bytes
+        self.words = (txn.address % word_bytes + txn.size + word_bytes - 1) // word_bytes
+        self.dep = txn.dep
+        self.arrival = txn.cycle
+        self.issued = None
+        self.sent = 0
+        self.left = self.words
+
+
+class WorkloadReplay:
+    """Workload replay
+
+    Simulator process replaying `Transaction`s on the native ports of a `Benchmark`. Transactions
+    are consumed lazily: they are read when they arrive, and queued in order on their port (at
+    most `max_pending` per port, the trace is not read further while a queue is full). Each port
+    issues the data words of the transaction at the head of its queue once its dependency has
+    completed, with at most `max_outstanding` words in flight.
+
+    Completed transactions are recorded in the benchmark metrics, with latencies counted from
+    their arrival, and written to `latency_file` as they complete, one line each:
+
+        id port op arrival issued completed latency
+
+    Parameters
+    ----------
+    bench : Benchmark
+        Benchmark to replay the transactions on
+    transactions : iterable of Transaction
+        Workload, for instance `read_workload(f)`
+    latency_file : file
+        Text file receiving the transaction latencies
+    max_pending : int
+        Transactions queued per port
+    max_cycles : int
+        Simulation time limit
+    """
+    def __init__(self, bench, transactions, latency_file=None, max_pending=256, max_cycles=None):
+        self.bench = bench
+        self.transactions = transactions
+        self.latency_file = latency_file
+        self.max_pending = max_pending
+        self.max_cycles = max_cycles
+
+    def process(self):
+        bench = self.bench
+        ports = bench.ports
+        nports = len(ports)
+        word_bytes = bench.data_width//8
+        address_limit = 2**bench.layout.address_width
+        latency_file = self.latency_file
+
+        transactions = iter(self.transactions)
+        next_txn = next(transactions, None)
+        next_id = 0
+        last_cycle = 0
+
+        queues = [deque() for i in range(nports)]
+        # Transactions of the words in flight, data completes in order
+        reads = [deque() for i in range(nports)]
+        writes = [deque() for i in range(nports)]
+        unfinished = set()
+        cycle = 0
+
+        if latency_file is not None:
+            latency_file.write("# id port op arrival issued completed latency\n")
+
+        def word_done(txn):
+            txn.left -= 1
+            if txn.left == 0:
+                unfinished.discard(txn.id)
+                bench.metrics.transaction(txn.port, txn.we, txn.arrival, cycle, txn.words)
+                if latency_file is not None:
+                    latency_file.write("{} {} {} {} {} {} {}\n".format(txn.id, txn.port,
+                        "W" if txn.we else "R", txn.arrival, txn.issued, cycle, cycle - txn.arrival))
+
+        for port in ports:
+            yield port.wdata.we.eq(2**len(port.wdata.we) - 1)
+
+        while next_txn is not None or any(queues) or any(reads) or any(writes):
+            if cycle == self.max_cycles:
+                raise RuntimeError("Workload did not complete in {} cycles".format(self.max_cycles))
+
+            # Arrivals
+            while next_txn is not None and next_txn.cycle <= cycle:
+                if next_txn.cycle < last_cycle:
+                    raise ValueError("Transaction {} arrives before the previous one".format(next_id))
+                if next_txn.port >= nports:
+                    raise ValueError("Transaction {} is on port {}, there are {} ports"
+                                     .format(next_id, next_txn.port, nports))
+                if len(queues[next_txn.port]) == self.max_pending:
+                    break
+                txn = _Transaction(next_id, next_txn, word_bytes)
+                if txn.addr + txn.words > address_limit:
+                    raise ValueError("Transaction {} is out of the memory".format(next_id))
+                queues[txn.port].append(txn)
+                unfinished.add(txn.id)
+                last_cycle = next_txn.cycle
+                next_id += 1
+                next_txn = next(transactions, None)
+
+            # Commands
+            heads = []
+            for port, queue, r, w in zip(ports, queues, reads, writes):
+                head = None
+                if queue and len(r) + len(w) < bench.max_outstanding:
+                    head = queue[0]
+                    if head.dep is not None and head.dep in unfinished:
+                        head = None
+                heads.append(head)
+                yield port.cmd.valid.eq(head is not None)
+                if head is not None:
+                    yield port.cmd.we.eq(head.we)
+                    yield port.cmd.addr.eq(head.addr + head.sent)
+                    if head.issued is None:
+                        head.issued = cycle
+            yield Settle()
+
+            for port, queue, head, r, w in zip(ports, queues, heads, reads, writes):
+                if (yield port.wdata.ready):
+                    word_done(w.popleft())
+                if (yield port.rdata.valid):
+                    word_done(r.popleft())
+                if head is not None and (yield port.cmd.ready):
+                    (w if head.we else r).append(head)
+                    head.sent += 1
+                    if head.sent == head.words:
+                        queue.popleft()
+
+            yield
+            cycle += 1
+
+        for port in ports:
+            yield port.cmd.valid.eq(0)
+
+    def run(self, vcd_file=None):
+        """Replay the workload and return the metrics summary"""
+        self.bench._simulate([self.process], vcd_file)
+        return self.bench.metrics.summary()
@@ -0,0 +1,206 @@
+# This file is Copyright (c) 2020 LambdaConcept <contact@lambdaconcept.com>
+# License: BSD
+
+"""Controller benchmark runner."""
+
+from collections import deque
+
+from nmigen import *
+from nmigen.sim import Simulator, Settle
+from nmigen.utils import log2_int
+
+from gram.common import PhySettings, get_cl_cw, get_sys_latency, get_sys_phases
+from gram.core.controller import ControllerSettings, gramController
+from gram.core.crossbar import gramCrossbar
+from gram.modules import MT41K256M16
+from gram.phy.dfitrace import DFIMonitor
+from gram.phy.fakephy import FakePHY
+from gram.bench.generators import AddressLayout
+from gram.bench.metrics import BenchmarkMetrics
+
+__ALL__ = ["default_phy_settings", "Benchmark"]
+
+
+def default_phy_settings(clk_freq, nranks=1):
+    """Settings of an ECP5 DDR3 x16 PHY (1:2) at `clk_freq`"""
+    tck = 1/(2*clk_freq)
+    nphases = 2
+    cl, cwl = get_cl_cw("DDR3", tck)
+    cl_sys_latency = get_sys_latency(nphases, cl)
+    cwl_sys_latency = get_sys_latency(nphases, cwl)
+    rdcmdphase, rdphase = get_sys_phases(nphases, cl_sys_latency, cl)
+    wrcmdphase, wrphase = get_sys_phases(nphases, cwl_sys_latency, cwl)
+    return PhySettings(
+        phytype="ECP5DDRPHY",
+        memtype="DDR3",
+        databits=16,
+        dfi_databits=64,
+        nranks=nranks,
+        nphases=nphases,
+        rdphase=rdphase,
+        wrphase=wrphase,
+        rdcmdphase=rdcmdphase,
+        wrcmdphase=wrcmdphase,
+        cl=cl,
+        cwl=cwl,
+        read_latency=2 + cl_sys_latency + 2 + log2_int(4//nphases) + 4,
+        write_latency=cwl_sys_latency)
+
+
+class Benchmark:
+    """Controller benchmark
+
+    Drives native ports of a controller and crossbar attached to a behavioural `FakePHY`, in
+    simulation. Each port issues the accesses of its workload as fast as the controller accepts
+    them, with at most `max_outstanding` transactions in flight. Latencies are measured from the
+    cycle a command is presented to the cycle its data is transferred (read data valid or write
+    data ready).
+
+    Parameters
+    ----------
+    module : SDRAMModule
+        DRAM module, defaults to a MT41K256M16 at `clk_freq`
+    phy_settings : PhySettings
+        PHY settings, defaults to `default_phy_settings(clk_freq)`
+    clk_freq : float
+        System clock frequency
+    nports : int
+        Number of native ports
+    controller_settings : ControllerSettings
+        Controller settings under test
+    max_outstanding : int
+        Transactions in flight per port
+
+    Attributes
+    ----------
+    layout : AddressLayout
+        Native port address layout, for the generators
+    ports : [gramNativePort]
+        Native ports
+    metrics : BenchmarkMetrics
+        Collected metrics
+    """
+    def __init__(self, module=None, phy_settings=None, clk_freq=100e6, nports=1,
+                 controller_settings=None, max_outstanding=8):
+        if nports < 1:
+            raise ValueError("At least one port is needed, not {}".format(nports))
+        if max_outstanding < 1:
+            raise ValueError("At least one transaction must be allowed in flight, not {}"
+                             .format(max_outstanding))
+
+        if module is None:
+            module = MT41K256M16(clk_freq, "1:2")
+        if phy_settings is None:
+            phy_settings = default_phy_settings(clk_freq)
+        if controller_settings is None:
+            controller_settings = ControllerSettings()
+
+        self.clk_freq = clk_freq
+        self.max_outstanding = max_outstanding
+
+        self.phy = FakePHY(module, phy_settings, clk_freq=clk_freq, behavioural=True)
+        self.controller = gramController(
+            phy_settings=phy_settings,
+            geom_settings=module.geom_settings,
+            timing_settings=module.timing_settings,
+            clk_freq=clk_freq,
+            controller_settings=controller_settings)
+        self.crossbar = gramCrossbar(self.controller.interface)
+        self.ports = [self.crossbar.get_native_port() for i in range(nports)]
+
+        self.layout = AddressLayout(
+            col_bits=module.geom_settings.colbits - self.controller.interface.address_align,
+            bank_bits=self.crossbar.bank_bits,
+            row_bits=module.geom_settings.rowbits)
+        self.data_width = self.ports[0].data_width
+
+        self.metrics = BenchmarkMetrics(self.data_width, clk_freq)
+        self._monitor = DFIMonitor(self.phy.dfi, sinks=[self.metrics.command])
+
+    def _port_process(self, n, accesses, max_cycles):
+        port = self.ports[n]
+        metrics = self.metrics
+
+        def process():
+            accesses_iter = iter(accesses)
+            access = next(accesses_iter, None)
+            # Cycles the outstanding transactions were presented on, data completes in order
+            reads = deque()
+            writes = deque()
+            cycle = 0
+
+            yield port.wdata.we.eq(2**len(port.wdata.we) - 1)
+
+            while access is not None or reads or writes:
+                if cycle == max_cycles:
+                    raise RuntimeError("Port {} did not complete its workload in {} cycles"
+                                       .format(n, max_cycles))
+
+                valid = access is not None and len(reads) + len(writes) < self.max_outstanding
+                yield port.cmd.valid.eq(valid)
+                if valid:
+                    yield port.cmd.we.eq(access.we)
+                    yield port.cmd.addr.eq(access.addr)
+                    if access.issued is None:
+                        access.issued = cycle
+                yield Settle()
+
+                if (yield port.wdata.ready):
+                    metrics.transaction(n, True, writes.popleft(), cycle)
+                if (yield port.rdata.valid):
+                    metrics.transaction(n, False, reads.popleft(), cycle)
+                if valid and (yield port.cmd.ready):
+                    (writes if access.we else reads).append(access.issued)
+                    access = next(accesses_iter, None)
+
+                yield
+                cycle += 1
+
+            yield port.cmd.valid.eq(0)
+
+        return process
+
+    def _simulate(self, processes, vcd_file=None):
+        m = Module()
+        m.submodules.phy = self.phy
+        m.submodules.controller = self.controller
+        m.submodules.crossbar = self.crossbar
+        m.d.comb += self.controller.dfi.connect(self.phy.dfi)
+
+        sim = Simulator(m)
+        sim.add_clock(1/self.clk_freq)
+        for process in self.phy.processes:
+            sim.add_sync_process(process)
+        sim.add_sync_process(self._monitor.process)
+        for process in processes:
+            sim.add_sync_process(process)
+
+        if vcd_file is not None:
+            with sim.write_vcd(vcd_file):
+                sim.run()
+        else:
+            sim.run()
+
+    def run(self, workloads, max_cycles=1000000, vcd_file=None):
+        """Run `workloads` (one iterable of `Access`es per port) and return the metrics summary
+
+        Missing workloads leave their ports idle. A benchmark can only be run once.
+        """
+        if len(workloads) > len(self.ports):
+            raise ValueError("{} workloads for {} ports".format(len(workloads), len(self.ports)))
+
+        processes = [self._port_process(n, (_Pending(a) for a in accesses), max_cycles)
+                     for n, accesses in enumerate(workloads)]
+        self._simulate(processes, vcd_file)
+
+        return self.metrics.summary()
+
+
+class _Pending:
+    # Access with the cycle it was first presented on
+    __slots__ = ("we", "addr", "issued")
+
+    def __init__(self, access):
+        self.we = access.we
+        self.addr = access.addr
+        self.issued = None
@@ -5,8 +5,6 @@
 # License: BSD
 
 import math
-from functools import reduce
-from operator import add
 from collections import OrderedDict
 
 from nmigen import *
@@ -60,6 +58,19 @@ def get_sys_phases(nphases, sys_latency, cas_latency):
     cmd_phase = (dat_phase - 1) % nphases
     return cmd_phase, dat_phase
 
+
+def get_rtw_ck(memtype, cl, cwl, bus_turnaround=2):
+    # JEDEC read to write command spacing, in memory clock cycles:
+    # the write burst (WL after WR) may only start once the read burst (RL after RD)
+    # has left the data bus, plus a bus turnaround gap (DQS preamble/ODT switching).
+    return cl + burst_lengths[memtype]//2 + bus_turnaround - cwl
+
+
+def get_rtw_latency(nphases, rtw_ck, rdphase, wrphase):
+    # Reads are issued on rdphase and writes on wrphase, convert the spacing to
+    # system clock cycles between both commands.
+    return max(math.ceil((rtw_ck - wrphase + rdphase)/nphases), 1)
+
 # Settings -----------------------------------------------------------------------------------------
 
 
@@ -74,11 +85,17 @@ class PhySettings(Settings):
                  nphases,
                  rdphase, wrphase,
                  rdcmdphase, wrcmdphase,
-                 cl, read_latency, write_latency, nranks=1, cwl=None):
+                 cl, read_latency, write_latency, nranks=1, cwl=None,
+                 rtw_latency=None):
         self.set_attributes(locals())
         self.cwl = cl if cwl is None else cwl
         self.is_rdimm = False
 
+        # Minimum number of system clock cycles between a read and a write command
+        if rtw_latency is None:
+            self.rtw_latency = get_rtw_latency(nphases, get_rtw_ck(memtype, cl, self.cwl),
+                                               rdphase, wrphase)
+
     # Optional DDR3/DDR4 electrical settings:
     # rtt_nom: Non-Writes on-die termination impedance
     # rtt_wr: Writes on-die termination impedance
@@ -244,6 +261,12 @@ class tXXDController(Elaboratable):
 
 
 class tFAWController(Elaboratable):
+    """Four Activate Window controller
+
+    `ready` is deasserted while four activates (`valid`) were issued in the last `tfaw` + 1
+    cycles. The issue times of the last four activates are tracked with countdown slots (the most
+    recent first), so the logic does not grow with `tfaw`.
+    """
     def __init__(self, tfaw):
         self.valid = Signal()
         self.ready = Signal(reset=1, attrs={"no_retiming": True})
@@ -253,14 +276,18 @@ class tFAWController(Elaboratable):
         m = Module()
 
         if self._tfaw is not None:
-            count = Signal(range(max(self._tfaw, 2)))
-            window = Signal(self._tfaw)
-            m.d.sync += window.eq(Cat(self.valid, window))
-            m.d.comb += count.eq(reduce(add, [window[i] for i in range(self._tfaw)]))
-            with m.If(count < 4):
-                with m.If(count == 3):
-                    m.d.sync += self.ready.eq(~self.valid)
-                with m.Else():
-                    m.d.sync += self.ready.eq(1)
+            # Cycles left in the window for each of the last four activates, 0 once expired
+            slots = [Signal(range(self._tfaw+1), name="slot{}".format(i)) for i in range(4)]
+
+            def countdown(slot):
+                return Mux(slot != 0, slot - 1, 0)
+
+            with m.If(self.valid):
+                m.d.sync += slots[0].eq(self._tfaw)
+                m.d.sync += [slots[i].eq(countdown(slots[i-1])) for i in range(1, 4)]
+                m.d.sync += self.ready.eq(slots[2] == 0)
+            with m.Else():
+                m.d.sync += [slot.eq(countdown(slot)) for slot in slots]
+                m.d.sync += self.ready.eq(slots[3] == 0)
 
         return m
@@ -7,10 +7,15 @@ from nmigen import tracer
 from nmigen.compat import Case
 from nmigen.back.pysim import *
 
-__ALL__ = ["delayed_enter", "Timeline", "CSRPrefixProxy"]
+__ALL__ = ["delayed_enter", "counted_delayed_enter", "Timeline", "CSRPrefixProxy"]
 
 
-def delayed_enter(m, src, dst, delay):
+def delayed_enter(m, src, dst, delay, max_states=4):
+    """Leave FSM state `src` for `dst` after `delay` cycles
+
+    Short delays are implemented as a chain of `delay` states, longer ones (more than
+    `max_states` cycles) as a single state with a down-counter (see `counted_delayed_enter`).
+    """
     if not isinstance(m, Module):
         raise ValueError("m must be a module object, not {!r}".format(m))
     if not isinstance(delay, int):
@@ -18,6 +23,10 @@ def delayed_enter(m, src, dst, delay):
     if delay < 1:
         raise ValueError("Delay must be at least one cycle, not {!r}".format(delay))
 
+    if max_states is not None and delay > max_states:
+        counted_delayed_enter(m, src, dst, delay)
+        return
+
     for i in range(delay):
         if i == 0:
             statename = src
@@ -33,6 +42,26 @@ def delayed_enter(m, src, dst, delay):
             m.next = deststate
 
 
+def counted_delayed_enter(m, src, dst, delay):
+    """Leave FSM state `src` for `dst` after `delay` cycles, counted in a single state"""
+    if not isinstance(m, Module):
+        raise ValueError("m must be a module object, not {!r}".format(m))
+    if not isinstance(delay, int):
+        raise ValueError("Delay must be an integer, not {!r}".format(delay))
+    if delay < 1:
+        raise ValueError("Delay must be at least one cycle, not {!r}".format(delay))
+
+    # The counter is reloaded when leaving the state, so it is ready for the next entry
+    count = Signal(range(delay), reset=delay-1, name="{}_count".format(src.replace("-", "_")))
+
+    with m.State(src):
+        with m.If(count == 0):
+            m.d.sync += count.eq(delay-1)
+            m.next = dst
+        with m.Else():
+            m.d.sync += count.eq(count-1)
+
+
 class Timeline(Elaboratable):
     def __init__(self, events):
         self.trigger = Signal()
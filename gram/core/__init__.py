@@ -3,6 +3,8 @@ from nmigen import *
 from lambdasoc.periph import Peripheral
 
 from gram.dfii import DFIInjector
+from gram.init import get_ddr3_mode_registers, InitSequencer
+from gram.phy import dfi
 from gram.compat import CSRPrefixProxy
 from gram.core.controller import ControllerSettings, gramController
 from gram.core.crossbar import gramCrossbar
@@ -10,7 +12,22 @@ from gram.core.crossbar import gramCrossbar
 __ALL__ = ["gramCore"]
 
 class gramCore(Peripheral, Elaboratable):
-    def __init__(self, phy, geom_settings, timing_settings, clk_freq, **kwargs):
+    """gram core
+
+    Parameters
+    ----------
+    with_init : bool
+        Initialize the DRAM in hardware after reset (see InitSequencer), instead of relying on
+        software to do it through the DFI injector
+    init_mode_registers : [int, int, int, int] or None
+        Mode registers used by the init sequencer (computed from the settings if None)
+    dfii_cmdlist_depth : int
+        Number of entries of the DFI injector command list (0 to disable it)
+    dfii_rdfifo_depth : int
+        Number of entries of the DFI injector read capture FIFOs (0 to disable them)
+    """
+    def __init__(self, phy, geom_settings, timing_settings, clk_freq, *, with_init=False,
+                 init_mode_registers=None, dfii_cmdlist_depth=0, dfii_rdfifo_depth=0, **kwargs):
         super().__init__("core")
 
         bank = self.csr_bank()
@@ -21,13 +38,30 @@ class gramCore(Peripheral, Elaboratable):
         self._clk_freq = clk_freq
         self._kwargs = kwargs
 
+        init = None
+        if with_init:
+            if init_mode_registers is None:
+                init_mode_registers = get_ddr3_mode_registers(self._phy.settings, self._timing_settings)
+            init = InitSequencer(
+                addressbits=self._geom_settings.addressbits,
+                bankbits=self._geom_settings.bankbits,
+                nranks=self._phy.settings.nranks,
+                databits=self._phy.settings.dfi_databits,
+                nphases=self._phy.settings.nphases,
+                clk_freq=self._clk_freq,
+                mode_registers=init_mode_registers,
+                trfc=self._timing_settings.tRFC)
+
         self.dfii = DFIInjector(
             csr_bank=CSRPrefixProxy(bank, "dfii"),
             addressbits=self._geom_settings.addressbits,
             bankbits=self._geom_settings.bankbits,
             nranks=self._phy.settings.nranks,
             databits=self._phy.settings.dfi_databits,
-            nphases=self._phy.settings.nphases)
+            nphases=self._phy.settings.nphases,
+            init=init,
+            cmdlist_depth=dfii_cmdlist_depth,
+            rdfifo_depth=dfii_rdfifo_depth)
 
         self.controller = gramController(
             phy_settings=self._phy.settings,
@@ -36,11 +70,48 @@ class gramCore(Peripheral, Elaboratable):
             clk_freq=self._clk_freq,
             **self._kwargs)
 
+        if self.controller.settings.rdly_tracking_interval and not hasattr(self._phy, "track_req"):
+            raise ValueError("PHY {!r} does not support read delay tracking".format(self._phy))
+
+        self.dfi_pipeline = dfi.Pipeline(
+            addressbits=self._geom_settings.addressbits,
+            bankbits=self._geom_settings.bankbits,
+            nranks=self._phy.settings.nranks,
+            databits=self._phy.settings.dfi_databits,
+            nphases=self._phy.settings.nphases,
+            stages=self.controller.settings.dfi_pipeline_stages)
+
         # Size in bytes
-        self.size = 2**geom_settings.bankbits * 2**geom_settings.rowbits * 2**geom_settings.colbits
+        self.size = self._phy.settings.nranks * 2**geom_settings.bankbits * 2**geom_settings.rowbits * 2**geom_settings.colbits
 
         self.crossbar = gramCrossbar(self.controller.interface)
 
+        # Runtime tunables
+        multiplexer = self.controller.multiplexer
+        self._tunables = [
+            (bank.csr(len(multiplexer.write_high_watermark), "rw", name="mux_write_high_watermark"),
+                multiplexer.write_high_watermark),
+            (bank.csr(len(multiplexer.write_low_watermark), "rw", name="mux_write_low_watermark"),
+                multiplexer.write_low_watermark),
+            (bank.csr(len(multiplexer.min_burst), "rw", name="mux_min_burst"),
+                multiplexer.min_burst),
+        ]
+        refresher = self.controller.refresher
+        self._tunables += [
+            (bank.csr(1, "rw", name="refresh_enable"), refresher.enable),
+            (bank.csr(len(refresher.trefi), "rw", name="refresh_trefi"), refresher.trefi),
+            (bank.csr(len(refresher.postponing), "rw", name="refresh_postponing"), refresher.postponing),
+            (bank.csr(len(refresher.zqcs_period), "rw", name="refresh_zqcs_period"), refresher.zqcs_period),
+        ]
+
+        # Read latency training: rdlat_measured holds the latency of the last read seen on the DFI
+        # (from rddata_en to rddata_valid, in system clock cycles), rdlat sets the latency assumed
+        # by the crossbar (defaults to the PHY read latency)
+        read_latency = self.controller.settings.phy.read_latency
+        self.rdlat_meter = dfi.ReadLatencyMeter(self.dfii.master, max_latency=2*read_latency)
+        self._rdlat_measured = bank.csr(len(self.rdlat_meter.latency), "r", name="rdlat_measured")
+        self._rdlat = bank.csr(len(self.crossbar.rdlat), "rw", name="rdlat")
+
         self._bridge = self.bridge(data_width=32, granularity=8, alignment=2)
         self.bus = self._bridge.bus
 
@@ -50,11 +121,35 @@ class gramCore(Peripheral, Elaboratable):
         m.submodules.bridge = self._bridge
 
         m.submodules.dfii = self.dfii
-        m.d.comb += self.dfii.master.connect(self._phy.dfi)
+        m.submodules.dfi_pipeline = self.dfi_pipeline
+        m.d.comb += [
+            self.dfii.master.connect(self.dfi_pipeline.sink),
+            self.dfi_pipeline.source.connect(self._phy.dfi),
+        ]
 
         m.submodules.controller = self.controller
         m.d.comb += self.controller.dfi.connect(self.dfii.slave)
 
         m.submodules.crossbar = self.crossbar
 
+        if self.controller.settings.rdly_tracking_interval:
+            refresher = self.controller.refresher
+            m.d.comb += [
+                self._phy.track_req.eq(refresher.track_req),
+                refresher.track_done.eq(self._phy.track_done),
+            ]
+
+        m.submodules.rdlat_meter = self.rdlat_meter
+        m.d.comb += [
+            self._rdlat_measured.r_data.eq(self.rdlat_meter.latency),
+            self._rdlat.r_data.eq(self.crossbar.rdlat - 1),
+        ]
+        with m.If(self._rdlat.w_stb):
+            m.d.sync += self.crossbar.rdlat.eq(self._rdlat.w_data + 1)
+
+        for csr, signal in self._tunables:
+            with m.If(csr.w_stb):
+                m.d.sync += signal.eq(csr.w_data)
+            m.d.comb += csr.r_data.eq(signal)
+
         return m
@@ -178,10 +178,14 @@ class BankMachine(Elaboratable):
         with m.FSM():
             with m.State("Regular"):
                 with m.If(self.refresh_req):
-                    with m.If(row_opened):
-                        m.next = "Precharge-For-Refresh"
-                    with m.Else():
+                    if self.settings.with_refresh_precharge_all:
+                        # The Refresher precharges all banks at once
                         m.next = "Refresh"
+                    else:
+                        with m.If(row_opened):
+                            m.next = "Precharge-For-Refresh"
+                        with m.Else():
+                            m.next = "Refresh"
                 with m.Elif(cmd_buffer.source.valid):
                     with m.If(row_opened):
                         with m.If(row_hit):
@@ -259,7 +263,8 @@ class BankMachine(Elaboratable):
                     self.cmd.is_cmd.eq(1),
                 ]
 
-                with m.If(twtpcon.ready):
+                # Precharge All timings must be satisfied for the open row
+                with m.If(twtpcon.ready & trascon.ready):
                     m.d.comb += self.refresh_gnt.eq(1)
                 with m.If(~self.refresh_req):
                     m.next = "Regular"
@@ -5,6 +5,8 @@
 
 """LiteDRAM Controller."""
 
+import copy
+
 from nmigen import *
 from nmigen.utils import log2_int
 
@@ -27,17 +29,35 @@ class ControllerSettings(Settings):
                  read_time=32,
                  write_time=16,
 
+                 # Write draining
+                 write_high_watermark=4,
+                 write_low_watermark=1,
+                 rw_min_burst=4,
+
+                 # Command arbitration ("roundrobin" or "oldest-first")
+                 cmd_arbitration="roundrobin",
+
                  # Refresh
                  with_refresh=True,
                  refresh_cls=Refresher,
                  refresh_zqcs_freq=1e0,
                  refresh_postponing=1,
+                 refresh_opportunistic=False,
+                 refresh_pullin=8,
+                 refresh_staggered=False,
+                 with_refresh_precharge_all=True,
+
+                 # PHY read delay tracking every N refreshes (0 to disable, needs PHY support)
+                 rdly_tracking_interval=0,
 
                  # Auto-Precharge
                  with_auto_precharge=True,
 
-                 # Address mapping
-                 address_mapping="ROW_BANK_COL"):
+                 # Address mapping ("ROW_BANK_COL" or "ROW_BANK_RANK_COL")
+                 address_mapping="ROW_BANK_COL",
+
+                 # Registered DFI stages between the controller and the PHY
+                 dfi_pipeline_stages=0):
         self.set_attributes(locals())
 
 # Controller ---------------------------------------------------------------------------------------
@@ -48,6 +68,11 @@ class gramController(Elaboratable):
                  controller_settings=ControllerSettings()):
         self._address_align = log2_int(burst_lengths[phy_settings.memtype])
 
+        # Read data goes through the DFI pipeline stages twice (command and data)
+        if controller_settings.dfi_pipeline_stages:
+            phy_settings = copy.copy(phy_settings)
+            phy_settings.read_latency += 2*controller_settings.dfi_pipeline_stages
+
         # Settings ---------------------------------------------------------------------------------
         self.settings = controller_settings
         self.settings.phy = phy_settings
@@ -68,34 +93,47 @@ class gramController(Elaboratable):
 
         self._clk_freq = clk_freq
 
-    def elaborate(self, platform):
-        m = Module()
-
-        nranks = self.settings.phy.nranks
-        nbanks = 2**self.settings.geom.bankbits
+        nranks = phy_settings.nranks
+        nbanks = 2**geom_settings.bankbits
 
         # Refresher --------------------------------------------------------------------------------
-        m.submodules.refresher = Refresher(self.settings,
-            clk_freq=self._clk_freq,
+        self.refresher = Refresher(self.settings,
+            clk_freq=clk_freq,
             zqcs_freq=self.settings.refresh_zqcs_freq,
-            postponing=self.settings.refresh_postponing)
+            postponing=self.settings.refresh_postponing,
+            opportunistic=self.settings.refresh_opportunistic,
+            pullin=self.settings.refresh_pullin,
+            staggered=self.settings.refresh_staggered,
+            track_interval=self.settings.rdly_tracking_interval)
 
         # Bank Machines ----------------------------------------------------------------------------
-        bank_machines = []
+        self.bank_machines = []
         for n in range(nranks*nbanks):
-            bank_machine = BankMachine(n, address_width=self.interface.address_width,
+            self.bank_machines.append(BankMachine(n, address_width=interface.address_width,
                 address_align=self._address_align,
-                nranks=nranks, settings=self.settings)
-            bank_machines.append(bank_machine)
-            setattr(m.submodules, "bankmachine"+str(n), bank_machine)
-            m.d.comb += getattr(self.interface, "bank" + str(n)).connect(bank_machine.req)
+                nranks=nranks, settings=self.settings))
 
         # Multiplexer ------------------------------------------------------------------------------
-        m.submodules.multiplexer = Multiplexer(
+        self.multiplexer = Multiplexer(
             settings=self.settings,
-            bank_machines=bank_machines,
-            refresher=m.submodules.refresher,
+            bank_machines=self.bank_machines,
+            refresher=self.refresher,
             dfi=self.dfi,
-            interface=self.interface)
+            interface=interface)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.refresher = self.refresher
+
+        for n, bank_machine in enumerate(self.bank_machines):
+            setattr(m.submodules, "bankmachine"+str(n), bank_machine)
+            m.d.comb += getattr(self.interface, "bank" + str(n)).connect(bank_machine.req)
+
+        m.submodules.multiplexer = self.multiplexer
+
+        # The controller is idle when no bank machine has a request pending
+        m.d.comb += self.refresher.idle.eq(
+            ~Cat(bm.req.valid | bm.req.lock for bm in self.bank_machines).any())
 
         return m
@@ -33,6 +33,33 @@ class _DelayLine(Elaboratable):
 
         return m
 
+class _VariableDelayLine(Elaboratable):
+    def __init__(self, max_delay):
+        if max_delay < 1:
+            raise ValueError("max_delay value must be 1+")
+        self.max_delay = max_delay
+
+        self.i = Signal()
+        self.o = Signal()
+        self.delay = Signal(range(max_delay + 1), reset=max_delay)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        buffer = Signal(self.max_delay)
+        m.d.sync += [
+            buffer.eq(Cat(self.i, buffer))
+        ]
+        with m.Switch(self.delay):
+            for delay in range(1, self.max_delay + 1):
+                with m.Case(delay):
+                    m.d.comb += self.o.eq(buffer[delay-1])
+            # Out of range delays fall back to the maximal delay
+            with m.Case():
+                m.d.comb += self.o.eq(buffer[-1])
+
+        return m
+
 class gramCrossbar(Elaboratable):
     """Multiplexes LiteDRAMController (slave) between ports (masters)
 
@@ -42,7 +69,9 @@ class gramCrossbar(Elaboratable):
     The crossbar routes requests from masters to the BankMachines
     (bankN.cmd_layout) and connects data path directly to the Multiplexer
     (data_layout). It performs address translation based on chosen
-    `controller.settings.address_mapping`.
+    `controller.settings.address_mapping`: "ROW_BANK_COL" (ranks are the upper
+    bank bits) or "ROW_BANK_RANK_COL" (ranks are interleaved right above the
+    column, so that sequential accesses spread over all ranks).
     Internally, all masters are multiplexed between controller banks based on
     the bank address (extracted from the presented address). Each bank has
     a RoundRobin arbiter, that selects from masters that want to access this
@@ -71,6 +100,9 @@ class gramCrossbar(Elaboratable):
     ----------
     masters : [LiteDRAMNativePort, ...]
         LiteDRAM memory ports
+    rdlat : Signal(range(read_latency + 1)), in
+        Delay applied to read data valid signals, defaults to the (conservative) PHY read
+        latency + 1
     """
 
     def __init__(self, controller):
@@ -82,6 +114,7 @@ class gramCrossbar(Elaboratable):
         self.cmd_buffer_depth = controller.settings.cmd_buffer_depth
         self.read_latency = controller.settings.phy.read_latency + 1
         self.write_latency = controller.settings.phy.write_latency + 1
+        self.rdlat = Signal(range(self.read_latency + 1), reset=self.read_latency)
 
         self.bank_bits = log2_int(self.nbanks, False)
         self.rank_bits = log2_int(self.nranks, False)
@@ -110,9 +143,17 @@ class gramCrossbar(Elaboratable):
             raise ValueError("No frontend instantiated")
 
         # Address mapping --------------------------------------------------------------------------
-        cba_shifts = {"ROW_BANK_COL": controller.settings.geom.colbits - controller.address_align}
+        cba_shifts = {
+            "ROW_BANK_COL":      controller.settings.geom.colbits - controller.address_align,
+            "ROW_BANK_RANK_COL": controller.settings.geom.colbits - controller.address_align,
+        }
+        if controller.settings.address_mapping not in cba_shifts:
+            raise ValueError("Unsupported address mapping: {}".format(controller.settings.address_mapping))
         cba_shift = cba_shifts[controller.settings.address_mapping]
         m_ba = [master.get_bank_address(self.bank_bits, cba_shift) for master in self.masters]
+        if controller.settings.address_mapping == "ROW_BANK_RANK_COL" and self.rank_bits:
+            # Rank bits are just above the column: consecutive column blocks alternate between ranks
+            m_ba = [Cat(ba[self.rank_bits:], ba[:self.rank_bits]) for ba in m_ba]
         m_rca = [master.get_row_column_address(self.bank_bits, self.rca_bits, cba_shift) for master in self.masters]
 
         master_readys = [0]*nmasters
@@ -165,9 +206,12 @@ class gramCrossbar(Elaboratable):
             master_wdata_readys[nm] = delayline.o
 
         for nm, master_rdata_valid in enumerate(master_rdata_valids):
-            delayline = _DelayLine(self.read_latency)
+            delayline = _VariableDelayLine(self.read_latency)
             m.submodules += delayline
-            m.d.comb += delayline.i.eq(master_rdata_valid)
+            m.d.comb += [
+                delayline.i.eq(master_rdata_valid),
+                delayline.delay.eq(self.rdlat),
+            ]
             master_rdata_valids[nm] = delayline.o
 
         for master, master_ready in zip(self.masters, master_readys):
@@ -11,6 +11,7 @@ import math
 from nmigen import *
 from nmigen.asserts import Assert, Assume
 from nmigen.lib.scheduler import RoundRobin
+from nmigen.lib.coding import Decoder
 
 from gram.common import *
 import gram.stream as stream
@@ -21,13 +22,18 @@ __ALL__ = ["Multiplexer"]
 class _CommandChooser(Elaboratable):
     """Arbitrates between requests, filtering them based on their type
 
-    Uses RoundRobin to choose current request, filters requests based on
-    `want_*` signals.
+    Uses RoundRobin (or _OldestFirst) to choose current request, filters
+    requests based on `want_*` signals.
 
     Parameters
     ----------
     requests : [Endpoint(cmd_request_rw_layout), ...]
         Request streams to consider for arbitration
+    arbitration : str
+        "roundrobin" (default) or "oldest-first". With "oldest-first", each
+        request stream has a saturating counter of the cycles it has been
+        waiting (valid & ~ready), and the eligible request that has been waiting
+        the longest is chosen.
 
     Attributes
     ----------
@@ -43,13 +49,17 @@ class _CommandChooser(Elaboratable):
         Currently selected request stream (when ~cmd.valid, cas/ras/we are 0)
     """
 
-    def __init__(self, requests):
+    def __init__(self, requests, arbitration="roundrobin"):
+        if arbitration not in ["roundrobin", "oldest-first"]:
+            raise ValueError("Unsupported arbitration: {}".format(arbitration))
+
         self.want_reads = Signal()
         self.want_writes = Signal()
         self.want_cmds = Signal()
         self.want_activates = Signal()
 
         self._requests = requests
+        self._arbitration = arbitration
         a = len(requests[0].a)
         ba = len(requests[0].ba)
 
@@ -72,12 +82,22 @@ class _CommandChooser(Elaboratable):
 
         # Arbitrate if a command is being accepted or if the command is not valid to ensure a valid
         # command is selected when cmd.ready goes high.
-        m.submodules.arbiter = arbiter = EnableInserter(self.cmd.ready | ~self.cmd.valid)(RoundRobin(count=n))
+        if self._arbitration == "oldest-first":
+            arbiter = _OldestFirst(count=n)
+            for i, request in enumerate(self._requests):
+                age = arbiter.ages[i]
+                with m.If(~request.valid | request.ready):
+                    m.d.sync += age.eq(0)
+                with m.Elif(age != 2**len(age)-1):
+                    m.d.sync += age.eq(age+1)
+            # Do not grant again the request being accepted, its next command is a new one
+            m.d.comb += arbiter.requests.eq(valids & ~self.ready)
+        else:
+            arbiter = RoundRobin(count=n)
+            m.d.comb += arbiter.requests.eq(valids)
+        m.submodules.arbiter = arbiter = EnableInserter(self.cmd.ready | ~self.cmd.valid)(arbiter)
         choices = Array(valids[i] for i in range(n))
-        m.d.comb += [
-            arbiter.requests.eq(valids),
-            self.cmd.valid.eq(choices[arbiter.grant])
-        ]
+        m.d.comb += self.cmd.valid.eq(choices[arbiter.grant])
 
         for name in ["a", "ba", "is_read", "is_write", "is_cmd"]:
             choices = Array(getattr(req, name) for req in self._requests)
@@ -108,6 +128,65 @@ class _CommandChooser(Elaboratable):
     def read(self):
         return self.cmd.is_read
 
+class _OldestFirst(Elaboratable):
+    """Grants the active request that has been waiting the longest
+
+    Same interface as RoundRobin, with an additional wait time per request. Ties
+    are resolved in favour of the lowest index: as the wait times saturate, the
+    width of the counters must be large enough for every request to be served
+    before a just-served one is saturated again.
+
+    Parameters
+    ----------
+    count : int
+        Number of requests
+    age_width : int
+        Width of the wait time counters
+
+    Attributes
+    ----------
+    requests : Signal(count), in
+        Set of requests
+    ages : [Signal(age_width), ...], in
+        Number of cycles each request has been waiting
+    grant : Signal(range(count)), out
+        Number of the granted request (registered, kept when no request is active)
+    valid : Signal(), out
+        Asserted if grant corresponds to an active request
+    """
+    def __init__(self, *, count, age_width=6):
+        if 2**age_width - 1 <= count:
+            raise ValueError("age_width is too small for {} requests".format(count))
+
+        self.count = count
+        self.requests = Signal(count)
+        self.ages = [Signal(age_width, name="age{}".format(i)) for i in range(count)]
+        self.grant = Signal(range(count))
+        self.valid = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Comparison tree: each node carries (active, age, index) of its oldest request
+        nodes = [(self.requests[i], self.ages[i], Const(i, len(self.grant))) for i in range(self.count)]
+        while len(nodes) > 1:
+            next_nodes = []
+            for left, right in zip(nodes[0::2], nodes[1::2]):
+                pick_left = Signal()
+                m.d.comb += pick_left.eq(left[0] & (~right[0] | (left[1] >= right[1])))
+                next_nodes.append((left[0] | right[0],
+                                   Mux(pick_left, left[1], right[1]),
+                                   Mux(pick_left, left[2], right[2])))
+            if len(nodes) % 2:
+                next_nodes.append(nodes[-1])
+            nodes = next_nodes
+
+        with m.If(self.requests.any()):
+            m.d.sync += self.grant.eq(nodes[0][2])
+        m.d.sync += self.valid.eq(self.requests.any())
+
+        return m
+
 # _Steerer -----------------------------------------------------------------------------------------
 
 
@@ -119,7 +198,8 @@ class _Steerer(Elaboratable):
 
     cas/ras/we/is_write/is_read are connected only when `cmd.valid & cmd.ready`.
     Rank bits are decoded and used to drive cs_n in multi-rank systems,
-    STEER_REFRESH always enables all ranks.
+    STEER_REFRESH enables all ranks unless `refresh_all_ranks` is disabled
+    (refreshes are then sent to the rank they address).
 
     Parameters
     ----------
@@ -130,6 +210,8 @@ class _Steerer(Elaboratable):
         always considered invalid (because of lack of the `valid` attribute).
     dfi : dfi.Interface
         DFI interface connected to PHY
+    refresh_all_ranks : bool
+        Send refreshes to all ranks at once
 
     Attributes
     ----------
@@ -139,12 +221,13 @@ class _Steerer(Elaboratable):
         select given source.
     """
 
-    def __init__(self, commands, dfi):
+    def __init__(self, commands, dfi, refresh_all_ranks=True):
         if len(commands) != 4:
             raise ValueError("Commands is not the right size")
 
         self.commands = commands
         self.dfi = dfi
+        self._refresh_all_ranks = refresh_all_ranks
         self.sel = [Signal(range(len(commands))) for i in range(len(dfi.phases))]
 
     def elaborate(self, platform):
@@ -169,9 +252,9 @@ class _Steerer(Elaboratable):
                 rank_decoder = Decoder(nranks)
                 m.submodules += rank_decoder
                 m.d.comb += rank_decoder.i.eq((Array(cmd.ba[-rankbits:] for cmd in self.commands)[sel]))
-                if i == 0:  # Select all ranks on refresh.
+                if i == 0 and self._refresh_all_ranks:  # Select all ranks on refresh.
                     with m.If(sel == STEER_REFRESH):
-                        m.d.sync += phase.cs.eq(1)
+                        m.d.sync += phase.cs.eq(Repl(1, nranks))
                     with m.Else():
                         m.d.sync += phase.cs.eq(rank_decoder.o)
                 else:
@@ -252,6 +335,18 @@ class Multiplexer(Elaboratable):
         DFI connected to the PHY
     interface : LiteDRAMInterface
         Data interface connected directly to LiteDRAMCrossbar
+
+    Attributes
+    ----------
+    write_high_watermark : Signal(), in
+        Number of bank machines with a pending write from which reads are
+        interrupted to drain writes (reset value from settings)
+    write_low_watermark : Signal(), in
+        Number of bank machines with a pending write down to which writes are
+        drained before serving pending reads (reset value from settings)
+    min_burst : Signal(), in
+        Minimum number of column commands issued in one direction before a
+        watermark can trigger a read/write turnaround (reset value from settings)
     """
 
     def __init__(self,
@@ -267,6 +362,13 @@ class Multiplexer(Elaboratable):
         self._dfi = dfi
         self._interface = interface
 
+        nbms = len(bank_machines)
+        self.write_high_watermark = Signal(range(nbms+1),
+            reset=min(settings.write_high_watermark, nbms))
+        self.write_low_watermark = Signal(range(nbms+1),
+            reset=min(settings.write_low_watermark, nbms))
+        self.min_burst = Signal(8, reset=settings.rw_min_burst)
+
     def elaborate(self, platform):
         m = Module()
 
@@ -281,8 +383,8 @@ class Multiplexer(Elaboratable):
 
         # Command choosing -------------------------------------------------------------------------
         requests = [bm.cmd for bm in bank_machines]
-        m.submodules.choose_cmd = choose_cmd = _CommandChooser(requests)
-        m.submodules.choose_req = choose_req = _CommandChooser(requests)
+        m.submodules.choose_cmd = choose_cmd = _CommandChooser(requests, settings.cmd_arbitration)
+        m.submodules.choose_req = choose_req = _CommandChooser(requests, settings.cmd_arbitration)
         for i, request in enumerate(requests):
             m.d.comb += request.ready.eq(choose_cmd.ready[i] | choose_req.ready[i])
         if settings.phy.nphases == 1:
@@ -296,7 +398,8 @@ class Multiplexer(Elaboratable):
                                         log2_int(len(bank_machines))))
         # nop must be 1st
         commands = [nop, choose_cmd.cmd, choose_req.cmd, refresher.cmd]
-        m.submodules.steerer = steerer = _Steerer(commands, dfi)
+        m.submodules.steerer = steerer = _Steerer(commands, dfi,
+            refresh_all_ranks=not settings.refresh_staggered)
 
         # tRRD timing (Row to Row delay) -----------------------------------------------------------
         m.submodules.trrdcon = trrdcon = tXXDController(settings.timing.tRRD)
@@ -313,8 +416,25 @@ class Multiplexer(Elaboratable):
         m.submodules.tccdcon = tccdcon = tXXDController(settings.timing.tCCD)
         m.d.comb += tccdcon.valid.eq(choose_req.accept() & (choose_req.write() | choose_req.read()))
 
+        # tRTRS timing (Rank to Rank switch) -------------------------------------------------------
+        nranks = settings.phy.nranks
+        rankbits = log2_int(nranks)
+        if rankbits:
+            # Column commands to another rank wait 2 more DRAM clock cycles for the DQS handoff
+            trtrs = (settings.timing.tCCD or 1) + math.ceil(2/settings.phy.nphases)
+            m.submodules.trtrscon = trtrscon = tXXDController(trtrs)
+            m.d.comb += trtrscon.valid.eq(choose_req.accept() & (choose_req.write() | choose_req.read()))
+            last_rank = Signal(rankbits)
+            rank_switch = Signal()
+            with m.If(trtrscon.valid):
+                m.d.sync += last_rank.eq(choose_req.cmd.ba[-rankbits:])
+            m.d.comb += rank_switch.eq(choose_req.cmd.ba[-rankbits:] != last_rank)
+
         # CAS control ------------------------------------------------------------------------------
-        m.d.comb += cas_allowed.eq(tccdcon.ready)
+        if rankbits:
+            m.d.comb += cas_allowed.eq(tccdcon.ready & (~rank_switch | trtrscon.ready))
+        else:
+            m.d.comb += cas_allowed.eq(tccdcon.ready)
 
         # tWTR timing (Write to Read delay) --------------------------------------------------------
         write_latency = math.ceil(settings.phy.cwl / settings.phy.nphases)
@@ -330,14 +450,36 @@ class Multiplexer(Elaboratable):
         writes = Signal(len(requests))
         m.d.comb += writes.eq(Cat([(req.valid & req.is_write) for req in requests]))
 
+        # Write draining ---------------------------------------------------------------------------
+        # Pending writes are counted in bank machines presenting a write command. Outside of
+        # starvation, a turnaround is only taken early once at least `min_burst` column commands
+        # have been issued in the current direction and the pending writes cross a watermark.
+        pending_writes = Signal(range(len(requests)+1))
+        m.d.comb += pending_writes.eq(sum(writes[i] for i in range(len(requests))))
+
+        burst = Signal.like(self.min_burst)
+        burst_done = Signal()
+        m.d.comb += burst_done.eq(burst >= self.min_burst)
+
         # Anti Starvation --------------------------------------------------------------------------
         m.submodules.read_antistarvation = read_antistarvation = _AntiStarvation(settings.read_time)
         m.submodules.write_antistarvation = write_antistarvation = _AntiStarvation(settings.write_time)
 
         # Refresh ----------------------------------------------------------------------------------
-        m.d.comb += [bm.refresh_req.eq(refresher.cmd.valid) for bm in bank_machines]
+        # With staggered refreshes, only the bank machines of the refreshed rank take part (the
+        # other ones keep their rows open). No command is issued to any rank during the refresh.
+        bm_refresh_reqs = Signal(len(bank_machines))
+        for n, bm in enumerate(bank_machines):
+            if rankbits and settings.refresh_staggered:
+                rank = n >> settings.geom.bankbits
+                m.d.comb += bm_refresh_reqs[n].eq(refresher.cmd.valid & (refresher.cmd.ba[-rankbits:] == rank))
+            else:
+                m.d.comb += bm_refresh_reqs[n].eq(refresher.cmd.valid)
+            m.d.comb += bm.refresh_req.eq(bm_refresh_reqs[n])
         bm_refresh_gnts = Signal(len(bank_machines))
         m.d.comb += bm_refresh_gnts.eq(Cat([bm.refresh_gnt for bm in bank_machines]))
+        refresh_granted = Signal()
+        m.d.comb += refresh_granted.eq(refresher.cmd.valid & (bm_refresh_gnts | ~bm_refresh_reqs).all())
 
         # Datapath ---------------------------------------------------------------------------------
         all_rddata = [p.rddata for p in dfi.phases]
@@ -350,7 +492,7 @@ class Multiplexer(Elaboratable):
         ]
 
         # Control FSM ------------------------------------------------------------------------------
-        with m.FSM():
+        with m.FSM() as fsm:
             with m.State("Read"):
                 m.d.comb += [
                     read_antistarvation.en.eq(1),
@@ -375,11 +517,12 @@ class Multiplexer(Elaboratable):
                     ]
 
                 with m.If(writes.any()):
-                    # TODO: switch only after several cycles of ~reads.any()?
                     with m.If(~reads.any() | read_antistarvation.max_time):
                         m.next = "RTW"
+                    with m.Elif(burst_done & (pending_writes >= self.write_high_watermark)):
+                        m.next = "RTW"
 
-                with m.If(bm_refresh_gnts.all()):
+                with m.If(refresh_granted):
                     m.next = "Refresh"
 
             with m.State("Write"):
@@ -408,8 +551,10 @@ class Multiplexer(Elaboratable):
                 with m.If(reads.any()):
                     with m.If(~writes.any() | write_antistarvation.max_time):
                         m.next = "WTR"
+                    with m.Elif(burst_done & (pending_writes <= self.write_low_watermark)):
+                        m.next = "WTR"
 
-                with m.If(bm_refresh_gnts.all()):
+                with m.If(refresh_granted):
                     m.next = "Refresh"
 
             with m.State("Refresh"):
@@ -424,7 +569,14 @@ class Multiplexer(Elaboratable):
                 with m.If(twtrcon.ready):
                     m.next = "Read"
 
-            # TODO: reduce this, actual limit is around (cl+1)/nphases
-            delayed_enter(m, "RTW", "Write", settings.phy.read_latency-1)
+            # Write commands can be accepted as soon as we enter Write: the last read was at most
+            # accepted on the cycle we entered RTW
+            delayed_enter(m, "RTW", "Write", max(settings.phy.rtw_latency-1, 1))
+
+        # Count column commands issued since the last turnaround (saturating)
+        with m.If(~fsm.ongoing("Read") & ~fsm.ongoing("Write")):
+            m.d.sync += burst.eq(0)
+        with m.Elif(choose_req.accept() & (choose_req.write() | choose_req.read()) & ~burst.all()):
+            m.d.sync += burst.eq(burst+1)
 
         return m
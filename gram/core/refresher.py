@@ -53,6 +53,14 @@ class RefreshExecuter(Elaboratable):
                 self.ras.eq(1),
                 self.we.eq(1)
             ]),
+            # Commands last one cycle
+            (1, [
+                self.a.eq(0),
+                self.ba.eq(0),
+                self.cas.eq(0),
+                self.ras.eq(0),
+                self.we.eq(0),
+            ]),
             # Auto Refresh after tRP
             (trp, [
                 self.a.eq(0),
@@ -61,6 +69,14 @@ class RefreshExecuter(Elaboratable):
                 self.ras.eq(1),
                 self.we.eq(0),
             ]),
+            # Commands last one cycle
+            (trp + 1, [
+                self.a.eq(0),
+                self.ba.eq(0),
+                self.cas.eq(0),
+                self.ras.eq(0),
+                self.we.eq(0),
+            ]),
             # Done after tRP + tRFC
             (trp + trfc, [
                 self.a.eq(0),
@@ -70,6 +86,9 @@ class RefreshExecuter(Elaboratable):
                 self.we.eq(0),
                 self.done.eq(1),
             ]),
+            (trp + trfc + 1, [
+                self.done.eq(0),
+            ]),
         ])
         m.d.comb += tl.trigger.eq(self.start)
 
@@ -81,12 +100,17 @@ class RefreshExecuter(Elaboratable):
 class RefreshSequencer(Elaboratable):
     """Refresh Sequencer
 
-    Sequence N refreshs to the DRAM.
+    Sequence N refreshs to the DRAM. N is given by the `postponing` signal (up to
+    `max_postponing`, reset value `postponing`) and sampled on `start`.
     """
 
-    def __init__(self, abits, babits, trp, trfc, postponing=1):
+    def __init__(self, abits, babits, trp, trfc, postponing=1, max_postponing=None):
+        if max_postponing is None:
+            max_postponing = postponing
+
         self.start = Signal()
         self.done = Signal()
+        self.postponing = Signal(range(max_postponing+1), reset=postponing)
 
         self._trp = trp
         self._trfc = trfc
@@ -115,18 +139,22 @@ class RefreshSequencer(Elaboratable):
         countEqZero = Signal(reset=(self._postponing <= 1))
         countDiffZero = Signal(reset=(self._postponing > 1))
 
-        count = Signal(range(self._postponing), reset=self._postponing-1)
+        # Restart the executer once it is done, while refreshes are left
+        restart = Signal()
+        m.d.sync += restart.eq(executer.done & countDiffZero)
+
+        count = Signal(len(self.postponing), reset=self._postponing-1)
         with m.If(self.start):
             m.d.sync += [
-                count.eq(count.reset),
-                countEqZero.eq(self._postponing <= 1),
-                countDiffZero.eq(self._postponing > 1),
+                count.eq(Mux(self.postponing > 1, self.postponing - 1, 0)),
+                countEqZero.eq(self.postponing <= 1),
+                countDiffZero.eq(self.postponing > 1),
             ]
         with m.Elif(executer.done):
             with m.If(count != 0):
                 m.d.sync += count.eq(count-1)
 
-            with m.If(count == 1):
+            with m.If(count <= 1):
                 m.d.sync += [
                     countEqZero.eq(1),
                     countDiffZero.eq(0),
@@ -138,7 +166,7 @@ class RefreshSequencer(Elaboratable):
                 ]
 
         m.d.comb += [
-            executer.start.eq(self.start | countDiffZero),
+            executer.start.eq(self.start | restart),
             self.done.eq(executer.done & countEqZero),
         ]
 
@@ -157,21 +185,28 @@ class RefreshTimer(Elaboratable):
     """Refresh Timer
 
     Generate periodic pulses (tREFI period) to trigger DRAM refresh.
+
+    The period is given by the `trefi` signal (up to `max_trefi`, reset value `trefi`), a new
+    value is taken into account when the counter reloads. Values under 2 are treated as 2.
     """
 
-    def __init__(self, trefi):
+    def __init__(self, trefi, max_trefi=None):
         if trefi < 2:
             raise ValueError("trefi values under 2 are currently unsupported")
+        if max_trefi is None:
+            max_trefi = trefi
 
         self.wait = Signal()
         self.done = Signal()
-        self.count = Signal(range(trefi), reset=trefi-1)
+        self.trefi = Signal(range(max_trefi+1), reset=trefi)
+        self.count = Signal(len(self.trefi), reset=trefi-1)
         self._trefi = trefi
 
     def elaborate(self, platform):
         m = Module()
 
-        trefi = self._trefi
+        reload = Signal.like(self.count)
+        m.d.comb += reload.eq(Mux(self.trefi < 2, 1, self.trefi - 1))
 
         with m.If(self.wait & (self.count != 0)):
             m.d.sync += self.count.eq(self.count-1)
@@ -180,7 +215,7 @@ class RefreshTimer(Elaboratable):
                 m.d.sync += self.done.eq(1)
         with m.Else():
             m.d.sync += [
-                self.count.eq(self.count.reset),
+                self.count.eq(reload),
                 self.done.eq(0),
             ]
 
@@ -195,28 +230,41 @@ class RefreshTimer(Elaboratable):
 class RefreshPostponer(Elaboratable):
     """Refresh Postponer
 
-    Postpone N Refresh requests and generate a request when N is reached.
+    Postpone N Refresh requests and generate a request when N is reached. N is given by the
+    `postponing` signal (up to `max_postponing`, reset value `postponing`). The number of
+    requests postponed is latched in `count` with `req_o`: it can exceed the current `postponing`
+    value when it was lowered in the meantime.
     """
 
-    def __init__(self, postponing=1):
+    def __init__(self, postponing=1, max_postponing=None):
+        if max_postponing is None:
+            max_postponing = postponing
+
         self.req_i = Signal()
         self.req_o = Signal()
+        self.postponing = Signal(range(max_postponing+1), reset=postponing)
+        self.count = Signal(range(max_postponing+1), reset=postponing)
         self._postponing = postponing
+        self._max_postponing = max_postponing
 
     def elaborate(self, platform):
         m = Module()
 
-        count = Signal(range(self._postponing), reset=self._postponing-1)
+        # Requests postponed since the last generated one, and with the current one
+        postponed = Signal(range(self._max_postponing))
+        pending = Signal(range(self._max_postponing+1))
+        m.d.comb += pending.eq(postponed + 1)
 
         with m.If(self.req_i):
-            with m.If(count == 0):
+            with m.If(pending >= self.postponing):
                 m.d.sync += [
-                    count.eq(count.reset),
+                    postponed.eq(0),
+                    self.count.eq(pending),
                     self.req_o.eq(1),
                 ]
             with m.Else():
                 m.d.sync += [
-                    count.eq(count-1),
+                    postponed.eq(pending),
                     self.req_o.eq(0),
                 ]
         with m.Else():
@@ -224,6 +272,55 @@ class RefreshPostponer(Elaboratable):
 
         return m
 
+# RefreshScheduler -------------------------------------------------------------------------------
+
+
+class RefreshScheduler(Elaboratable):
+    """Refresh Scheduler
+
+    Track the refresh debt (tREFI periods elapsed minus refreshes done) and request a refresh:
+    - when the controller is idle, as long as less than `pullin` refreshes have been done in advance.
+    - when `postponing` refreshes are owed, regardless of the traffic.
+
+    DDR3 allows up to 8 refreshes to be postponed or pulled in. Once 8 refreshes are still owed after
+    the one being done, `urgent` is asserted: refreshes must be issued back to back. Ticks are not
+    dropped if refreshes are held off longer, the debt only saturates at 255.
+    """
+
+    def __init__(self, postponing=8, pullin=8):
+        if not (1 <= postponing <= 8) or not (0 <= pullin <= 8):
+            raise ValueError("DDR3 allows up to 8 refreshes to be postponed or pulled in")
+
+        self.tick = Signal()
+        self.idle = Signal()
+        self.done = Signal()
+        self.req_o = Signal()
+        self.urgent = Signal()
+        self.postponing = Signal(range(9), reset=postponing)
+        self.debt = Signal(range(-pullin, 256))
+        self._pullin = pullin
+
+    def elaborate(self, platform):
+        m = Module()
+
+        with m.If(self.tick & ~self.done):
+            with m.If(self.debt != 255):
+                m.d.sync += self.debt.eq(self.debt+1)
+        with m.Elif(self.done & ~self.tick):
+            with m.If(self.debt != -self._pullin):
+                m.d.sync += self.debt.eq(self.debt-1)
+
+        limit = Signal.like(self.postponing)
+        m.d.comb += limit.eq(Mux(self.postponing == 0, 1, self.postponing))
+
+        m.d.comb += [
+            self.req_o.eq((self.debt >= limit) |
+                          (self.idle & (self.debt > -self._pullin))),
+            self.urgent.eq(self.debt >= 8 + self.done),
+        ]
+
+        return m
+
 # ZQCSExecuter ----------------------------------------------------------------------------------
 
 
@@ -265,6 +362,14 @@ class ZQCSExecuter(Elaboratable):
                 self.we.eq(1),
                 self.done.eq(0)
             ]),
+            # Commands last one cycle
+            (1, [
+                self.a.eq(0),
+                self.ba.eq(0),
+                self.cas.eq(0),
+                self.ras.eq(0),
+                self.we.eq(0),
+            ]),
             # ZQ Short Calibration after tRP
             (trp, [
                 self.a.eq(0),
@@ -274,6 +379,14 @@ class ZQCSExecuter(Elaboratable):
                 self.we.eq(1),
                 self.done.eq(0),
             ]),
+            # Commands last one cycle
+            (trp + 1, [
+                self.a.eq(0),
+                self.ba.eq(0),
+                self.cas.eq(0),
+                self.ras.eq(0),
+                self.we.eq(0),
+            ]),
             # Done after tRP + tZQCS
             (trp + tzqcs, [
                 self.a.eq(0),
@@ -283,6 +396,9 @@ class ZQCSExecuter(Elaboratable):
                 self.we.eq(0),
                 self.done.eq(1)
             ]),
+            (trp + tzqcs + 1, [
+                self.done.eq(0),
+            ]),
         ])
         m.d.comb += tl.trigger.eq(self.start)
 
@@ -304,57 +420,172 @@ class Refresher(Elaboratable):
     this allows the Controller to finish the current transaction and block next transactions. Once all
     transactions are done, the Refresher can execute the refresh Sequence and release the Controller.
 
+    When `opportunistic` is set, refreshes are issued one at a time by a RefreshScheduler: early when
+    the Controller is `idle` (up to `pullin` in advance), and postponed while there is traffic (up to
+    `postponing`). If refreshes could not be issued in time and 8 are still owed once one is done,
+    the next one is issued without releasing the Controller.
+
+    When `staggered` is set on multi-rank systems, ranks are refreshed one after the other (the rank
+    is given by the upper bits of `cmd.ba`) every tREFI/nranks instead of all at once every tREFI,
+    so that only the bank machines of one rank close their rows at a time. The Multiplexer still
+    stops issuing commands to every rank while a refresh is done: staggering spreads the refreshes
+    over time, it does not overlap them with traffic to the other ranks. ZQCS is then issued to
+    each rank in turn as well.
+
+    When `track_interval` is set, every `track_interval` refreshes the refresh window is extended
+    until the PHY has tracked its read delays: `track_req` is asserted after the refresh (all banks
+    are then precharged) and the Controller is released on `track_done`. With staggered refreshes,
+    tracking is only done after refreshes of rank 0.
+
+    Attributes
+    ----------
+    enable : Signal(), in
+        Enable refreshes (reset value from settings.with_refresh)
+    trefi : Signal(), in
+        Refresh interval in system clock cycles, up to twice tREFI (reset value tREFI)
+    postponing : Signal(), in
+        Number of refreshes to postpone, up to 8 (reset value `postponing`)
+    zqcs_period : Signal(), in
+        ZQCS interval in system clock cycles, up to twice the nominal period (reset value
+        clk_freq/zqcs_freq)
+    track_req : Signal(), out
+        Read delay tracking request to the PHY
+    track_done : Signal(), in
+        Read delay tracking completed
     """
 
-    def __init__(self, settings, clk_freq, zqcs_freq=1e0, postponing=1):
+    def __init__(self, settings, clk_freq, zqcs_freq=1e0, postponing=1, opportunistic=False, pullin=8,
+                 staggered=False, track_interval=0):
         assert postponing <= 8
+        assert pullin <= 8
+        self.idle = Signal()
         self._abits = settings.geom.addressbits
         self._babits = settings.geom.bankbits + log2_int(settings.phy.nranks)
         self.cmd = cmd = stream.Endpoint(cmd_request_rw_layout(a=self._abits, ba=self._babits))
         self._postponing = postponing
+        self._opportunistic = opportunistic
+        self._pullin = pullin
         self._settings = settings
         self._clk_freq = clk_freq
         self._zqcs_freq = zqcs_freq
+        self._rankbits = log2_int(settings.phy.nranks) if staggered else 0
+        self._track_interval = track_interval
+
+        trefi = settings.timing.tREFI
+        zqcs_period = int(clk_freq/zqcs_freq)
+        self.enable = Signal(reset=settings.with_refresh)
+        self.trefi = Signal(range(2*trefi+1), reset=trefi)
+        self.postponing = Signal(range(9), reset=postponing)
+        self.zqcs_period = Signal(range(2*zqcs_period+1), reset=zqcs_period)
+        self.track_req = Signal()
+        self.track_done = Signal()
 
     def elaborate(self, platform):
         m = Module()
 
         wants_refresh = Signal()
+        urgent = Signal()
 
         settings = self._settings
 
         # Refresh Timer ----------------------------------------------------------------------------
-        timer = RefreshTimer(settings.timing.tREFI)
+        timer = RefreshTimer(settings.timing.tREFI, 2*settings.timing.tREFI)
         m.submodules.timer = timer
-        m.d.comb += timer.wait.eq(~timer.done)
-
-        # Refresh Postponer ------------------------------------------------------------------------
-        postponer = RefreshPostponer(self._postponing)
-        m.submodules.postponer = postponer
         m.d.comb += [
-            postponer.req_i.eq(timer.done),
-            wants_refresh.eq(postponer.req_o),
+            timer.wait.eq(~timer.done),
+            timer.trefi.eq(self.trefi >> self._rankbits),
         ]
 
+        # Rank to refresh --------------------------------------------------------------------------
+        rankbits = self._rankbits
+        rank = Signal(rankbits)
+        nranks = 2**rankbits
+
         # Refresh Sequencer ------------------------------------------------------------------------
-        sequencer = RefreshSequencer(self._abits, self._babits, settings.timing.tRP, settings.timing.tRFC, self._postponing)
+        if self._opportunistic:
+            sequencer = RefreshSequencer(self._abits, self._babits, settings.timing.tRP, settings.timing.tRFC)
+        else:
+            sequencer = RefreshSequencer(self._abits, self._babits, settings.timing.tRP, settings.timing.tRFC,
+                self._postponing, 8)
         m.submodules.sequencer = sequencer
 
+        if self._opportunistic:
+
+            # Refresh Scheduler --------------------------------------------------------------------
+            scheduler = RefreshScheduler(self._postponing, self._pullin)
+            m.submodules.scheduler = scheduler
+            m.d.comb += [
+                scheduler.tick.eq(timer.done),
+                scheduler.idle.eq(self.idle),
+                scheduler.done.eq(sequencer.done),
+                scheduler.postponing.eq(self.postponing),
+                wants_refresh.eq(scheduler.req_o),
+                urgent.eq(scheduler.urgent),
+            ]
+        else:
+
+            # Refresh Postponer --------------------------------------------------------------------
+            postponer = RefreshPostponer(self._postponing, 8)
+            m.submodules.postponer = postponer
+            m.d.comb += [
+                postponer.req_i.eq(timer.done),
+                postponer.postponing.eq(self.postponing),
+                wants_refresh.eq(postponer.req_o),
+                # Issue as many refreshes as were postponed, even if `postponing` was lowered since
+                sequencer.postponing.eq(postponer.count),
+            ]
+
         if settings.timing.tZQCS is not None:
 
             # ZQCS Timer ---------------------------------------------------------------------------
-            zqcs_timer = RefreshTimer(int(self._clk_freq/self._zqcs_freq))
+            zqcs_period = int(self._clk_freq/self._zqcs_freq)
+            zqcs_timer = RefreshTimer(zqcs_period, 2*zqcs_period)
             m.submodules.zqcs_timer = zqcs_timer
+            m.d.comb += zqcs_timer.trefi.eq(self.zqcs_period)
 
             # ZQCS Executer ------------------------------------------------------------------------
             zqcs_executer = ZQCSExecuter(self._abits, self._babits, settings.timing.tRP, settings.timing.tZQCS)
             m.submodules.zqcs_executer = zqcs_executer
-            m.d.comb += zqcs_timer.wait.eq(~zqcs_executer.done)
+
+            # ZQCS is pending for each rank until it gets refreshed
+            zqcs_pending = Signal(nranks)
+            wants_zqcs = Signal()
+            m.d.comb += [
+                zqcs_timer.wait.eq(~zqcs_timer.done),
+                wants_zqcs.eq((zqcs_pending >> rank)[0]),
+            ]
+            with m.If(zqcs_executer.start):
+                m.d.sync += zqcs_pending.eq(zqcs_pending & ~(1 << rank))
+            with m.If(zqcs_timer.done):
+                m.d.sync += zqcs_pending.eq(2**nranks - 1)
+
+        # Read delay tracking ----------------------------------------------------------------------
+        if self._track_interval:
+            track_count = Signal(range(self._track_interval))
+            track_due = Signal()
+            m.d.comb += track_due.eq((track_count == self._track_interval - 1) & (rank == 0))
+
+        def finish():
+            m.d.comb += self.cmd.last.eq(1)
+            if rankbits:
+                m.d.sync += rank.eq(rank + 1)
+            m.next = "Idle"
+
+        def release():
+            if self._track_interval:
+                with m.If(track_due):
+                    m.next = "Do-Track"
+                with m.Else():
+                    with m.If(rank == 0):
+                        m.d.sync += track_count.eq(track_count + 1)
+                    finish()
+            else:
+                finish()
 
         # Refresh FSM ------------------------------------------------------------------------------
         with m.FSM():
             with m.State("Idle"):
-                with m.If(settings.with_refresh & wants_refresh):
+                with m.If(self.enable & wants_refresh):
                     m.next = "Wait-Bank-Machines"
 
             with m.State("Wait-Bank-Machines"):
@@ -363,46 +594,69 @@ class Refresher(Elaboratable):
                     m.d.comb += sequencer.start.eq(1)
                     m.next = "Do-Refresh"
 
+            # Refreshes owed beyond the allowed postponing are issued without releasing the
+            # Controller
             if settings.timing.tZQCS is None:
                 with m.State("Do-Refresh"):
-                    m.d.comb += self.cmd.valid.eq(~sequencer.done)
+                    m.d.comb += self.cmd.valid.eq(~sequencer.done | urgent)
                     with m.If(sequencer.done):
-                        m.d.comb += self.cmd.last.eq(1)
-                        m.next = "Idle"
+                        with m.If(urgent):
+                            m.next = "Wait-Bank-Machines"
+                        with m.Else():
+                            release()
             else:
                 with m.State("Do-Refresh"):
-                    m.d.comb += self.cmd.valid.eq(zqcs_timer.done & ~sequencer.done)
+                    m.d.comb += self.cmd.valid.eq(~sequencer.done | urgent)
                     with m.If(sequencer.done):
-                        with m.If(zqcs_timer.done):
+                        with m.If(urgent):
+                            m.next = "Wait-Bank-Machines"
+                        with m.Elif(wants_zqcs):
                             m.d.comb += zqcs_executer.start.eq(1)
                             m.next = "Do-Zqcs"
                         with m.Else():
-                            m.d.comb += self.cmd.last.eq(1)
-                            m.next = "Idle"
+                            release()
 
                 with m.State("Do-Zqcs"):
                     m.d.comb += self.cmd.valid.eq(~zqcs_executer.done)
                     with m.If(zqcs_executer.done):
-                        m.d.comb += self.cmd.last.eq(1)
-                        m.next = "Idle"
+                        release()
+
+            if self._track_interval:
+                with m.State("Do-Track"):
+                    m.d.comb += [
+                        self.cmd.valid.eq(1),
+                        self.track_req.eq(1),
+                    ]
+                    with m.If(self.track_done):
+                        m.d.sync += track_count.eq(0)
+                        finish()
 
         # Connect sequencer/executer outputs to cmd
-        if settings.timing.tZQCS is None:
-            m.d.comb += [
-                self.cmd.a.eq(sequencer.a),
-                self.cmd.ba.eq(sequencer.ba),
-                self.cmd.cas.eq(sequencer.cas),
-                self.cmd.ras.eq(sequencer.ras),
-                self.cmd.we.eq(sequencer.we),
-            ]
-        else:
-            m.d.comb += [
-                self.cmd.a.eq(zqcs_executer.a),
-                self.cmd.ba.eq(zqcs_executer.ba),
-                self.cmd.cas.eq(zqcs_executer.cas),
-                self.cmd.ras.eq(zqcs_executer.ras),
-                self.cmd.we.eq(zqcs_executer.we),
-            ]
+        executers = [sequencer]
+        if settings.timing.tZQCS is not None:
+            executers.append(zqcs_executer)
+
+        def merge(field):
+            value = 0
+            for executer in executers:
+                value = value | field(executer)
+            return value
 
+        a = Signal.like(self.cmd.a)
+        ba = Signal.like(self.cmd.ba)
+        cmd = Signal(3)
+        m.d.comb += [
+            a.eq(merge(lambda e: e.a)),
+            ba.eq(merge(lambda e: e.ba)),
+            cmd.eq(merge(lambda e: Cat(e.cas, e.ras, e.we))),
+        ]
+
+        m.d.comb += [
+            self.cmd.a.eq(a),
+            self.cmd.ba.eq(ba),
+            Cat(self.cmd.cas, self.cmd.ras, self.cmd.we).eq(cmd),
+        ]
+        if rankbits:
+            m.d.comb += self.cmd.ba[-rankbits:].eq(rank)
 
         return m
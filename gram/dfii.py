@@ -4,6 +4,8 @@
 # License: BSD
 
 from nmigen import *
+from nmigen.utils import bits_for
+from nmigen.lib.fifo import SyncFIFOBuffered
 
 from gram.phy import dfi
 from gram.compat import CSRPrefixProxy
@@ -54,12 +56,187 @@ class PhaseInjector(Elaboratable):
 
         return m
 
+# ReadCaptureFIFO ----------------------------------------------------------------------------------
+
+
+class ReadCaptureFIFO(Elaboratable):
+    """Captures consecutive read data beats of a DFI phase
+
+    Every `rddata_valid` beat is pushed into a FIFO (beats are dropped when it is full).
+    Reading the `rdfifo_data` CSR pops the oldest beat, `rdfifo_level` gives the number of
+    beats available.
+    """
+
+    def __init__(self, csr_bank, phase, depth=16):
+        self._data = csr_bank.csr(len(phase.rddata), "r", name="rdfifo_data")
+        self._level = csr_bank.csr(bits_for(depth), "r", name="rdfifo_level")
+
+        self._phase = phase
+        self._depth = depth
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.fifo = fifo = SyncFIFOBuffered(width=len(self._phase.rddata), depth=self._depth)
+        m.d.comb += [
+            fifo.w_data.eq(self._phase.rddata),
+            fifo.w_en.eq(self._phase.rddata_valid),
+            self._data.r_data.eq(fifo.r_data),
+            fifo.r_en.eq(self._data.r_stb),
+            self._level.r_data.eq(fifo.level),
+        ]
+
+        return m
+
+# CommandListPlayer --------------------------------------------------------------------------------
+
+
+class CommandListPlayer(Elaboratable):
+    """Plays a list of DFI commands stored in a small memory
+
+    Software fills the memory through `addr` (write pointer), `cmd` and
+    `address` (writing `address` stores the entry and increments the write
+    pointer), then writes the number of entries to play to `start` (0 and
+    values above the depth are ignored). `status` reads 1 while the list is
+    being played.
+
+    Entries are made of:
+    - cmd[5:0]: command, same encoding as PhaseInjector (cs, we, cas, ras, wrdata_en, rddata_en)
+    - cmd[7:6]: phase the command is issued on
+    - cmd[23:8]: number of cycles to wait before the next entry
+    - address: DRAM address, bank address above `addressbits`
+    """
+
+    def __init__(self, csr_bank, addressbits, bankbits, nranks, databits, nphases=1, depth=16):
+        if nphases > 4:
+            raise ValueError("Up to 4 phases are supported, not {}".format(nphases))
+        if addressbits + bankbits > 32:
+            raise ValueError("Address and bank address must fit in 32 bits")
+
+        self.dfi = dfi.Interface(addressbits, bankbits, nranks, databits, nphases)
+        self.busy = Signal()
+
+        self._addr = csr_bank.csr(bits_for(depth-1), "w")
+        self._cmd = csr_bank.csr(24, "w")
+        self._address = csr_bank.csr(addressbits + bankbits, "w")
+        self._start = csr_bank.csr(bits_for(depth), "w")
+        self._status = csr_bank.csr(1, "r")
+
+        self._addressbits = addressbits
+        self._bankbits = bankbits
+        self._depth = depth
+
+    def elaborate(self, platform):
+        m = Module()
+
+        mem = Memory(width=24 + self._addressbits + self._bankbits, depth=self._depth)
+        m.submodules.wrport = wrport = mem.write_port()
+        m.submodules.rdport = rdport = mem.read_port(domain="comb")
+
+        # Fill
+        wrptr = Signal(range(self._depth))
+        with m.If(self._addr.w_stb):
+            m.d.sync += wrptr.eq(self._addr.w_data)
+        with m.Elif(self._address.w_stb):
+            m.d.sync += wrptr.eq(wrptr + 1)
+        m.d.comb += [
+            wrport.addr.eq(wrptr),
+            wrport.data.eq(Cat(self._cmd.w_data, self._address.w_data)),
+            wrport.en.eq(self._address.w_stb),
+        ]
+
+        # Playback
+        command = rdport.data[0:6]
+        phase = rdport.data[6:8]
+        wait = rdport.data[8:24]
+        address = rdport.data[24:24+self._addressbits]
+        bank = rdport.data[24+self._addressbits:]
+
+        rdptr = Signal(range(self._depth))
+        length = Signal(range(self._depth+1))
+        count = Signal(16)
+        m.d.comb += [
+            rdport.addr.eq(rdptr),
+            self._status.r_data.eq(self.busy),
+        ]
+
+        for n, p in enumerate(self.dfi.phases):
+            m.d.comb += [
+                p.address.eq(address),
+                p.bank.eq(bank),
+            ]
+
+        with m.FSM():
+            with m.State("Idle"):
+                with m.If(self._start.w_stb & (self._start.w_data != 0) &
+                          (self._start.w_data <= self._depth)):
+                    m.d.sync += [
+                        rdptr.eq(0),
+                        length.eq(self._start.w_data),
+                    ]
+                    m.next = "Issue"
+
+            with m.State("Issue"):
+                m.d.comb += self.busy.eq(1)
+                for n, p in enumerate(self.dfi.phases):
+                    with m.If(phase == n):
+                        m.d.comb += [
+                            p.cs.eq(Repl(command[0], len(p.cs))),
+                            p.we.eq(command[1]),
+                            p.cas.eq(command[2]),
+                            p.ras.eq(command[3]),
+                            p.wrdata_en.eq(command[4]),
+                            p.rddata_en.eq(command[5]),
+                        ]
+                m.d.sync += [
+                    rdptr.eq(rdptr + 1),
+                    count.eq(wait),
+                ]
+                with m.If(rdptr == length - 1):
+                    m.next = "Drain"
+                with m.Elif(wait != 0):
+                    m.next = "Wait"
+
+            with m.State("Wait"):
+                m.d.comb += self.busy.eq(1)
+                m.d.sync += count.eq(count - 1)
+                with m.If(count == 1):
+                    m.next = "Issue"
+
+            # Honour the wait cycles of the last entry before releasing the DFI
+            with m.State("Drain"):
+                m.d.comb += self.busy.eq(1)
+                m.d.sync += count.eq(count - 1)
+                with m.If(count <= 1):
+                    m.next = "Idle"
+
+        return m
+
 # DFIInjector --------------------------------------------------------------------------------------
 
 
 class DFIInjector(Elaboratable):
-    def __init__(self, csr_bank, addressbits, bankbits, nranks, databits, nphases=1):
+    """DFI injector
+
+    Selects who drives the DFI master interface: the controller (slave interface) or the
+    software-controlled phase injectors, according to the control CSR.
+
+    When an InitSequencer is given (`init`), it drives the DFI interface after reset until the
+    initialization sequence is done, then control is handed to the controller. Once software
+    writes the control CSR, the control CSR takes over. The `init_done` CSR reports the end of
+    the sequence.
+
+    When `cmdlist_depth` is not 0, a CommandListPlayer with that many entries is added, it
+    replaces the phase injectors while it is playing (write data comes from the phase injectors,
+    read data is captured by them).
+
+    When `rdfifo_depth` is not 0, a ReadCaptureFIFO with that many entries is added to each
+    phase, so that a burst of reads can be issued before reading the data back.
+    """
+    def __init__(self, csr_bank, addressbits, bankbits, nranks, databits, nphases=1, init=None,
+                 cmdlist_depth=0, rdfifo_depth=0):
         self._nranks = nranks
+        self._init = init
 
         self._inti = dfi.Interface(addressbits, bankbits, nranks, databits, nphases)
         self.slave = dfi.Interface(addressbits, bankbits, nranks, databits, nphases)
@@ -72,15 +249,73 @@ class DFIInjector(Elaboratable):
             self._phases += [PhaseInjector(CSRPrefixProxy(csr_bank,
                                                           "p{}".format(n)), phase)]
 
+        if init is not None:
+            self._init_done = csr_bank.csr(1, "r")
+
+        self._player = None
+        if cmdlist_depth:
+            self._player = CommandListPlayer(CSRPrefixProxy(csr_bank, "cmdlist"),
+                addressbits, bankbits, nranks, databits, nphases, depth=cmdlist_depth)
+
+        self._rdfifos = []
+        if rdfifo_depth:
+            for n, phase in enumerate(self._inti.phases):
+                self._rdfifos += [ReadCaptureFIFO(CSRPrefixProxy(csr_bank, "p{}".format(n)), phase,
+                                                  depth=rdfifo_depth)]
+
     def elaborate(self, platform):
         m = Module()
 
         m.submodules += self._phases
+        m.submodules += self._rdfifos
 
-        with m.If(self._control.w_data[0]):
-            m.d.comb += self.slave.connect(self.master)
-        with m.Else():
-            m.d.comb += self._inti.connect(self.master)
+        # Software interface: phase injectors, or the command list player while it is playing
+        inti = self._inti
+        if self._player is not None:
+            m.submodules.player = self._player
+            inti = dfi.Interface(len(self.master.phases[0].address), len(self.master.phases[0].bank),
+                self._nranks, len(self.master.phases[0].wrdata), len(self.master.phases))
+            with m.If(self._player.busy):
+                m.d.comb += self._player.dfi.connect(inti)
+                for src, dst in zip(self._inti.phases, self._player.dfi.phases):
+                    m.d.comb += [
+                        dst.wrdata.eq(src.wrdata),
+                        dst.wrdata_mask.eq(src.wrdata_mask),
+                        dst.clk_en.eq(src.clk_en),
+                        dst.odt.eq(src.odt),
+                        dst.reset.eq(src.reset),
+                    ]
+                for src, dst in zip(inti.phases, self._inti.phases):
+                    m.d.comb += [
+                        dst.rddata.eq(src.rddata),
+                        dst.rddata_valid.eq(src.rddata_valid),
+                    ]
+            with m.Else():
+                m.d.comb += self._inti.connect(inti)
+
+        if self._init is not None:
+            m.submodules.init = self._init
+            m.d.comb += self._init_done.r_data.eq(self._init.done)
+
+            # Software takes over as soon as it writes the control CSR
+            sw_override = Signal()
+            with m.If(self._control.w_stb):
+                m.d.sync += sw_override.eq(1)
+
+            with m.If(sw_override):
+                with m.If(self._control.w_data[0]):
+                    m.d.comb += self.slave.connect(self.master)
+                with m.Else():
+                    m.d.comb += inti.connect(self.master)
+            with m.Elif(self._init.done):
+                m.d.comb += self.slave.connect(self.master)
+            with m.Else():
+                m.d.comb += self._init.dfi.connect(self.master)
+        else:
+            with m.If(self._control.w_data[0]):
+                m.d.comb += self.slave.connect(self.master)
+            with m.Else():
+                m.d.comb += inti.connect(self.master)
 
         for i in range(self._nranks):
             m.d.comb += [phase.clk_en[i].eq(self._control.w_data[1])
@@ -0,0 +1,208 @@
+# This file is Copyright (c) 2020 LambdaConcept <contact@lambdaconcept.com>
+# License: BSD
+
+"""DDR3 initialization."""
+
+import math
+
+from nmigen import *
+
+from gram.phy import dfi
+from gram.compat import Timeline
+
+__ALL__ = ["get_ddr3_mode_registers", "InitSequencer"]
+
+# Mode registers -----------------------------------------------------------------------------------
+
+
+def _ddr3_mr0(cl, wr, dll_reset=True):
+    # CL 5-11 are encoded on A6:4 as cl-4, CL 12-16 as cl-12 with A2 set
+    cl_to_mr0 = {cl: ((cl-4) << 4) for cl in range(5, 12)}
+    cl_to_mr0.update({cl: ((cl-12) << 4) | (1 << 2) for cl in range(12, 17)})
+    wr_to_mr0 = {
+        5:  1,
+        6:  2,
+        7:  3,
+        8:  4,
+        10: 5,
+        12: 6,
+        14: 7,
+        16: 0,
+    }
+    if cl not in cl_to_mr0:
+        raise ValueError("Unsupported CAS latency: {}".format(cl))
+    # Round write recovery up to the next supported value
+    wr = min([_wr for _wr in wr_to_mr0 if _wr >= max(wr, 5)], default=None)
+    if wr is None:
+        raise ValueError("Write recovery is too long for DDR3")
+
+    mr0 = cl_to_mr0[cl]
+    mr0 |= wr_to_mr0[wr] << 9
+    mr0 |= dll_reset << 8
+    return mr0
+
+
+def _ddr3_mr1(ron, rtt_nom):
+    ron_to_mr1 = {
+        40: 0,
+        34: (1 << 1),
+    }
+    rtt_nom_to_mr1 = {
+        None: 0,
+        60:   (1 << 2),
+        120:  (1 << 6),
+        40:   (1 << 6) | (1 << 2),
+        20:   (1 << 9),
+        30:   (1 << 9) | (1 << 2),
+    }
+    return ron_to_mr1[ron] | rtt_nom_to_mr1[rtt_nom]
+
+
+def _ddr3_mr2(cwl, rtt_wr):
+    rtt_wr_to_mr2 = {
+        None: 0,
+        60:   (1 << 9),
+        120:  (1 << 10),
+    }
+    if not (5 <= cwl <= 12):
+        raise ValueError("Unsupported CAS write latency: {}".format(cwl))
+    return ((cwl-5) << 3) | rtt_wr_to_mr2[rtt_wr]
+
+
+def get_ddr3_mode_registers(phy_settings, timing_settings, ron=34, rtt_nom=60, rtt_wr=60):
+    """Compute DDR3 mode registers
+
+    Parameters
+    ----------
+    phy_settings : PhySettings
+        PHY settings (CL/CWL)
+    timing_settings : TimingSettings
+        Module timings in system clock cycles (tWR)
+    ron : int
+        Output driver impedance (34 or 40 ohms)
+    rtt_nom : int or None
+        Nominal termination (None to disable)
+    rtt_wr : int or None
+        Dynamic termination during writes (None to disable)
+
+    Returns
+    -------
+    [MR0, MR1, MR2, MR3]
+    """
+    if phy_settings.memtype != "DDR3":
+        raise NotImplementedError("Only DDR3 is supported, not {}".format(phy_settings.memtype))
+
+    wr = timing_settings.tWR*phy_settings.nphases
+    return [
+        _ddr3_mr0(phy_settings.cl, wr),
+        _ddr3_mr1(ron, rtt_nom),
+        _ddr3_mr2(phy_settings.cwl, rtt_wr),
+        0,
+    ]
+
+# InitSequencer ------------------------------------------------------------------------------------
+
+
+class InitSequencer(Elaboratable):
+    """DDR3 initialization sequencer
+
+    Drives the JEDEC power-up and initialization sequence on its DFI interface
+    after reset:
+    - Hold RESET# for 200us, then CKE low for 500us
+    - Bring CKE high, wait tXPR
+    - Load MR2, MR3, MR1, MR0 (tMRD apart), wait tMOD
+    - Send ZQCL, wait tZQinit
+    - Assert `done`
+
+    Parameters
+    ----------
+    clk_freq : float
+        System clock frequency
+    mode_registers : [int, int, int, int]
+        Values of MR0 to MR3
+    trfc : int
+        tRFC in system clock cycles
+
+    Attributes
+    ----------
+    dfi : dfi.Interface
+        DFI interface driven by the sequencer
+    done : Signal(), out
+        Initialization sequence completed
+    """
+
+    def __init__(self, addressbits, bankbits, nranks, databits, nphases, clk_freq, mode_registers, trfc):
+        if len(mode_registers) != 4:
+            raise ValueError("Expected 4 mode registers, not {}".format(len(mode_registers)))
+
+        self.dfi = dfi.Interface(addressbits, bankbits, nranks, databits, nphases)
+        self.done = Signal()
+
+        self._nphases = nphases
+        self._clk_freq = clk_freq
+        self._mode_registers = mode_registers
+        self._trfc = trfc
+
+    def elaborate(self, platform):
+        m = Module()
+
+        nphases = self._nphases
+
+        def cycles(t):
+            return math.ceil(t*self._clk_freq)
+
+        def ck(n):
+            return math.ceil(n/nphases)
+
+        treset = cycles(200e-6)
+        tcke = cycles(500e-6)
+        txpr = max(ck(5), self._trfc + cycles(10e-9))
+        tmrd = ck(4)
+        tmod = max(ck(12), cycles(15e-9))
+        tzqinit = max(ck(512), cycles(640e-9))
+
+        phase = self.dfi.phases[0]
+
+        def command(a, ba, cas, ras, we):
+            return [
+                phase.address.eq(a),
+                phase.bank.eq(ba),
+                phase.cs.eq(Repl(1, len(phase.cs))),
+                phase.cas.eq(cas),
+                phase.ras.eq(ras),
+                phase.we.eq(we),
+            ]
+
+        nop = [
+            phase.cs.eq(0),
+            phase.cas.eq(0),
+            phase.ras.eq(0),
+            phase.we.eq(0),
+        ]
+
+        def clk_en(value):
+            return [p.clk_en.eq(Repl(value, len(p.clk_en))) for p in self.dfi.phases]
+
+        def reset(value):
+            return [p.reset.eq(value) for p in self.dfi.phases]
+
+        events = []
+        t = treset
+        events.append((t, reset(0)))
+        t += tcke
+        events.append((t, clk_en(1)))
+        t += txpr
+        for i, mr in enumerate([2, 3, 1, 0]):
+            events.append((t, command(self._mode_registers[mr], mr, cas=1, ras=1, we=1)))
+            events.append((t+1, nop))
+            t += tmod if mr == 0 else tmrd
+        # ZQ Calibration Long
+        events.append((t, command(2**10, 0, cas=0, ras=0, we=1)))
+        events.append((t+1, nop))
+        t += tzqinit
+        events.append((t, [self.done.eq(1)]))
+
+        m.submodules.timeline = tl = Timeline(events)
+        m.d.comb += tl.trigger.eq(~self.done)
+
+        return m
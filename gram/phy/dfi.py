@@ -4,7 +4,7 @@
 from nmigen import *
 from nmigen.hdl.rec import *
 
-__ALL__ = ["Interface"]
+__ALL__ = ["Interface", "Pipeline", "ReadLatencyMeter"]
 
 
 def phase_description(addressbits, bankbits, nranks, databits):
@@ -50,3 +50,104 @@ class Interface:
             ret += [self.phases[i].connect(target.phases[i])]
 
         return ret
+
+
+class Pipeline(Elaboratable):
+    """Registered DFI stages
+
+    Adds `stages` register stages between a DFI master (connected to `sink`) and
+    a DFI slave (connected to `source`): commands and write data are delayed by
+    `stages` cycles, read data by `stages` cycles too. Read latency seen by the
+    master is therefore increased by 2*stages, write latency is unchanged.
+
+    Parameters
+    ----------
+    stages : int
+        Number of register stages (0 connects sink and source directly)
+    """
+
+    def __init__(self, addressbits, bankbits, nranks, databits, nphases=1, stages=1):
+        if stages < 0:
+            raise ValueError("Stages must be a non-negative integer, not {!r}".format(stages))
+
+        self.sink = Interface(addressbits, bankbits, nranks, databits, nphases)
+        self.source = Interface(addressbits, bankbits, nranks, databits, nphases)
+        self._stages = stages
+
+    def elaborate(self, platform):
+        m = Module()
+
+        for sink, source in zip(self.sink.phases, self.source.phases):
+            fanout = sink
+            fanin = source
+            for i in range(self._stages):
+                fanout_r = Record.like(sink)
+                fanin_r = Record.like(source)
+                for name, _, direction in sink.layout:
+                    if direction == DIR_FANOUT:
+                        m.d.sync += getattr(fanout_r, name).eq(getattr(fanout, name))
+                    else:
+                        m.d.sync += getattr(fanin_r, name).eq(getattr(fanin, name))
+                fanout = fanout_r
+                fanin = fanin_r
+
+            for name, _, direction in sink.layout:
+                if direction == DIR_FANOUT:
+                    m.d.comb += getattr(source, name).eq(getattr(fanout, name))
+                else:
+                    m.d.comb += getattr(sink, name).eq(getattr(fanin, name))
+
+        return m
+
+
+class ReadLatencyMeter(Elaboratable):
+    """Read latency measurement
+
+    Monitors a DFI interface and measures the number of cycles between a read
+    (`rddata_en` on any phase) and the read data being returned (`rddata_valid`
+    on any phase). Reads issued while a measurement is in progress are ignored,
+    and a measurement is abandoned after `max_latency` cycles.
+
+    Parameters
+    ----------
+    dfi : Interface
+        Monitored DFI interface
+    max_latency : int
+        Maximal measurable latency
+
+    Attributes
+    ----------
+    latency : Signal(range(max_latency + 1)), out
+        Last measured latency (0 if nothing was measured yet)
+    """
+
+    def __init__(self, dfi, max_latency):
+        if max_latency < 1:
+            raise ValueError("Max latency must be a positive integer, not {!r}".format(max_latency))
+
+        self.dfi = dfi
+        self.latency = Signal(range(max_latency + 1))
+        self._max_latency = max_latency
+
+    def elaborate(self, platform):
+        m = Module()
+
+        rddata_en = Cat(*[phase.rddata_en for phase in self.dfi.phases]).any()
+        rddata_valid = Cat(*[phase.rddata_valid for phase in self.dfi.phases]).any()
+        counter = Signal(range(self._max_latency + 1))
+
+        with m.FSM():
+            with m.State("Idle"):
+                with m.If(rddata_en):
+                    m.d.sync += counter.eq(1)
+                    m.next = "Measure"
+
+            with m.State("Measure"):
+                m.d.sync += counter.eq(counter + 1)
+                with m.If(rddata_valid):
+                    m.d.sync += self.latency.eq(counter)
+                    m.next = "Idle"
+                with m.Elif(counter == self._max_latency):
+                    m.next = "Idle"
+
+        return m
@@ -0,0 +1,606 @@
+# This file is Copyright (c) 2020 LambdaConcept <contact@lambdaconcept.com>
+# License: BSD
+
+"""DFI command traces (text and binary), replay and offline timing checks."""
+
+from collections import namedtuple, deque
+
+from nmigen import *
+from nmigen.sim import Passive, Settle
+
+from gram.phy.fakephy import _DFITimingsBase
+
+__ALL__ = ["DFICommand", "DFIMonitor", "write_trace", "read_trace", "DFIRecord", "DFITraceWriter",
+           "write_binary_trace", "read_binary_trace", "record_commands", "DFITraceRecorder",
+           "DFITraceReplayer", "TimingViolation", "RuleSlack", "DFITraceChecker"]
+
+# Commands -----------------------------------------------------------------------------------------
+
+DFICommand = namedtuple("DFICommand", ["cycle", "phase", "name", "bank", "address"])
+DFICommand.__doc__ = """DFI command
+
+cycle : int
+    System clock cycle the command was issued on
+phase : int
+    DFI phase of the command
+name : str
+    Command name (ACT, PRE, REF, RD, WR, ZQCS or MRS)
+bank : int
+    Bank address
+address : int
+    Address
+"""
+
+# cs & ras & cas & we, deselect and NOP are not recorded
+_cmd_names = {
+    0b1100: "ACT",
+    0b1101: "PRE",
+    0b1110: "REF",
+    0b1010: "RD",
+    0b1011: "WR",
+    0b1001: "ZQCS",
+    0b1111: "MRS",
+}
+
+# Monitor ------------------------------------------------------------------------------------------
+
+
+class DFIMonitor:
+    """DFI command monitor
+
+    Simulator process decoding the commands sent on a DFI interface, for instance the one of a
+    `FakePHY` or of the controller. Each command is passed as a `DFICommand` to every sink:
+
+        monitor = DFIMonitor(phy.dfi, sinks=[checker.command])
+        sim.add_sync_process(monitor.process)
+
+    Parameters
+    ----------
+    dfi : dfi.Interface
+        Interface to monitor
+    sinks : [callable]
+        Called with each command, defaults to appending to `commands`
+
+    Attributes
+    ----------
+    commands : [DFICommand]
+        Recorded commands (when no sinks are given)
+    """
+    def __init__(self, dfi, sinks=None):
+        self.dfi = dfi
+        self.commands = []
+        self.sinks = [self.commands.append] if sinks is None else sinks
+
+    def process(self):
+        yield Passive()
+
+        phases = self.dfi.phases
+        cmds = Cat(*[Cat(p.we, p.cas, p.ras, p.cs[0]) for p in phases])
+        cycle = 0
+
+        while True:
+            yield Settle()
+
+            state = (yield cmds)
+            if state:
+                for np, phase in enumerate(phases):
+                    name = _cmd_names.get((state >> 4*np) & 0b1111)
+                    if name is None:
+                        continue
+                    cmd = DFICommand(cycle, np, name, (yield phase.bank), (yield phase.address))
+                    for sink in self.sinks:
+                        sink(cmd)
+
+            cycle += 1
+            yield
+
+# Trace files --------------------------------------------------------------------------------------
+
+
+def write_trace(commands, f):
+    """Write commands to a text file, one "cycle phase name bank address" line per command"""
+    for cmd in commands:
+        f.write("{} {} {} {} {:#x}\n".format(cmd.cycle, cmd.phase, cmd.name, cmd.bank, cmd.address))
+
+
+def read_trace(f):
+    """Read commands written by `write_trace`"""
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        cycle, phase, name, bank, address = line.split()
+        yield DFICommand(int(cycle), int(phase), name, int(bank), int(address, 0))
+
+# Binary traces ------------------------------------------------------------------------------------
+
+DFIRecord = namedtuple("DFIRecord", ["cycle", "phase", "cs", "ras", "cas", "we", "rddata_en", "wrdata_en",
+                                     "bank", "address"])
+DFIRecord.__doc__ = """State of a DFI phase in a binary trace
+
+Only phases with a command (other than NOP) or a read/write data enable are recorded. `cs` is the
+chip select mask, `bank` and `address` are 0 when there is no command.
+"""
+
+# Header: magic, version, nphases, nranks
+_TRACE_MAGIC = b"DFIT"
+_TRACE_VERSION = 1
+# Cycle delta and address of up to 64 bits, flags, chip select mask and bank
+_MAX_RECORD_SIZE = 2*10 + 3
+
+
+def _write_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+class DFITraceWriter:
+    """Compact binary DFI trace writer
+
+    Each record takes a cycle delta (LEB128), a flags byte (cs, ras, cas, we, rddata_en,
+    wrdata_en, phase), the chip select mask on multi-rank traces and, for commands, the bank and
+    the address (LEB128): typically 2 to 5 bytes.
+    """
+    def __init__(self, f, nphases, nranks=1):
+        if not (1 <= nphases <= 4):
+            raise ValueError("Binary traces support 1 to 4 phases, not {}".format(nphases))
+        if not (1 <= nranks <= 8):
+            raise ValueError("Binary traces support 1 to 8 ranks, not {}".format(nranks))
+        self._f = f
+        self._nranks = nranks
+        self._cycle = 0
+        f.write(_TRACE_MAGIC + bytes([_TRACE_VERSION, nphases, nranks]))
+
+    def write(self, record):
+        if record.cycle < self._cycle:
+            raise ValueError("Records must be written in cycle order")
+        buf = bytearray()
+        _write_varint(buf, record.cycle - self._cycle)
+        self._cycle = record.cycle
+
+        cmd = record.cs != 0
+        buf.append(cmd | (record.ras << 1) | (record.cas << 2) | (record.we << 3) |
+                   (record.rddata_en << 4) | (record.wrdata_en << 5) | (record.phase << 6))
+        if cmd:
+            if self._nranks > 1:
+                buf.append(record.cs)
+            buf.append(record.bank)
+            _write_varint(buf, record.address)
+        self._f.write(buf)
+
+
+def write_binary_trace(records, f, nphases, nranks=1):
+    """Write `DFIRecord`s to a binary trace file"""
+    writer = DFITraceWriter(f, nphases, nranks)
+    for record in records:
+        writer.write(record)
+
+
+def read_binary_trace(f, chunk_size=65536):
+    """Read `DFIRecord`s from a binary trace (file object or bytes-like)
+
+    File objects are read lazily, `chunk_size` bytes at a time.
+    """
+    if isinstance(f, (bytes, bytearray, memoryview)):
+        chunks = iter([bytes(f)])
+    else:
+        chunks = iter(lambda: f.read(chunk_size), b"")
+
+    # Unparsed bytes, refilled so that at least one full record is buffered
+    data = b""
+    i = 0
+    for chunk in chunks:
+        data += chunk
+        if len(data) >= 7:
+            break
+    if data[:4] != _TRACE_MAGIC:
+        raise ValueError("Not a DFI trace")
+    if len(data) < 7:
+        raise ValueError("Truncated DFI trace")
+    if data[4] != _TRACE_VERSION:
+        raise ValueError("Unsupported DFI trace version {}".format(data[4]))
+    nranks = data[6]
+
+    def varint(i):
+        value = shift = 0
+        while True:
+            byte = data[i]
+            i += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value, i
+            shift += 7
+
+    i = 7
+    cycle = 0
+    while True:
+        if len(data) - i < _MAX_RECORD_SIZE:
+            data = data[i:]
+            i = 0
+            for chunk in chunks:
+                data += chunk
+                if len(data) >= _MAX_RECORD_SIZE:
+                    break
+            if not data:
+                return
+
+        try:
+            delta, i = varint(i)
+            cycle += delta
+            flags = data[i]
+            i += 1
+            cs = bank = address = 0
+            if flags & 1:
+                cs = 1
+                if nranks > 1:
+                    cs = data[i]
+                    i += 1
+                bank = data[i]
+                address, i = varint(i + 1)
+        except IndexError:
+            raise ValueError("Truncated DFI trace") from None
+        yield DFIRecord(cycle, flags >> 6, cs, (flags >> 1) & 1, (flags >> 2) & 1, (flags >> 3) & 1,
+                        (flags >> 4) & 1, (flags >> 5) & 1, bank, address)
+
+
+def record_commands(records, rank=0):
+    """Convert `DFIRecord`s to the `DFICommand`s sent to `rank`, e.g. for `DFITraceChecker`"""
+    for r in records:
+        if (r.cs >> rank) & 1:
+            name = _cmd_names.get(0b1000 | (r.ras << 2) | (r.cas << 1) | r.we)
+            if name is not None:
+                yield DFICommand(r.cycle, r.phase, name, r.bank, r.address)
+
+
+class DFITraceRecorder:
+    """DFI binary trace recorder
+
+    Simulator process recording the commands and read/write data enables of a DFI interface
+    into a binary trace (see `DFITraceWriter`):
+
+        with open("workload.dfit", "wb") as f:
+            recorder = DFITraceRecorder(dfi, f)
+            sim.add_sync_process(recorder.process)
+            sim.run_until(...)
+    """
+    def __init__(self, dfi, f):
+        self.dfi = dfi
+        self._writer = DFITraceWriter(f, len(dfi.phases), len(dfi.phases[0].cs))
+
+    def process(self):
+        yield Passive()
+
+        phases = self.dfi.phases
+        state = Cat(*[Cat(p.cs.any(), p.ras, p.cas, p.we, p.rddata_en, p.wrdata_en) for p in phases])
+        cycle = 0
+
+        while True:
+            yield Settle()
+
+            s = (yield state)
+            if s:
+                for np, phase in enumerate(phases):
+                    flags = (s >> 6*np) & 0b111111
+                    # Deselect and NOP
+                    if flags in (0b000000, 0b000001):
+                        continue
+                    cs = bank = address = 0
+                    if flags & 1:
+                        cs = (yield phase.cs)
+                        bank = (yield phase.bank)
+                        address = (yield phase.address)
+                    self._writer.write(DFIRecord(cycle, np, cs, (flags >> 1) & 1, (flags >> 2) & 1,
+                        (flags >> 3) & 1, (flags >> 4) & 1, (flags >> 5) & 1, bank, address))
+
+            cycle += 1
+            yield
+
+
+class DFITraceReplayer:
+    """DFI binary trace replayer
+
+    Simulator process driving the commands and read/write data enables of a DFI interface (of a
+    `FakePHY` or a PHY) from `DFIRecord`s, for instance `read_binary_trace(f)`. Records are
+    consumed lazily, the first record is replayed on the first cycle and the process ends with
+    the trace. clk_en, odt and reset are left to the testbench.
+
+    Parameters
+    ----------
+    dfi : dfi.Interface
+        Interface to drive
+    records : iterable of DFIRecord
+        Trace to replay
+    wrdata : callable
+        Called with the records that have `wrdata_en` set, returns the write data of the phase
+        (the write data is left unchanged when not given)
+    """
+    def __init__(self, dfi, records, wrdata=None):
+        self.dfi = dfi
+        self.records = records
+        self.wrdata = wrdata
+
+    def process(self):
+        phases = self.dfi.phases
+        records = iter(self.records)
+        record = next(records, None)
+        if record is None:
+            return
+        cycle = record.cycle
+        driven = []
+
+        while record is not None:
+            for phase in driven:
+                yield phase.cs.eq(0)
+                yield phase.ras.eq(0)
+                yield phase.cas.eq(0)
+                yield phase.we.eq(0)
+                yield phase.rddata_en.eq(0)
+                yield phase.wrdata_en.eq(0)
+            driven = []
+
+            while record is not None and record.cycle == cycle:
+                phase = phases[record.phase]
+                yield phase.cs.eq(record.cs)
+                yield phase.ras.eq(record.ras)
+                yield phase.cas.eq(record.cas)
+                yield phase.we.eq(record.we)
+                yield phase.bank.eq(record.bank)
+                yield phase.address.eq(record.address)
+                yield phase.rddata_en.eq(record.rddata_en)
+                yield phase.wrdata_en.eq(record.wrdata_en)
+                if record.wrdata_en and self.wrdata is not None:
+                    yield phase.wrdata.eq(self.wrdata(record))
+                driven.append(phase)
+                record = next(records, None)
+
+            yield
+            cycle += 1
+            if record is not None and not driven:
+                # Idle cycles
+                for i in range(record.cycle - cycle):
+                    yield
+                cycle = record.cycle
+
+        for phase in driven:
+            yield phase.cs.eq(0)
+            yield phase.ras.eq(0)
+            yield phase.cas.eq(0)
+            yield phase.we.eq(0)
+            yield phase.rddata_en.eq(0)
+            yield phase.wrdata_en.eq(0)
+        yield
+
+# Timing checker -----------------------------------------------------------------------------------
+
+TimingViolation = namedtuple("TimingViolation", ["ps", "bank", "rule", "required", "actual"])
+TimingViolation.__doc__ = """Timing violation
+
+ps : int
+    Time of the offending command
+bank : int or None
+    Bank, None for rules that apply to the whole device (tRRD, tFAW, tREFI) or between two
+    all-bank commands
+rule : str
+    Rule name, e.g. "ACT->RD (tRCD)"
+required : int
+    Required delay in ps (maximum delay for tREFI)
+actual : int
+    Actual delay in ps
+"""
+
+RuleSlack = namedtuple("RuleSlack", ["rule", "timing", "required", "worst", "slack", "count", "histogram"])
+RuleSlack.__doc__ = """Observed spacings for a timing rule
+
+rule : str
+    Rule name, e.g. "ACT->RD (tRCD)"
+timing : str or None
+    Timing the rule comes from, e.g. "tRCD"
+required : int
+    Required delay in ps (maximum delay for tREFI)
+worst : int
+    Closest observed delay to the requirement in ps (smallest, largest for tREFI)
+slack : int
+    Margin of the worst delay in ps, negative for violations
+count : int
+    Number of observations
+histogram : {int: int}
+    Number of observations by slack in DRAM clock cycles, slacks of `SLACK_HISTOGRAM_MAX` cycles
+    and more are counted together
+"""
+
+
+class DFITraceChecker(_DFITimingsBase):
+    """Offline DFI timing checker
+
+    Checks a DFI command stream against the same rules as `DFITimingsChecker`, plus tRRD, tFAW
+    and the maximum delay between refreshes (tREFI times the number of refreshes that can be
+    postponed), without elaborating any logic. Commands can be fed live from a `DFIMonitor` or
+    from a trace file:
+
+        checker = DFITraceChecker(nphases, phy.get_timings(), refresh_mode, "DDR3")
+        checker.check(read_trace(f))
+        print(checker.report())
+
+    Unlike `DFITimingsChecker`, a rule is checked against the last command of its kind on the
+    bank even if other commands were issued in between (e.g. ACT, WR, PRE checks tRAS). Rank rules
+    (RD->WR tRTW) are checked against the last command of its kind on any bank.
+
+    Every checked spacing is also recorded, `slack` and `slack_report` then give for each rule
+    how close the traffic came to the limit. Rules with a large minimum slack point at timings
+    the controller enforces too conservatively.
+
+    Attributes
+    ----------
+    violations : [TimingViolation]
+        Violations found so far
+    """
+
+    ALL_BANKS = {"REF", "ZQCS"}
+
+    # Maximum delay between refreshes, in tREFI
+    REF_LIMIT = {"1x": 9, "2x": 17, "4x": 36}
+
+    SLACK_HISTOGRAM_MAX = 16
+
+    def __init__(self, nphases, timings, refresh_mode, memtype):
+        self.prepare_timings(timings, refresh_mode, memtype)
+        self.add_cmds()
+        self.add_rules()
+        self.nphases = nphases
+        self.memtype = memtype
+        self.refresh_mode = "1x" if refresh_mode is None else refresh_mode
+
+        self.violations = []
+
+        self._rules_by_curr = {}
+        for rule in self.rules:
+            label = "{} ({})".format(rule.name, rule.timing or rule.delay)
+            self._rules_by_curr.setdefault(rule.curr, []).append((rule, label))
+        self._rank_rules_by_curr = {}
+        for rule in self.rank_rules:
+            label = "{} ({})".format(rule.name, rule.timing or rule.delay)
+            self._rank_rules_by_curr.setdefault(rule.curr, []).append((rule, label))
+        self._slack = {}  # label -> [timing, required, worst, count, histogram]
+        self._tck = self.timings["tCK"]
+        self._banks = set()
+        self._last = {}      # (bank, command) -> ps
+        self._last_all = {}  # all banks command -> ps
+        self._last_rank = {} # command on any bank -> ps
+        self._acts = deque(maxlen=4)
+        self._last_act = None
+        self._last_ref = None
+        self._ps = 0
+
+    def _check(self, ps, bank, rule, timing, required, actual, maximum=False):
+        slack = required - actual if maximum else actual - required
+        if slack < 0:
+            self.violations.append(TimingViolation(ps, bank, rule, required, actual))
+
+        stats = self._slack.get(rule)
+        if stats is None:
+            stats = self._slack[rule] = [timing, required, actual, 0, {}]
+        elif (actual > stats[2]) if maximum else (actual < stats[2]):
+            stats[2] = actual
+        stats[3] += 1
+        bucket = min(slack//self._tck, self.SLACK_HISTOGRAM_MAX)
+        stats[4][bucket] = stats[4].get(bucket, 0) + 1
+
+    def _last_cmd(self, bank, name):
+        last = self._last.get((bank, name))
+        last_all = self._last_all.get(name)
+        if last is None or (last_all is not None and last_all > last):
+            return last_all
+        return last
+
+    def command(self, cmd):
+        """Check a `DFICommand`, commands must be given in issue order"""
+        ps = (cmd.cycle*self.nphases + cmd.phase)*self._tck
+        self._ps = ps
+        name = cmd.name
+
+        # Bank rules
+        if name in self.cmds:
+            all_banks = name in self.ALL_BANKS or (name == "PRE" and (cmd.address >> 10) & 1)
+            if all_banks:
+                # Check each bank's own commands, then all-bank commands once
+                banks = sorted(self._banks) + [None]
+            else:
+                banks = [cmd.bank]
+
+            for bank in banks:
+                for rule, label in self._rules_by_curr.get(name, []):
+                    if not all_banks:
+                        last = self._last_cmd(bank, rule.prev)
+                    elif bank is None:
+                        last = self._last_all.get(rule.prev)
+                    else:
+                        last = self._last.get((bank, rule.prev))
+                    if last is not None:
+                        self._check(ps, bank, label, rule.timing, rule.delay, ps - last)
+
+            if all_banks:
+                self._last_all[name] = ps
+            else:
+                self._banks.add(cmd.bank)
+                self._last[(cmd.bank, name)] = ps
+
+            # Rank rules
+            for rule, label in self._rank_rules_by_curr.get(name, []):
+                last = self._last_rank.get(rule.prev)
+                if last is not None:
+                    self._check(ps, None, label, rule.timing, rule.delay, ps - last)
+            self._last_rank[name] = ps
+
+        # tRRD & tFAW
+        if name == "ACT":
+            if self._last_act is not None:
+                self._check(ps, None, "ACT->ACT (tRRD)", "tRRD", self.timings["tRRD"], ps - self._last_act)
+            if len(self._acts) == 4:
+                self._check(ps, None, "tFAW", "tFAW", self.timings["tFAW"], ps - self._acts[0])
+            self._acts.append(ps)
+            self._last_act = ps
+
+        # tREFI
+        if name == "REF":
+            self._check_refresh(ps)
+            self._last_ref = ps
+
+    def _check_refresh(self, ps):
+        if self.memtype == "SDR" or self._last_ref is None:
+            return
+        limit = self.REF_LIMIT[self.refresh_mode]*self.timings["tREFI"]
+        self._check(ps, None, "tREFI", "tREFI", limit, ps - self._last_ref, maximum=True)
+
+    def check(self, commands):
+        """Check a sequence of `DFICommand`s, returns the violations"""
+        for cmd in commands:
+            self.command(cmd)
+        return self.violations
+
+    def finish(self, cycle=None):
+        """Check the delay since the last refresh at the end of the trace (last command by default)"""
+        ps = self._ps if cycle is None else cycle*self.nphases*self._tck
+        self._check_refresh(ps)
+        return self.violations
+
+    def report(self):
+        """Human readable list of violations"""
+        lines = []
+        for v in self.violations:
+            if v.rule == "tREFI":
+                lines.append("[{:016d}ps] tREFI violation: {}ps since last refresh > {}ps".format(
+                    v.ps, v.actual, v.required))
+            else:
+                where = "" if v.bank is None else " on bank {}".format(v.bank)
+                lines.append("[{:016d}ps] {} violation{}: {}ps < {}ps".format(
+                    v.ps, v.rule, where, v.actual, v.required))
+        return "\n".join(lines)
+
+    def slack(self):
+        """Observed spacings of each rule, as `RuleSlack`s"""
+        return [RuleSlack(rule, timing, required, worst, required - worst if rule == "tREFI" else worst - required,
+                          count, dict(sorted(histogram.items())))
+                for rule, (timing, required, worst, count, histogram) in self._slack.items()]
+
+    def slack_report(self, timing_settings=None):
+        """Human readable slack table
+
+        Parameters
+        ----------
+        timing_settings : TimingSettings
+            Controller timings (in system clock cycles), listed next to the rules they enforce
+        """
+        tck = self._tck
+        lines = ["{:<22} {:>12} {:>12} {:>8} {:>8} {:>8}  {}".format(
+            "Rule", "Required", "Worst", "Slack", "Count", "Setting", "Slack histogram (tCK: count)")]
+        for rs in sorted(self.slack(), key=lambda rs: rs.slack):
+            setting = getattr(timing_settings, rs.timing, None) if rs.timing is not None else None
+            histogram = " ".join("{}{}:{}".format(">=" if bucket == self.SLACK_HISTOGRAM_MAX else "",
+                                                  bucket, count)
+                                 for bucket, count in rs.histogram.items())
+            lines.append("{:<22} {:>10}ps {:>10}ps {:>5}tCK {:>8} {:>8}  {}".format(
+                rs.rule, rs.required, rs.worst, rs.slack//tck, rs.count,
+                "-" if setting is None else setting, histogram))
+        return "\n".join(lines)
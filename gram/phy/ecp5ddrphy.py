@@ -114,6 +114,326 @@ class _DQSBUFMSettingManager(Elaboratable):
         return m
 
 
+class _ReadDelayCalibration(Elaboratable):
+    """Read delay calibration engine.
+
+    Sweeps every read delay value on all DQS groups at once and records, for
+    each group, which values led to a burst detection. For each value, the
+    engine issues its own reads to row 0 of bank 0 and samples the DQSBUFM
+    burst detection flags once the reads have completed.
+
+    In tracking mode, each group is only tested at its current read delay and
+    the two values on each side. While the current value passes, the delay is
+    moved by one step away from a failing neighbour when both values on the
+    other side pass, so that drift is followed before it causes read errors,
+    without oscillating in a window of 2 values. When the current value fails,
+    the delay is moved by one step towards the closest passing value. This
+    compensates drift during operation, within a refresh window.
+
+    The engine takes over the DFI interface while busy, it must be started
+    while the controller is idle with all banks precharged (for instance
+    right after initialization).
+
+    Parameters
+    ----------
+    addressbits, bankbits, nranks, databits, nphases : int
+        DFI interface parameters.
+    ngroups : int
+        Number of DQS groups.
+    sys_clk_freq : float
+        System clock frequency.
+    rdphase : int
+        Phase on which reads are issued.
+    read_latency : int
+        PHY read latency in system clock cycles.
+    nreads : int
+        Number of reads issued for each read delay value.
+
+    Attributes
+    ----------
+    start : Signal(), in
+        Starts a calibration sweep.
+    auto_apply : Signal(), in
+        Applies the center of the passing window at the end of the sweep,
+        the previous read delays are restored otherwise.
+    busy : Signal(), out
+        Sweep in progress, the engine drives the DFI interface.
+    done : Signal(), out
+        Sweep completed, cleared when a new sweep is started.
+    track : Signal(), in
+        Starts a tracking sweep.
+    track_done : Signal(), out
+        Tracking sweep completed (pulse).
+    burstdet : Signal(ngroups), in
+        Burst detection pulses.
+    readclksel : list of Signal(3), in
+        Read delays currently applied to the DQSBUFMs.
+    rdly : list of Record(w_stb, w_data), out
+        Read delay updates, to the DQSBUFM setting managers.
+    bitmaps : list of Signal(8), out
+        Passing read delays of each DQS group (bit N set if rdly=N passed).
+    """
+    def __init__(self, addressbits, bankbits, nranks, databits, nphases, ngroups,
+                 sys_clk_freq, rdphase, read_latency, nreads=16):
+        self.dfi = Interface(addressbits, bankbits, nranks, databits, nphases)
+
+        self.start = Signal()
+        self.auto_apply = Signal()
+        self.busy = Signal()
+        self.done = Signal()
+        self.track = Signal()
+        self.track_done = Signal()
+
+        self.burstdet = Signal(ngroups)
+        self.readclksel = [Signal(3) for i in range(ngroups)]
+        self.rdly = [Record([("w_stb", 1), ("w_data", 3)]) for i in range(ngroups)]
+        self.bitmaps = [Signal(8) for i in range(ngroups)]
+
+        self._ngroups = ngroups
+        self._sys_clk_freq = sys_clk_freq
+        self._rdphase = rdphase
+        self._read_latency = read_latency
+        self._nreads = nreads
+
+    def elaborate(self, platform):
+        m = Module()
+
+        def cycles(t):
+            return math.ceil(t*self._sys_clk_freq) + 1
+
+        # Conservative for all DDR3 speed grades
+        trp = cycles(20e-9)
+        trcd = cycles(20e-9)
+        # DQSBUFM pause sequence and settling
+        tsettle = 8
+        tdrain = self._read_latency + 8
+
+        counter = Signal(range(max(trp, trcd, tsettle, tdrain) + 1))
+        reads = Signal(range(self._nreads + 1))
+        value = Signal(3)
+        auto_apply = Signal()
+        previous = [Signal(3) for i in range(self._ngroups)]
+
+        # Tracking: current read delay (step 2) and the values 1 and 2 steps away (steps 0, 1, 3
+        # and 4). Values out of range are not valid.
+        tracking = Signal()
+        step = Signal(3)
+        track_pass = [Signal(5) for i in range(self._ngroups)]
+        track_values = []
+        track_valids = []
+        for prev in previous:
+            track_value = Signal(3)
+            track_valid = Signal()
+            m.d.comb += [
+                track_value.eq(prev),
+                track_valid.eq(1),
+            ]
+            with m.Switch(step):
+                for s, offset in enumerate(range(-2, 3)):
+                    if offset == 0:
+                        continue
+                    with m.Case(s):
+                        with m.If((prev + offset >= 0) & (prev + offset <= 7)):
+                            m.d.comb += track_value.eq(prev + offset)
+                        with m.Else():
+                            m.d.comb += track_valid.eq(0)
+            track_values.append(track_value)
+            track_valids.append(track_valid)
+
+        # Burst detection flags, cleared before each batch of reads
+        seen = Signal(self._ngroups)
+        seen_clear = Signal()
+        with m.If(seen_clear):
+            m.d.sync += seen.eq(0)
+        with m.Else():
+            m.d.sync += seen.eq(seen | self.burstdet)
+
+        # Center of the passing window of each group
+        centers = []
+        for bitmap in self.bitmaps:
+            lo = Signal(3)
+            hi = Signal(3)
+            for b in reversed(range(8)):
+                with m.If(bitmap[b]):
+                    m.d.comb += lo.eq(b)
+            for b in range(8):
+                with m.If(bitmap[b]):
+                    m.d.comb += hi.eq(b)
+            center = Signal(3)
+            m.d.comb += center.eq((lo + hi) >> 1)
+            centers.append(center)
+
+        cmd_phase = self.dfi.phases[0]
+        rd_phase = self.dfi.phases[self._rdphase]
+
+        def command(phase, a, cas, ras, we):
+            return [
+                phase.address.eq(a),
+                phase.bank.eq(0),
+                # Only rank 0 is trained, reads from several ranks would fight on DQ
+                phase.cs.eq(1),
+                phase.cas.eq(cas),
+                phase.ras.eq(ras),
+                phase.we.eq(we),
+            ]
+
+        with m.FSM():
+            with m.State("Idle"):
+                with m.If(self.start):
+                    m.d.sync += [
+                        self.done.eq(0),
+                        auto_apply.eq(self.auto_apply),
+                        tracking.eq(0),
+                        value.eq(0),
+                        counter.eq(trp),
+                    ]
+                    m.d.sync += [prev.eq(sel) for prev, sel in zip(previous, self.readclksel)]
+                    m.d.sync += [bitmap.eq(0) for bitmap in self.bitmaps]
+                    m.next = "Precharge"
+                with m.Elif(self.track):
+                    m.d.sync += [
+                        tracking.eq(1),
+                        step.eq(0),
+                        counter.eq(trp),
+                    ]
+                    m.d.sync += [prev.eq(sel) for prev, sel in zip(previous, self.readclksel)]
+                    m.next = "Precharge"
+
+            with m.State("Precharge"):
+                m.d.comb += self.busy.eq(1)
+                m.d.comb += command(cmd_phase, 2**10, cas=0, ras=1, we=1)
+                m.next = "tRP"
+
+            with m.State("tRP"):
+                m.d.comb += self.busy.eq(1)
+                m.d.sync += counter.eq(counter - 1)
+                with m.If(counter == 0):
+                    m.d.sync += counter.eq(trcd)
+                    m.next = "Activate"
+
+            with m.State("Activate"):
+                m.d.comb += self.busy.eq(1)
+                m.d.comb += command(cmd_phase, 0, cas=0, ras=1, we=0)
+                m.next = "tRCD"
+
+            with m.State("tRCD"):
+                m.d.comb += self.busy.eq(1)
+                m.d.sync += counter.eq(counter - 1)
+                with m.If(counter == 0):
+                    m.next = "Set-Rdly"
+
+            with m.State("Set-Rdly"):
+                m.d.comb += self.busy.eq(1)
+                for rdly, track_value in zip(self.rdly, track_values):
+                    m.d.comb += [
+                        rdly.w_stb.eq(1),
+                        rdly.w_data.eq(Mux(tracking, track_value, value)),
+                    ]
+                m.d.sync += counter.eq(tsettle)
+                m.next = "Settle"
+
+            with m.State("Settle"):
+                m.d.comb += self.busy.eq(1)
+                m.d.sync += counter.eq(counter - 1)
+                with m.If(counter == 0):
+                    m.d.comb += seen_clear.eq(1)
+                    m.d.sync += reads.eq(self._nreads - 1)
+                    m.next = "Read"
+
+            with m.State("Read"):
+                m.d.comb += self.busy.eq(1)
+                m.d.comb += command(rd_phase, 0, cas=1, ras=0, we=0)
+                m.d.comb += rd_phase.rddata_en.eq(1)
+                m.d.sync += reads.eq(reads - 1)
+                with m.If(reads == 0):
+                    m.d.sync += counter.eq(tdrain)
+                    m.next = "Drain"
+                with m.Else():
+                    m.next = "tCCD"
+
+            # BL8 reads take 2 system clock cycles
+            with m.State("tCCD"):
+                m.d.comb += self.busy.eq(1)
+                m.next = "Read"
+
+            with m.State("Drain"):
+                m.d.comb += self.busy.eq(1)
+                m.d.sync += counter.eq(counter - 1)
+                with m.If(counter == 0):
+                    with m.If(tracking):
+                        with m.Switch(step):
+                            for v in range(5):
+                                with m.Case(v):
+                                    m.d.sync += [p[v].eq(seen[i] & valid)
+                                        for i, (p, valid) in enumerate(zip(track_pass, track_valids))]
+                        m.d.sync += step.eq(step + 1)
+                        with m.If(step == 4):
+                            m.next = "Close"
+                        with m.Else():
+                            m.next = "Set-Rdly"
+                    with m.Else():
+                        with m.Switch(value):
+                            for v in range(8):
+                                with m.Case(v):
+                                    m.d.sync += [bitmap[v].eq(seen[i]) for i, bitmap in enumerate(self.bitmaps)]
+                        m.d.sync += value.eq(value + 1)
+                        with m.If(value == 7):
+                            m.next = "Close"
+                        with m.Else():
+                            m.next = "Set-Rdly"
+
+            with m.State("Close"):
+                m.d.comb += self.busy.eq(1)
+                m.d.comb += command(cmd_phase, 2**10, cas=0, ras=1, we=1)
+                m.d.sync += counter.eq(trp)
+                m.next = "Close-tRP"
+
+            with m.State("Close-tRP"):
+                m.d.comb += self.busy.eq(1)
+                m.d.sync += counter.eq(counter - 1)
+                with m.If(counter == 0):
+                    m.next = "Apply"
+
+            with m.State("Apply"):
+                m.d.comb += self.busy.eq(1)
+                for rdly, bitmap, center, prev, p in zip(self.rdly, self.bitmaps, centers, previous, track_pass):
+                    m.d.comb += rdly.w_stb.eq(1)
+                    with m.If(tracking):
+                        # p[2] is the current value, p[0] and p[4] are 2 steps away
+                        with m.If(p[2]):
+                            # Move away from a failing neighbour when the window extends at least
+                            # 2 values on the other side
+                            with m.If(p[0] & p[1] & ~p[3]):
+                                m.d.comb += rdly.w_data.eq(prev - 1)
+                            with m.Elif(p[3] & p[4] & ~p[1]):
+                                m.d.comb += rdly.w_data.eq(prev + 1)
+                            with m.Else():
+                                m.d.comb += rdly.w_data.eq(prev)
+                        with m.Else():
+                            # Move towards the closest passing value
+                            with m.If(p[1] & ~p[3]):
+                                m.d.comb += rdly.w_data.eq(prev - 1)
+                            with m.Elif(p[3] & ~p[1]):
+                                m.d.comb += rdly.w_data.eq(prev + 1)
+                            with m.Elif(p[0] & ~p[4]):
+                                m.d.comb += rdly.w_data.eq(prev - 1)
+                            with m.Elif(p[4] & ~p[0]):
+                                m.d.comb += rdly.w_data.eq(prev + 1)
+                            with m.Else():
+                                m.d.comb += rdly.w_data.eq(prev)
+                    with m.Elif(auto_apply & bitmap.any()):
+                        m.d.comb += rdly.w_data.eq(center)
+                    with m.Else():
+                        m.d.comb += rdly.w_data.eq(prev)
+                with m.If(tracking):
+                    m.d.comb += self.track_done.eq(1)
+                with m.Else():
+                    m.d.sync += self.done.eq(1)
+                m.next = "Idle"
+
+        return m
+
+
 class ECP5DDRPHY(Peripheral, Elaboratable):
     def __init__(self, pads, sys_clk_freq=100e6):
         super().__init__(name="phy")
@@ -130,9 +450,18 @@ class ECP5DDRPHY(Peripheral, Elaboratable):
 
         self.burstdet = bank.csr(databits//8, "rw")
 
-        self.rdly = []
-        self.rdly += [bank.csr(3, "rw", name="rdly_p0")]
-        self.rdly += [bank.csr(3, "rw", name="rdly_p1")]
+        self.rdly = [bank.csr(3, "rw", name="rdly_p{}".format(i)) for i in range(databits//8)]
+
+        # Read delay calibration: bit 0 starts a sweep, bit 1 applies the window center
+        self.calib_control = bank.csr(2, "w")
+        # Bit 0: busy, bit 1: done
+        self.calib_status = bank.csr(2, "r")
+        # Bit N set if rdly=N passed
+        self.calib_bitmap = [bank.csr(8, "r", name="calib_bitmap_p{}".format(i)) for i in range(databits//8)]
+
+        # Read delay tracking, requested by the controller during refresh windows
+        self.track_req = Signal()
+        self.track_done = Signal()
 
         self._bridge = self.bridge(data_width=32, granularity=8, alignment=2)
         self.bus = self._bridge.bus
@@ -194,8 +523,33 @@ class ECP5DDRPHY(Peripheral, Elaboratable):
         cl_sys_latency = get_sys_latency(nphases, cl)
         cwl_sys_latency = get_sys_latency(nphases, cwl)
 
+        # Read delay calibration -------------------------------------------------------------------
+        m.submodules.calib = calib = _ReadDelayCalibration(len(self.pads.a.o0), len(self.pads.ba.o0),
+            self.settings.nranks, 4*databits, 4, databits//8, self._sys_clk_freq,
+            self.settings.rdphase, self.settings.read_latency)
+        m.d.comb += [
+            calib.start.eq(self.calib_control.w_stb & self.calib_control.w_data[0]),
+            calib.auto_apply.eq(self.calib_control.w_data[1]),
+            calib.track.eq(self.track_req),
+            self.track_done.eq(calib.track_done),
+            self.calib_status.r_data.eq(Cat(calib.busy, calib.done)),
+        ]
+        for csr, bitmap in zip(self.calib_bitmap, calib.bitmaps):
+            m.d.comb += csr.r_data.eq(bitmap)
+
         # DFI Interface ----------------------------------------------------------------------------
-        dfi = self.dfi
+        # The calibration engine takes over the DFI interface while sweeping
+        dfi = Interface(len(self.pads.a.o0), len(self.pads.ba.o0), self.settings.nranks, 4*databits, 4)
+        with m.If(calib.busy):
+            m.d.comb += calib.dfi.connect(dfi)
+            for src, dst in zip(self.dfi.phases, calib.dfi.phases):
+                m.d.comb += [
+                    dst.clk_en.eq(src.clk_en),
+                    dst.odt.eq(src.odt),
+                    dst.reset.eq(src.reset),
+                ]
+        with m.Else():
+            m.d.comb += self.dfi.connect(dfi)
 
         bl8_chunk = Signal()
 
@@ -272,8 +626,22 @@ class ECP5DDRPHY(Peripheral, Elaboratable):
             datavalid_prev = Signal()
             m.d.sync += datavalid_prev.eq(datavalid)
 
-            dqsbufm_manager = _DQSBUFMSettingManager(self.rdly[i])
+            # Read delay updates come from the CSR, or from the calibration engine while sweeping
+            rdly = Record([("w_stb", 1), ("w_data", 3)])
+            with m.If(calib.busy):
+                m.d.comb += rdly.eq(calib.rdly[i])
+            with m.Else():
+                m.d.comb += [
+                    rdly.w_stb.eq(self.rdly[i].w_stb),
+                    rdly.w_data.eq(self.rdly[i].w_data),
+                ]
+
+            dqsbufm_manager = _DQSBUFMSettingManager(rdly)
             setattr(m.submodules, f"dqsbufm_manager{i}", dqsbufm_manager)
+            m.d.comb += [
+                self.rdly[i].r_data.eq(dqsbufm_manager.readclksel),
+                calib.readclksel[i].eq(dqsbufm_manager.readclksel),
+            ]
 
             m.submodules += Instance("DQSBUFM",
                 p_DQS_LI_DEL_ADJ="MINUS",
@@ -328,7 +696,12 @@ class ECP5DDRPHY(Peripheral, Elaboratable):
                 o_DQSW270=dqsw270,
                 o_DQSW=dqsw)
 
-            with m.If(Rose(burstdet)):
+            burstdet_rose = Signal()
+            m.d.comb += [
+                burstdet_rose.eq(Rose(burstdet)),
+                calib.burstdet[i].eq(burstdet_rose),
+            ]
+            with m.If(burstdet_rose):
                 m.d.sync += burstdet_reg[i].eq(1)
 
             # DQS and DM ---------------------------------------------------------------------------
@@ -7,16 +7,21 @@
 # - add multirank support.
 
 from nmigen import *
+from nmigen.sim import Passive, Settle
 from nmigen.utils import log2_int
 
-from gram.common import burst_lengths
+from gram.common import burst_lengths, get_rtw_ck
 from gram.phy.dfi import *
 from gram.modules import _speedgrade_timings, _technology_timings
 
+from collections import deque
 from functools import reduce
 from operator import or_
 
+import mmap
+import os
 import struct
+import sys
 
 SDRAM_VERBOSE_OFF = 0
 SDRAM_VERBOSE_STD = 1
@@ -106,6 +111,109 @@ class BankModel(Elaboratable):
 
         return m
 
+class _SparseStorage:
+    """Bank contents indexed by line (one burst of `data_width` bits), missing lines read as 0"""
+    def __init__(self, data_width, ncols, burst_length, nphases, we_granularity, init):
+        self.lines = {}
+        if init:
+            self.lines.update((addr, data) for addr, data in enumerate(init) if data)
+
+        self._ncols = ncols
+        self._shift = log2_int(burst_length*nphases)
+        self._bytemasks = None
+        if we_granularity:
+            # Data bits written for each value of the write mask, computed on first use
+            self._bytemasks = {}
+            self._nbytes = data_width//8
+
+    def line(self, row, col):
+        return (row*self._ncols | col) >> self._shift
+
+    def read(self, row, col):
+        return self.lines.get(self.line(row, col), 0)
+
+    def write(self, row, col, data, mask):
+        addr = self.line(row, col)
+        if self._bytemasks is not None and mask:
+            bytemask = self._bytemasks.get(mask)
+            if bytemask is None:
+                bytemask = 0
+                for i in range(self._nbytes):
+                    if not (mask >> i) & 1:
+                        bytemask |= 0xff << 8*i
+                self._bytemasks[mask] = bytemask
+            data = (self.lines.get(addr, 0) & ~bytemask) | (data & bytemask)
+        self.lines[addr] = data
+
+
+class SparseBankModel(Elaboratable):
+    """Bank model covering the full row × column space of the bank
+
+    Same interface as `BankModel`, but the bank contents are held in a Python dictionary by a
+    simulator process instead of a `Memory`: only the lines that were written (or initialized)
+    use memory and addresses never alias. `process` must be added to the simulator as a sync
+    process, the module itself only tracks the open row.
+
+    Attributes
+    ----------
+    lines : dict
+        Bank contents, indexed by line (one burst of `data_width` bits), missing lines read as 0
+    """
+    def __init__(self, data_width, nrows, ncols, burst_length, nphases, we_granularity, init):
+        self.activate     = Signal()
+        self.activate_row = Signal(range(nrows))
+        self.precharge    = Signal()
+
+        self.write        = Signal()
+        self.write_col    = Signal(range(ncols))
+        self.write_data   = Signal(data_width)
+        self.write_mask   = Signal(data_width//8)
+
+        self.read         = Signal()
+        self.read_col     = Signal(range(ncols))
+        self.read_data    = Signal(data_width)
+
+        self._storage = _SparseStorage(data_width, ncols, burst_length, nphases, we_granularity, init)
+        self.lines = self._storage.lines
+
+        self._active = Signal()
+        self._row    = Signal(range(nrows))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        with m.If(self.precharge):
+            m.d.sync += self._active.eq(0)
+        with m.Elif(self.activate):
+            m.d.sync += [
+                self._active.eq(1),
+                self._row.eq(self.activate_row),
+            ]
+
+        return m
+
+    def process(self):
+        yield Passive()
+
+        storage = self._storage
+
+        while True:
+            yield Settle()
+
+            active = (yield self._active)
+            row = (yield self._row)
+
+            # Reads see the bank contents before this cycle's write, as the Memory read port does
+            read_data = 0
+            if active and (yield self.read):
+                read_data = storage.read(row, (yield self.read_col))
+            yield self.read_data.eq(read_data)
+
+            if active and (yield self.write):
+                storage.write(row, (yield self.write_col), (yield self.write_data), (yield self.write_mask))
+
+            yield
+
 # DFI Phase Model ----------------------------------------------------------------------------------
 
 class DFIPhaseModel(Elaboratable):
@@ -153,14 +261,16 @@ class SDRAMCMD:
 
 
 class TimingRule:
-    def __init__(self, prev: str, curr: str, delay: int):
-        self.name  = prev + "->" + curr
-        self.prev  = prev
-        self.curr  = curr
-        self.delay = delay
+    def __init__(self, prev: str, curr: str, delay: int, timing: str = None):
+        self.name   = prev + "->" + curr
+        self.prev   = prev
+        self.curr   = curr
+        self.delay  = delay
+        self.timing = timing
 
 
-class DFITimingsChecker(Elaboratable):
+class _DFITimingsBase:
+    """Commands, timing rules and timings (in ps) shared by the DFI timing checkers"""
     CMDS = [
         # Name, cs & ras & cas & we value
         ("PRE",  "1101"), # Precharge
@@ -198,20 +308,32 @@ class DFITimingsChecker(Elaboratable):
         ("ZQCS", "ACT", "tZQCS"),
     ]
 
+    # Rules checked against the last command on any bank
+    RANK_RULES = [
+        # tRTW
+        ("RD",   "WR",  "tRTW"),
+    ]
+
     def add_cmds(self):
         self.cmds = {}
         for idx, (name, pattern) in enumerate(self.CMDS):
             self.cmds[name] = SDRAMCMD(name, int(pattern, 2), idx)
 
-    def add_rule(self, prev, curr, delay):
+    def make_rule(self, prev, curr, delay):
+        timing = None
         if not isinstance(delay, int):
+            timing = delay
             delay = self.timings[delay]
-        self.rules.append(TimingRule(prev, curr, delay))
+        return TimingRule(prev, curr, delay, timing)
+
+    def add_rule(self, prev, curr, delay):
+        self.rules.append(self.make_rule(prev, curr, delay))
 
     def add_rules(self):
         self.rules = []
         for rule in self.RULES:
             self.add_rule(*rule)
+        self.rank_rules = [self.make_rule(*rule) for rule in self.RANK_RULES]
 
     # Convert ns to ps
     def ns_to_ps(self, val):
@@ -224,7 +346,7 @@ class DFITimingsChecker(Elaboratable):
         return self.ns_to_ps(max(c, t))
 
     def prepare_timings(self, timings, refresh_mode, memtype):
-        CK_NS = ["tRFC", "tWTR", "tFAW", "tCCD", "tRRD", "tZQCS"]
+        CK_NS = ["tRFC", "tWTR", "tFAW", "tCCD", "tRRD", "tZQCS", "tRTW"]
         REF   = ["tREFI", "tRFC"]
         self.timings = timings
         new_timings  = {}
@@ -254,6 +376,8 @@ class DFITimingsChecker(Elaboratable):
 
         self.timings = new_timings
 
+
+class DFITimingsChecker(_DFITimingsBase, Elaboratable):
     def __init__(self, dfi, nbanks, nphases, timings, refresh_mode, memtype, verbose=False):
         self.prepare_timings(timings, refresh_mode, memtype)
         self.add_cmds()
@@ -287,6 +411,13 @@ class DFITimingsChecker(Elaboratable):
 
         ref_issued = Signal(self.nphases)
 
+        # Last command on any bank for the rank rules, updated phase by phase
+        rank_cmds = {rule.prev for rule in self.rank_rules}
+        rank_last_ps    = {name: Signal.like(cnt, name="last_{}_ps".format(name)) for name in rank_cmds}
+        rank_last_valid = {name: Signal(name="last_{}_valid".format(name)) for name in rank_cmds}
+        last_ps    = dict(rank_last_ps)
+        last_valid = dict(rank_last_valid)
+
         for np, phase in enumerate(phases):
             ps = Signal().like(cnt)
             m.d.comb += ps.eq((cnt + np)*int(self.timings["tCK"]))
@@ -356,6 +487,28 @@ class DFITimingsChecker(Elaboratable):
                                 act_curr.eq(act_next),
                             ]
 
+            # Rank command monitoring
+            for rule in self.rank_rules:
+                cmd_recv = state == self.cmds[rule.curr].enc
+                m.d.sync += Assert(~(cmd_recv & last_valid[rule.prev] & (ps < (last_ps[rule.prev] + rule.delay))))
+
+            for name in rank_cmds:
+                cmd_recv = state == self.cmds[name].enc
+                phase_ps = Signal.like(cnt)
+                phase_valid = Signal()
+                m.d.comb += [
+                    phase_ps.eq(Mux(cmd_recv, ps, last_ps[name])),
+                    phase_valid.eq(cmd_recv | last_valid[name]),
+                ]
+                last_ps[name] = phase_ps
+                last_valid[name] = phase_valid
+
+        for name in rank_cmds:
+            m.d.sync += [
+                rank_last_ps[name].eq(last_ps[name]),
+                rank_last_valid[name].eq(last_valid[name]),
+            ]
+
         # tREFI
         ref_ps      = Signal().like(cnt)
         ref_ps_mod  = Signal().like(cnt)
@@ -421,65 +574,76 @@ class DFITimingsChecker(Elaboratable):
 
         return m
 
+def _init_image(init):
+    """Bytes view of a FakePHY init image
+
+    `init` is a list of 32-bit words, a bytes-like object (bytes, bytearray, memoryview, mmap)
+    or the path of a file, which is memory-mapped. Lines are stored in little-endian order.
+    """
+    if isinstance(init, (str, os.PathLike)):
+        with open(init, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            init = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if isinstance(init, (list, tuple)):
+        init = struct.pack("<{}I".format(len(init)), *init)
+    return memoryview(init).cast("B")
+
+
+# Native formats of the lines that memoryviews can convert without copying
+_line_formats = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+def _image_lines(view, line_bytes):
+    """Values of the `line_bytes` wide lines of a bytes view"""
+    fmt = _line_formats.get(line_bytes)
+    if fmt is not None and sys.byteorder == "little" and struct.calcsize(fmt) == line_bytes:
+        return view.cast(fmt).tolist()
+    return [int.from_bytes(view[i:i+line_bytes], "little") for i in range(0, len(view), line_bytes)]
+
+
 class FakePHY(Elaboratable):
     def __prepare_bank_init_data(self, init, nbanks, nrows, ncols, data_width, address_mapping):
-        mem_size          = (self.settings.databits//8)*(nrows*ncols*nbanks)
-        bank_size         = mem_size // nbanks
-        column_size       = bank_size // nrows
-        model_bank_size   = bank_size // (data_width//8)
-        model_column_size = model_bank_size // nrows
-        model_data_ratio  = data_width // 32
         data_width_bytes  = data_width // 8
-        bank_init         = [[] for i in range(nbanks)]
+        model_bank_size   = (self.settings.databits//8)*nrows*ncols // data_width_bytes
+        model_column_size = model_bank_size // nrows
 
+        image = _init_image(init)
         # Pad init if too short
-        if len(init)%data_width_bytes != 0:
-            init.extend([0]*(data_width_bytes-len(init)%data_width_bytes))
-
-
-        # Convert init data width from 32-bit to data_width if needed
-        if model_data_ratio > 1:
-            new_init = [0]*(len(init)//model_data_ratio)
-            for i in range(0, len(init), model_data_ratio):
-                ints = init[i:i+model_data_ratio]
-                strs = "".join("{:08x}".format(x) for x in reversed(ints))
-                new_init[i//model_data_ratio] = int(strs, 16)
-            init = new_init
-        elif model_data_ratio == 0:
-            assert data_width_bytes in [1, 2]
-            model_data_ratio = 4 // data_width_bytes
-            struct_unpack_patterns = {1: "4B", 2: "2H"}
-            new_init = [0]*int(len(init)*model_data_ratio)
-            for i in range(len(init)):
-                new_init[model_data_ratio*i:model_data_ratio*(i+1)] = struct.unpack(
-                    struct_unpack_patterns[data_width_bytes],
-                    struct.pack("I", init[i])
-                )[0:model_data_ratio]
-            init = new_init
+        if len(image) % data_width_bytes:
+            image = memoryview(bytes(image) + bytes(data_width_bytes - len(image) % data_width_bytes))
+        nlines = min(len(image) // data_width_bytes, nbanks*model_bank_size)
 
+        # Slices of the image (in lines) going to each bank, taken as views of the image
         if address_mapping == "ROW_BANK_COL":
-            for row in range(nrows):
-                for bank in range(nbanks):
-                    start = (row*nbanks*model_column_size + bank*model_column_size)
-                    end   = min(start + model_column_size, len(init))
-                    if start > len(init):
-                        break
-                    bank_init[bank].extend(init[start:end])
+            chunks = [[] for i in range(nbanks)]
+            for start in range(0, nlines, model_column_size):
+                bank = (start // model_column_size) % nbanks
+                chunks[bank].append((start, min(start + model_column_size, nlines)))
         elif address_mapping == "BANK_ROW_COL":
-            for bank in range(nbanks):
-                start = bank*model_bank_size
-                end   = min(start + model_bank_size, len(init))
-                if start > len(init):
-                    break
-                bank_init[bank] = init[start:end]
+            chunks = [[(start, min(start + model_bank_size, nlines))]
+                      for start in range(0, nbanks*model_bank_size, model_bank_size)]
+        else:
+            raise ValueError("Unsupported address mapping {}".format(address_mapping))
+
+        bank_init = []
+        for bank_chunks in chunks:
+            lines = []
+            for start, end in bank_chunks:
+                if start < end:
+                    lines.extend(_image_lines(image[start*data_width_bytes:end*data_width_bytes],
+                                              data_width_bytes))
+            bank_init.append(lines)
 
         return bank_init
 
     def __init__(self, module, settings, clk_freq=100e6,
         we_granularity         = 8,
-        init                   = [],
+        init                   = None,
         address_mapping        = "ROW_BANK_COL",
-        verbosity              = SDRAM_VERBOSE_OFF):
+        verbosity              = SDRAM_VERBOSE_OFF,
+        sparse                 = False,
+        behavioural            = False):
 
         # Parameters -------------------------------------------------------------------------------
         self.burst_length = {
@@ -514,36 +678,12 @@ class FakePHY(Elaboratable):
             nphases     = self.settings.nphases
         )
 
-    def elaborate(self, platform):
-        m = Module()
-
         nphases    = self.settings.nphases
         nbanks     = 2**self.bankbits
         nrows      = 2**self.rowbits
         ncols      = 2**self.colbits
         data_width = self.settings.dfi_databits*self.settings.nphases
 
-        # DFI phases -------------------------------------------------------------------------------
-        phases = [DFIPhaseModel(self.dfi, n) for n in range(self.settings.nphases)]
-        m.submodules += phases
-
-        # DFI timing checker -----------------------------------------------------------------------
-        if self.verbosity > SDRAM_VERBOSE_OFF:
-            timings = {"tCK": (1e9 / self.clk_freq) / nphases}
-
-            for name in _speedgrade_timings + _technology_timings:
-                timings[name] = self.module.get(name)
-
-            timing_checker = DFITimingsChecker(
-                dfi          = self.dfi,
-                nbanks       = nbanks,
-                nphases      = nphases,
-                timings      = timings,
-                refresh_mode = self.module.timing_settings.fine_refresh_mode,
-                memtype      = self.settings.memtype,
-                verbose      = self.verbosity > SDRAM_VERBOSE_DBG)
-            m.submodules.timing_checker = timing_checker
-
         # Bank init data ---------------------------------------------------------------------------
         bank_init  = [None for i in range(nbanks)]
 
@@ -558,7 +698,26 @@ class FakePHY(Elaboratable):
             )
 
         # Banks ------------------------------------------------------------------------------------
-        banks = [BankModel(
+        # The sparse and behavioural models cover the whole module geometry, their storage lives
+        # in simulator processes that must be added along with the design:
+        #   for process in phy.processes:
+        #       sim.add_sync_process(process)
+        self._behavioural = behavioural
+        if behavioural:
+            # The DRAM side (banks, latencies, read data) is entirely modelled by a process
+            self.banks = []
+            self._storage = [_SparseStorage(
+                data_width     = data_width,
+                ncols          = ncols,
+                burst_length   = self.burst_length,
+                nphases        = nphases,
+                we_granularity = self.we_granularity,
+                init           = bank_init[i]) for i in range(nbanks)]
+            self.processes = [self._behavioural_process]
+            return
+
+        bank_cls = SparseBankModel if sparse else BankModel
+        self.banks = [bank_cls(
             data_width     = data_width,
             nrows          = nrows,
             ncols          = ncols,
@@ -566,6 +725,118 @@ class FakePHY(Elaboratable):
             nphases        = nphases,
             we_granularity = self.we_granularity,
             init           = bank_init[i]) for i in range(nbanks)]
+        self.processes = [bank.process for bank in self.banks] if sparse else []
+
+    def get_timings(self):
+        """Module timings (ns and/or clock cycles) in the format expected by the DFI checkers"""
+        timings = {"tCK": (1e9 / self.clk_freq) / self.settings.nphases}
+
+        for name in _speedgrade_timings + _technology_timings:
+            timings[name] = self.module.get(name)
+        timings["tRTW"] = (get_rtw_ck(self.settings.memtype, self.settings.cl, self.settings.cwl), None)
+
+        return timings
+
+    def _behavioural_process(self):
+        yield Passive()
+
+        phases = self.dfi.phases
+        nphases = len(phases)
+        storage = self._storage
+        read_latency = self.settings.read_latency
+        write_latency = self.settings.write_latency
+        ncols = 2**self.colbits
+
+        # cs/ras/cas/we of all phases, read at once
+        cmds = Cat(*[Cat(p.we, p.cas, p.ras, p.cs[0]) for p in phases])
+        wrdata = Cat(*[p.wrdata for p in phases])
+        wrdata_mask = Cat(*[p.wrdata_mask for p in phases])
+        rddata = Cat(*[p.rddata for p in phases])
+        rddata_valid = Cat(*[p.rddata_valid for p in phases])
+
+        open_rows = [None]*len(storage)
+        reads = deque()  # (cycle, data)
+        writes = deque() # (cycle, bank, row, col)
+        driving = False
+        cycle = 0
+
+        while True:
+            yield Settle()
+
+            state = (yield cmds)
+            for np, phase in enumerate(phases):
+                cmd = (state >> 4*np) & 0b1111
+                if not cmd & 0b1000:
+                    continue
+                if cmd == 0b1100: # Activate
+                    open_rows[(yield phase.bank)] = (yield phase.address)
+                elif cmd == 0b1101: # Precharge
+                    if (yield phase.address[10]):
+                        open_rows = [None]*len(storage)
+                    else:
+                        open_rows[(yield phase.bank)] = None
+                elif cmd in (0b1010, 0b1011): # Read, Write
+                    bank = (yield phase.bank)
+                    address = (yield phase.address)
+                    row = open_rows[bank]
+                    # The column is below A10 (auto precharge)
+                    col = address & (ncols - 1)
+                    if cmd == 0b1010:
+                        data = 0 if row is None else storage[bank].read(row, col)
+                        reads.append((cycle + read_latency, data))
+                    elif row is not None:
+                        writes.append((cycle + write_latency, bank, row, col))
+                    if address & 2**10:
+                        open_rows[bank] = None
+
+            # Write data is sampled write latency cycles after the command
+            while writes and writes[0][0] == cycle:
+                _, bank, row, col = writes.popleft()
+                storage[bank].write(row, col, (yield wrdata), (yield wrdata_mask))
+
+            if reads and reads[0][0] == cycle:
+                _, data = reads.popleft()
+                yield rddata_valid.eq(2**nphases - 1)
+                yield rddata.eq(data)
+                driving = True
+            elif driving:
+                yield rddata_valid.eq(0)
+                yield rddata.eq(0)
+                driving = False
+
+            cycle += 1
+            yield
+
+    def elaborate(self, platform):
+        m = Module()
+
+        nphases    = self.settings.nphases
+        nbanks     = 2**self.bankbits
+        nrows      = 2**self.rowbits
+        ncols      = 2**self.colbits
+        data_width = self.settings.dfi_databits*self.settings.nphases
+
+        # DFI timing checker -----------------------------------------------------------------------
+        if self.verbosity > SDRAM_VERBOSE_OFF:
+            timing_checker = DFITimingsChecker(
+                dfi          = self.dfi,
+                nbanks       = nbanks,
+                nphases      = nphases,
+                timings      = self.get_timings(),
+                refresh_mode = self.module.timing_settings.fine_refresh_mode,
+                memtype      = self.settings.memtype,
+                verbose      = self.verbosity > SDRAM_VERBOSE_DBG)
+            m.submodules.timing_checker = timing_checker
+
+        if self._behavioural:
+            return m
+
+        # DFI phases -------------------------------------------------------------------------------
+        phases = [DFIPhaseModel(self.dfi, n) for n in range(self.settings.nphases)]
+        m.submodules += phases
+
+        # Banks ------------------------------------------------------------------------------------
+        banks = self.banks
         m.submodules += banks
 
         # Connect DFI phases to Banks (CMDs, Write datapath) ---------------------------------------
@@ -0,0 +1,135 @@
+import io
+import json
+
+from gram.bench import *
+from gram.phy.dfitrace import DFICommand, DFITraceChecker
+from gram.test.utils import *
+
+class GeneratorsTestCase(FHDLTestCase):
+    layout = AddressLayout(col_bits=8, bank_bits=3, row_bits=15)
+
+    def test_patterns(self):
+        self.assertEqual([a.addr for a in sequential(self.layout, 3, start=5)], [5, 6, 7])
+        self.assertEqual([a.addr for a in strided(self.layout, 3, stride=256)], [0, 256, 512])
+        self.assertEqual([a.addr for a in bank_conflict(self.layout, 3, bank=2)],
+                         [2 << 8, (1 << 11) | (2 << 8), 2 << 8])
+        for a in random_access(self.layout, 100):
+            self.assertLess(a.addr, 2**26)
+
+    def test_read_ratio(self):
+        self.assertFalse(any(a.we for a in sequential(self.layout, 100, read_ratio=1.0)))
+        self.assertTrue(all(a.we for a in sequential(self.layout, 100, read_ratio=0.0)))
+        writes = sum(a.we for a in random_access(self.layout, 1000, read_ratio=0.75))
+        self.assertTrue(200 < writes < 300)
+
+class BenchmarkMetricsTestCase(FHDLTestCase):
+    def test_summary(self):
+        metrics = BenchmarkMetrics(data_width=128, clk_freq=100e6)
+        for i in range(100):
+            metrics.transaction(0, False, i, i + 10 + (i == 50)*90)
+        for name in ["ACT", "RD", "RD", "WR", "RD", "ACT", "RD"]:
+            metrics.command(DFICommand(0, 0, name, 0, 0))
+
+        summary = metrics.summary()
+        self.assertEqual(summary["cycles"], 151)
+        self.assertEqual(summary["bytes"], 1600)
+        self.assertEqual(summary["latency"]["p50"], 10)
+        self.assertEqual(summary["latency"]["p99"], 10)
+        self.assertEqual(summary["latency"]["max"], 100)
+        self.assertEqual(summary["row_hit_rate"], 0.6)
+        self.assertEqual(summary["turnarounds"], {"read_to_write": 1, "write_to_read": 1})
+        json.dumps(summary)
+
+    def test_row_hits(self):
+        metrics = BenchmarkMetrics(data_width=128)
+        for name, bank, address in [
+                ("ACT", 0, 1), ("ACT", 1, 1), ("RD", 0, 0), ("RD", 1, 0), ("RD", 0, 8),
+                # Row opened and closed without column commands
+                ("ACT", 3, 1), ("PRE", 3, 0),
+                # Precharge of bank 0, then Precharge All
+                ("PRE", 0, 0), ("RD", 1, 8), ("ACT", 0, 2), ("RD", 0, 0), ("PRE", 0, 2**10),
+                ("ACT", 1, 1), ("RD", 1, 0), ("RD", 1, 8), ("REF", 0, 0),
+                ("ACT", 2, 1), ("RD", 2, 0), ("WR", 2, 8)]:
+            metrics.command(DFICommand(0, 0, name, bank, address))
+
+        self.assertEqual(metrics.row_hits, 4)
+        self.assertEqual(metrics.summary()["row_hit_rate"], 4/9)
+
+class BenchmarkTestCase(FHDLTestCase):
+    def test_sequential(self):
+        bench = Benchmark()
+        summary = bench.run([sequential(bench.layout, 64)])
+        self.assertEqual(summary["reads"], 64)
+        self.assertGreater(summary["row_hit_rate"], 0.9)
+        self.assertEqual(summary["turnarounds"], {"read_to_write": 0, "write_to_read": 0})
+        json.dumps(summary)
+
+    def test_bank_conflict(self):
+        bench = Benchmark(nports=2)
+        summary = bench.run([
+            bank_conflict(bench.layout, 16, read_ratio=0.5),
+            bank_conflict(bench.layout, 16, read_ratio=0.5, bank=1, seed=1),
+        ])
+        self.assertEqual(summary["transactions"], 32)
+        self.assertEqual(summary["row_hit_rate"], 0.0)
+        self.assertEqual(set(summary["ports"]), {"0", "1"})
+        self.assertLess(summary["bandwidth_efficiency"], 100)
+
+    def test_timings(self):
+        bench = Benchmark(nports=2)
+        phy = bench.phy
+        checker = DFITraceChecker(phy.settings.nphases, phy.get_timings(),
+                                  phy.module.timing_settings.fine_refresh_mode, phy.settings.memtype)
+        bench._monitor.sinks.append(checker.command)
+
+        # Reads on bank 0 and writes on bank 1: tRTW is only met across banks
+        summary = bench.run([
+            sequential(bench.layout, 100, read_ratio=1.0),
+            sequential(bench.layout, 100, read_ratio=0.0, start=bench.layout.address(row=0, bank=1, col=0)),
+        ])
+        self.assertGreater(summary["turnarounds"]["read_to_write"], 10)
+
+        self.assertEqual(checker.violations, [], checker.report())
+        slack = {rs.rule: rs for rs in checker.slack()}
+        self.assertGreater(slack["RD->WR (tRTW)"].count, 10)
+
+class WorkloadReplayTestCase(FHDLTestCase):
+    trace = """\
+# cycle port op address size [dep]
+0   0 R 0x0      16
+0   1 W 0x100000 64
+5   0 R 0x8      16
+5   1 R 0x200000 16 1
+40  0 W 0x40     16
+"""
+
+    def test_read_workload(self):
+        txns = list(read_workload(io.StringIO(self.trace)))
+        self.assertEqual(txns[3], Transaction(5, 1, False, 0x200000, 16, 1))
+        f = io.StringIO()
+        write_workload(txns, f)
+        f.seek(0)
+        self.assertEqual(list(read_workload(f)), txns)
+
+        with self.assertRaises(ValueError):
+            list(read_workload(io.StringIO("0 0 R 0x0 16 0\n")))
+        with self.assertRaises(ValueError):
+            list(read_workload(io.StringIO("0 0 X 0x0 16\n")))
+
+    def test_replay(self):
+        bench = Benchmark(nports=2)
+        latencies = io.StringIO()
+        summary = WorkloadReplay(bench, read_workload(io.StringIO(self.trace)), latencies).run()
+
+        # 16 byte words: the transaction at 0x8 spans two words, the 64 bytes one four words
+        self.assertEqual(summary["transactions"], 5)
+        self.assertEqual(summary["bytes"], 16*(1 + 4 + 2 + 1 + 1))
+
+        lines = [l.split() for l in latencies.getvalue().splitlines()[1:]]
+        done = {int(l[0]): (int(l[3]), int(l[4]), int(l[5]), int(l[6])) for l in lines}
+        self.assertEqual(set(done), set(range(5)))
+        for arrival, issued, completed, latency in done.values():
+            self.assertLessEqual(arrival, issued)
+            self.assertEqual(completed - arrival, latency)
+        # Transaction 3 waits for transaction 1
+        self.assertGreater(done[3][1], done[1][2])
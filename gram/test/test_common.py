@@ -1,8 +1,16 @@
 #nmigen: UnusedElaboratable=no
+import random
+from functools import reduce
+from operator import add
+
 from nmigen import *
 from nmigen.hdl.ast import Past
+from nmigen.asserts import Assert, Assume
+from nmigen.sim import Settle
+
+from nmigen.utils import log2_int
 
-from gram.common import tXXDController, tFAWController
+from gram.common import *
 from gram.test.utils import *
 
 class tXXDControllerTestCase(FHDLTestCase):
@@ -39,6 +47,53 @@ class tXXDControllerTestCase(FHDLTestCase):
         generic_test(5)
         generic_test(10)
 
+class _tFAWWindow(Elaboratable):
+    """Reference tFAW controller counting the activates of a `tfaw` cycles shift register
+
+    This is the previous `tFAWController`, except for the width of `count`: it was
+    `range(max(tfaw, 2))`, which wraps to 0 when 4 activates fill a 4 cycles window.
+    """
+    def __init__(self, tfaw):
+        self.valid = Signal()
+        self.ready = Signal(reset=1)
+        self._tfaw = tfaw
+
+    def elaborate(self, platform):
+        m = Module()
+
+        count = Signal(range(max(self._tfaw+1, 2)))
+        window = Signal(self._tfaw)
+        m.d.sync += window.eq(Cat(self.valid, window))
+        m.d.comb += count.eq(reduce(add, [window[i] for i in range(self._tfaw)]))
+        with m.If(count < 4):
+            with m.If(count == 3):
+                m.d.sync += self.ready.eq(~self.valid)
+            with m.Else():
+                m.d.sync += self.ready.eq(1)
+
+        return m
+
+class tFAWControllerEquivalenceSpec(Elaboratable):
+    def __init__(self, tfaw):
+        self.tfaw = tfaw
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.dut = dut = tFAWController(self.tfaw)
+        m.submodules.ref = ref = _tFAWWindow(self.tfaw)
+        valid = Signal()
+        m.d.comb += [
+            dut.valid.eq(valid),
+            ref.valid.eq(valid),
+        ]
+
+        # Activates are only issued when allowed
+        m.d.comb += Assume(valid.implies(dut.ready))
+        m.d.comb += Assert(dut.ready == ref.ready)
+
+        return m
+
 class tFAWControllerTestCase(FHDLTestCase):
     def test_strobe_3(self):
         dut = tFAWController(10)
@@ -55,3 +110,72 @@ class tFAWControllerTestCase(FHDLTestCase):
             self.assertFalse((yield dut.valid))
 
         runSimulation(dut, process, "test_common.vcd")
+
+    def test_formal(self):
+        for tfaw in [1, 3, 4, 5, 10]:
+            self.assertFormal(tFAWControllerEquivalenceSpec(tfaw), mode="bmc", depth=3*tfaw+4)
+
+    def test_random(self):
+        # Same checks as test_formal, in simulation
+        for tfaw in [1, 3, 4, 5, 10, 30]:
+            dut = tFAWController(tfaw)
+            ref = _tFAWWindow(tfaw)
+            m = Module()
+            m.submodules.dut = dut
+            m.submodules.ref = ref
+            m.d.comb += ref.valid.eq(dut.valid)
+            rng = random.Random(tfaw)
+
+            def process():
+                for i in range(2000):
+                    yield Settle()
+                    self.assertEqual((yield dut.ready), (yield ref.ready))
+                    yield dut.valid.eq((yield dut.ready) & (rng.random() < 0.5))
+                    yield
+
+            runSimulation(m, process, "test_common.vcd")
+
+class RTWLatencyTestCase(FHDLTestCase):
+    def ecp5_settings(self, sys_clk_freq):
+        tck = 1/(2*sys_clk_freq)
+        nphases = 2
+        cl, cwl = get_cl_cw("DDR3", tck)
+        cl_sys_latency = get_sys_latency(nphases, cl)
+        cwl_sys_latency = get_sys_latency(nphases, cwl)
+        rdcmdphase, rdphase = get_sys_phases(nphases, cl_sys_latency, cl)
+        wrcmdphase, wrphase = get_sys_phases(nphases, cwl_sys_latency, cwl)
+        return PhySettings(
+            phytype="ECP5DDRPHY",
+            memtype="DDR3",
+            databits=16,
+            dfi_databits=64,
+            nphases=nphases,
+            rdphase=rdphase,
+            wrphase=wrphase,
+            rdcmdphase=rdcmdphase,
+            wrcmdphase=wrcmdphase,
+            cl=cl,
+            cwl=cwl,
+            read_latency=2 + cl_sys_latency + 2 + log2_int(4//nphases) + 4,
+            write_latency=cwl_sys_latency)
+
+    def test_rtw_ck(self):
+        # CL6/CWL5 BL8: 6 + 4 + 2 - 5
+        self.assertEqual(get_rtw_ck("DDR3", 6, 5), 7)
+
+    def test_legal_and_tight(self):
+        for sys_clk_freq in [50e6, 75e6, 100e6]:
+            settings = self.ecp5_settings(sys_clk_freq)
+            rtw_ck = get_rtw_ck("DDR3", settings.cl, settings.cwl)
+            spacing = lambda cycles: cycles*settings.nphases + settings.wrphase - settings.rdphase
+
+            self.assertGreaterEqual(spacing(settings.rtw_latency), rtw_ck)
+            if settings.rtw_latency > 1:
+                self.assertLess(spacing(settings.rtw_latency-1), rtw_ck)
+            self.assertLess(settings.rtw_latency, settings.read_latency-1)
+
+    def test_override(self):
+        settings = PhySettings(phytype="ECP5DDRPHY", memtype="DDR3", databits=16, dfi_databits=64,
+            nphases=2, rdphase=0, wrphase=1, rdcmdphase=1, wrcmdphase=0, cl=6, cwl=5,
+            read_latency=12, write_latency=3, rtw_latency=8)
+        self.assertEqual(settings.rtw_latency, 8)
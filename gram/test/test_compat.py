@@ -8,7 +8,7 @@ from gram.test.utils import *
 
 class DelayedEnterTestCase(FHDLTestCase):
     def test_sequence(self):
-        def sequence(expected_delay):
+        def sequence(expected_delay, max_states=4):
             m = Module()
 
             before = Signal()
@@ -19,7 +19,7 @@ class DelayedEnterTestCase(FHDLTestCase):
                     m.d.comb += before.eq(1)
                     m.next = "Delayed-Enter"
 
-                delayed_enter(m, "Delayed-Enter", "End-Delayed-Enter", expected_delay)
+                delayed_enter(m, "Delayed-Enter", "End-Delayed-Enter", expected_delay, max_states)
 
                 with m.State("End-Delayed-Enter"):
                     m.d.comb += end.eq(1)
@@ -44,6 +44,51 @@ class DelayedEnterTestCase(FHDLTestCase):
         sequence(10)
         sequence(100)
         sequence(1000)
+        # State chains only
+        sequence(10, max_states=None)
+        # Counter only
+        sequence(1, max_states=0)
+        sequence(2, max_states=0)
+
+    def test_reenter(self):
+        def delays(max_states):
+            m = Module()
+
+            enter = Signal()
+            end = Signal()
+
+            with m.FSM():
+                with m.State("Idle"):
+                    with m.If(enter):
+                        m.next = "Delayed-Enter"
+
+                delayed_enter(m, "Delayed-Enter", "End-Delayed-Enter", 5, max_states)
+
+                with m.State("End-Delayed-Enter"):
+                    m.d.comb += end.eq(1)
+                    m.next = "Idle"
+
+            result = []
+
+            def process():
+                for i in range(3):
+                    yield enter.eq(1)
+                    yield
+                    yield enter.eq(0)
+
+                    delay = 0
+                    while not (yield end):
+                        yield
+                        delay += 1
+                    result.append(delay)
+
+            runSimulation(m, process, "test_delayedenter.vcd")
+            return result
+
+        # The counter gives the same delay as the state chain each time the state is entered
+        chain = delays(max_states=None)
+        self.assertEqual(len(set(chain)), 1)
+        self.assertEqual(delays(max_states=0), chain)
 
 class TimelineTestCase(FHDLTestCase):
     def test_sequence(self):
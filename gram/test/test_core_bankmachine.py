@@ -51,6 +51,7 @@ class BankMachineTestCase(FHDLTestCase):
     settings.cmd_buffer_depth = 1
     settings.cmd_buffer_buffered = False
     settings.with_auto_precharge = False
+    settings.with_refresh_precharge_all = True
     settings.geom = types.SimpleNamespace()
     settings.geom.addressbits = 20
     settings.geom.colbits = 8
@@ -70,3 +71,37 @@ class BankMachineTestCase(FHDLTestCase):
     def test_no_request_grant(self):
         dut = BankMachine(0, 20, 2, 1, self.settings)
         self.assertFormal(dut, "bmc", depth=21)
+
+    def test_refresh_precharge(self):
+        def generic_test(precharge_all):
+            settings = types.SimpleNamespace(**vars(self.settings))
+            settings.with_refresh_precharge_all = precharge_all
+            dut = BankMachine(0, 20, 2, 1, settings)
+
+            def process():
+                yield dut.cmd.ready.eq(1)
+
+                # Open a row
+                yield dut.req.valid.eq(1)
+                yield dut.req.we.eq(1)
+                while not (yield dut.req.wdata_ready):
+                    yield
+                yield dut.req.valid.eq(0)
+                yield
+
+                yield dut.refresh_req.eq(1)
+                precharges = 0
+                for i in range(50):
+                    yield
+                    if (yield dut.cmd.valid) & (yield dut.cmd.ras) & (yield dut.cmd.we):
+                        precharges += 1
+                    if (yield dut.refresh_gnt):
+                        break
+
+                self.assertTrue((yield dut.refresh_gnt))
+                self.assertEqual(precharges, 0 if precharge_all else 1)
+
+            runSimulation(dut, process, "test_core_bankmachine.vcd")
+
+        generic_test(True)
+        generic_test(False)
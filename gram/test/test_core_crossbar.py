@@ -1,8 +1,11 @@
 from nmigen import *
 from nmigen.hdl.ast import Sample
 from nmigen.asserts import Assert, Assume
+from nmigen.sim import Settle
 
-from gram.core.crossbar import _DelayLine
+from gram.core.crossbar import gramCrossbar, _DelayLine, _VariableDelayLine
+from gram.core.controller import ControllerSettings
+from gram.common import gramInterface, PhySettings, GeomSettings
 from gram.test.utils import *
 
 class DelayLineSpec(Elaboratable):
@@ -26,3 +29,71 @@ class DelayLineTestCase(FHDLTestCase):
     def test_delay_many(self):
         spec = DelayLineSpec(10)
         self.assertFormal(spec, depth=11)
+
+class VariableDelayLineTestCase(FHDLTestCase):
+    def test_delay(self):
+        def generic_test(delay, expected):
+            dut = _VariableDelayLine(5)
+
+            def process():
+                if delay is not None:
+                    yield dut.delay.eq(delay)
+                yield dut.i.eq(1)
+                yield
+                yield dut.i.eq(0)
+                for i in range(1, 7):
+                    yield Delay(1e-9)
+                    self.assertEqual((yield dut.o), i == expected)
+                    yield
+
+            runSimulation(dut, process, "test_core_crossbar.vcd")
+
+        generic_test(1, 1)
+        generic_test(3, 3)
+        generic_test(5, 5)
+        # Out of range delays fall back to the maximal delay
+        generic_test(0, 5)
+        generic_test(6, 5)
+        # Defaults to the maximal delay
+        generic_test(None, 5)
+
+class CrossbarAddressMappingTestCase(FHDLTestCase):
+    def prepare_testbench(self, address_mapping):
+        settings = ControllerSettings(address_mapping=address_mapping)
+        settings.phy = PhySettings(phytype="ECP5DDRPHY", memtype="DDR3", databits=16, dfi_databits=32,
+            nphases=2, rdphase=1, wrphase=1, rdcmdphase=0, wrcmdphase=0, cl=6, cwl=5,
+            read_latency=10, write_latency=2, nranks=2)
+        settings.geom = GeomSettings(bankbits=3, rowbits=13, colbits=10)
+        interface = gramInterface(3, settings)
+        dut = gramCrossbar(interface)
+        port = dut.get_native_port()
+        return (interface, port, dut)
+
+    def test_mapping(self):
+        colbits = 10 - 3
+
+        def generic_test(address_mapping, rank_shift, bank_shift, row_shift):
+            interface, port, dut = self.prepare_testbench(address_mapping)
+
+            def process():
+                for rank, bank, row, col in [(0, 0, 0, 0), (1, 0, 0, 0), (0, 5, 0, 3), (1, 3, 7, 9),
+                                             (1, 7, 2**13-1, 2**colbits-1)]:
+                    addr = (rank << rank_shift) | (bank << bank_shift) | (row << row_shift) | col
+                    yield port.cmd.valid.eq(1)
+                    yield port.cmd.addr.eq(addr)
+                    yield Settle()
+
+                    # Bank machines are numbered rank first
+                    for n in range(interface.nbanks):
+                        bank_port = getattr(interface, "bank{}".format(n))
+                        self.assertEqual((yield bank_port.valid), n == (rank << 3) | bank)
+                    bank_port = getattr(interface, "bank{}".format((rank << 3) | bank))
+                    self.assertEqual((yield bank_port.addr), (row << colbits) | col)
+                    yield
+
+            runSimulation(dut, process, "test_core_crossbar.vcd")
+
+        # Row, rank, bank, column from the MSB (ranks are the upper bank bits)
+        generic_test("ROW_BANK_COL", rank_shift=colbits + 3, bank_shift=colbits, row_shift=colbits + 4)
+        # Row, bank, rank, column from the MSB: consecutive column blocks alternate between ranks
+        generic_test("ROW_BANK_RANK_COL", rank_shift=colbits, bank_shift=colbits + 1, row_shift=colbits + 4)
@@ -1,7 +1,12 @@
+from collections import deque
+
 from nmigen import *
+from nmigen.sim import Settle
+from nmigen.utils import log2_int
 
-from gram.core.multiplexer import _AntiStarvation, _CommandChooser, _Steerer, STEER_NOP, STEER_CMD
-from gram.common import cmd_request_rw_layout
+from gram.core.multiplexer import _AntiStarvation, _CommandChooser, _Steerer, Multiplexer, STEER_NOP, STEER_CMD, STEER_REFRESH
+from gram.core.controller import ControllerSettings
+from gram.common import cmd_request_rw_layout, gramInterface, PhySettings, GeomSettings, TimingSettings
 from gram.phy.dfi import Interface
 import gram.stream as stream
 from gram.test.utils import *
@@ -79,6 +84,46 @@ class CommandChooserTestCase(FHDLTestCase):
 
         runSimulation(dut, process, "test_core_multiplexer_commandchooser.vcd")
 
+    def test_oldest_first(self):
+        def generic_test(arbitration, expected):
+            requests, _ = self.prepare_testbench()
+            dut = _CommandChooser(requests, arbitration)
+
+            def process():
+                for i in range(10):
+                    yield requests[i].a.eq(i)
+                    yield requests[i].is_write.eq(1)
+                yield dut.want_writes.eq(1)
+
+                # Request #6 gets granted but is not accepted yet
+                yield requests[6].valid.eq(1)
+                yield; yield
+                yield requests[2].valid.eq(1)
+                yield; yield; yield
+                yield requests[7].valid.eq(1)
+                yield; yield Delay(1e-9)
+                self.assertEqual((yield dut.cmd.a), 6)
+
+                # Accept #6, #2 has been waiting longer than #7
+                yield dut.cmd.ready.eq(1)
+                yield requests[6].ready.eq(1)
+                yield
+                yield dut.cmd.ready.eq(0)
+                yield requests[6].ready.eq(0)
+                yield requests[6].valid.eq(0)
+                yield; yield Delay(1e-9)
+                self.assertEqual((yield dut.cmd.a), expected)
+
+            runSimulation(dut, process, "test_core_multiplexer_commandchooser.vcd")
+
+        generic_test("roundrobin", 7)
+        generic_test("oldest-first", 2)
+
+    def test_arbitration_value_error(self):
+        requests, _ = self.prepare_testbench()
+        with self.assertRaises(ValueError):
+            _CommandChooser(requests, "fifo")
+
 class SteererTestCase(FHDLTestCase):
     def test_nop(self):
         a = 12
@@ -170,6 +215,34 @@ class SteererTestCase(FHDLTestCase):
 
         runSimulation(dut, process, "test_core_multiplexer_steerer.vcd")
 
+    def test_refresh_ranks(self):
+        def generic_test(refresh_all_ranks, expected_cs):
+            a = 12
+            ba = 3 + 1
+
+            commands = [stream.Endpoint(cmd_request_rw_layout(a, ba)) for i in range(4)]
+            dfi = Interface(a, 3, 2, 8, nphases=2)
+            dut = _Steerer(commands, dfi, refresh_all_ranks=refresh_all_ranks)
+
+            def process():
+                yield dut.sel[0].eq(STEER_REFRESH)
+                yield dut.sel[1].eq(STEER_NOP)
+                yield commands[STEER_REFRESH].valid.eq(1)
+                yield commands[STEER_REFRESH].ready.eq(1)
+                yield commands[STEER_REFRESH].cas.eq(1)
+                yield commands[STEER_REFRESH].ras.eq(1)
+                yield commands[STEER_REFRESH].ba.eq(0b1000)
+                yield; yield Delay(1e-9)
+
+                self.assertTrue((yield dfi.phases[0].cas))
+                self.assertTrue((yield dfi.phases[0].ras))
+                self.assertEqual((yield dfi.phases[0].cs), expected_cs)
+
+            runSimulation(dut, process, "test_core_multiplexer_steerer.vcd")
+
+        generic_test(True, 0b11)
+        generic_test(False, 0b10)
+
 class AntiStarvationTestCase(FHDLTestCase):
     def test_duration(self):
         def generic_test(timeout):
@@ -197,3 +270,195 @@ class AntiStarvationTestCase(FHDLTestCase):
         generic_test(5)
         generic_test(10)
         generic_test(0x20)
+
+class MultiplexerTestCase(FHDLTestCase):
+    class FakeBankMachine:
+        def __init__(self, a, ba):
+            self.cmd = stream.Endpoint(cmd_request_rw_layout(a, ba))
+            self.refresh_req = Signal()
+            self.refresh_gnt = Signal()
+
+    class FakeRefresher:
+        def __init__(self, a, ba):
+            self.cmd = stream.Endpoint(cmd_request_rw_layout(a, ba))
+
+    def prepare_testbench(self, nranks=1, **kwargs):
+        settings = ControllerSettings(**kwargs)
+        settings.phy = PhySettings(phytype="ECP5DDRPHY", memtype="DDR3", databits=16, dfi_databits=32,
+            nphases=2, rdphase=1, wrphase=1, rdcmdphase=0, wrcmdphase=0, cl=6, cwl=5,
+            read_latency=10, write_latency=2, nranks=nranks)
+        settings.geom = GeomSettings(bankbits=3, rowbits=13, colbits=10)
+        settings.timing = TimingSettings(tRP=2, tRCD=2, tWR=2, tWTR=2, tREFI=64, tRFC=8, tFAW=None,
+            tCCD=2, tRRD=None, tRC=None, tRAS=None, tZQCS=None)
+
+        a = settings.geom.addressbits
+        ba = settings.geom.bankbits + log2_int(nranks)
+        bank_machines = [self.FakeBankMachine(a, ba) for n in range(2**ba)]
+        refresher = self.FakeRefresher(a, ba)
+        dfi = Interface(a, settings.geom.bankbits, nranks, settings.phy.dfi_databits, nphases=2)
+        interface = gramInterface(3, settings)
+        dut = Multiplexer(settings, bank_machines, refresher, dfi, interface)
+
+        return (bank_machines, refresher, dut)
+
+    def accepted(self, bank_machines):
+        # Bank machines whose command is accepted this cycle
+        accepted = []
+        for n, bm in enumerate(bank_machines):
+            if (yield bm.cmd.valid & bm.cmd.ready):
+                accepted.append(n)
+        return accepted
+
+    def traffic(self, bank_machines, traffic, cycles):
+        # Present the commands of each bank machine ({n: [(cycle, "R" or "W"), ...]}) in order, from
+        # their cycle on. Returns the kinds of the accepted commands, in order.
+        pending = {n: deque(cmds) for n, cmds in traffic.items()}
+        issued = ""
+        for cycle in range(cycles):
+            for n, cmds in pending.items():
+                bm = bank_machines[n]
+                valid = bool(cmds) and cmds[0][0] <= cycle
+                yield bm.cmd.valid.eq(valid)
+                if valid:
+                    write = cmds[0][1] == "W"
+                    yield bm.cmd.ba.eq(n)
+                    yield bm.cmd.cas.eq(1)
+                    yield bm.cmd.we.eq(write)
+                    yield bm.cmd.is_read.eq(not write)
+                    yield bm.cmd.is_write.eq(write)
+            yield Settle()
+            for n in (yield from self.accepted(bank_machines)):
+                issued += pending[n].popleft()[1]
+            yield
+        return issued
+
+    def warm_up(self, bank_machines, refresher):
+        # The read anti-starvation timer leaves reset expired, go through a refresh to reload it
+        for bm in bank_machines:
+            yield bm.refresh_gnt.eq(1)
+        yield refresher.cmd.valid.eq(1)
+        yield refresher.cmd.last.eq(1)
+        yield; yield
+        yield refresher.cmd.valid.eq(0)
+        yield refresher.cmd.last.eq(0)
+        yield
+
+    def test_write_high_watermark(self):
+        bank_machines, refresher, dut = self.prepare_testbench(
+            write_high_watermark=4, write_low_watermark=1, rw_min_burst=1, read_time=128, write_time=128)
+
+        def process():
+            yield from self.warm_up(bank_machines, refresher)
+            traffic = {n: [(0, "R")]*100 for n in [0, 1]}
+            traffic.update({n: [(0, "W")] for n in [2, 3, 4]})
+            traffic[5] = [(32, "W")]
+
+            # 3 pending writes: reads go on, then a 4th write reaches the high watermark and writes
+            # are drained down to the low watermark
+            issued = yield from self.traffic(bank_machines, traffic, 64)
+            self.assertEqual(issued[:16], "R"*16)
+            self.assertRegex(issued, r"^R*WWWR+$")
+
+        runSimulation(dut, process, "test_core_multiplexer.vcd")
+
+    def test_write_low_watermark(self):
+        bank_machines, refresher, dut = self.prepare_testbench(
+            write_high_watermark=4, write_low_watermark=2, rw_min_burst=1, read_time=128, write_time=128)
+
+        def process():
+            yield from self.warm_up(bank_machines, refresher)
+            traffic = {n: [(0, "R")]*100 for n in [0, 1]}
+            traffic.update({n: [(0, "W")] for n in range(2, 8)})
+
+            # Draining stops once 2 writes are pending, they are held back under the high watermark
+            issued = yield from self.traffic(bank_machines, traffic, 64)
+            self.assertRegex(issued, r"^RWWWWR+$")
+
+        runSimulation(dut, process, "test_core_multiplexer.vcd")
+
+    def test_min_burst(self):
+        def generic_test(min_burst, expected):
+            bank_machines, refresher, dut = self.prepare_testbench(
+                write_high_watermark=4, write_low_watermark=3, rw_min_burst=min_burst, read_time=128, write_time=128)
+
+            def process():
+                yield from self.warm_up(bank_machines, refresher)
+                traffic = {n: [(0, "R")]*100 for n in [0, 1]}
+                traffic.update({n: [(0, "W")] for n in range(2, 8)})
+
+                issued = yield from self.traffic(bank_machines, traffic, 64)
+                self.assertRegex(issued, expected)
+
+            runSimulation(dut, process, "test_core_multiplexer.vcd")
+
+        # Watermarks are crossed from the start, turnarounds wait for min_burst commands
+        generic_test(1, r"^RWWWR+$")
+        generic_test(4, r"^RRRRWWWWR+$")
+
+    def test_staggered_refresh(self):
+        bank_machines, refresher, dut = self.prepare_testbench(nranks=2, refresh_staggered=True)
+
+        def process():
+            # Refresh of rank 0, only granted by its bank machines
+            yield refresher.cmd.valid.eq(1)
+            yield refresher.cmd.ba.eq(0b0000)
+            for bm in bank_machines[:8]:
+                yield bm.refresh_gnt.eq(1)
+            yield Settle()
+            self.assertEqual((yield Cat(bm.refresh_req for bm in bank_machines)), 0x00ff)
+
+            # A bank machine of rank 1 is held back during the refresh
+            bm = bank_machines[8]
+            yield bm.cmd.ba.eq(8)
+            yield bm.cmd.valid.eq(1)
+            yield bm.cmd.is_read.eq(1)
+            yield bm.cmd.cas.eq(1)
+            for cycle in range(8):
+                yield
+                yield Settle()
+                self.assertTrue((yield refresher.cmd.ready))
+                self.assertFalse((yield bm.cmd.ready))
+
+            yield refresher.cmd.last.eq(1)
+            yield
+            yield refresher.cmd.valid.eq(0)
+            yield refresher.cmd.last.eq(0)
+            for cycle in range(8):
+                yield
+                yield Settle()
+                if (yield bm.cmd.ready):
+                    break
+            else:
+                self.fail("Command not accepted after the refresh")
+
+        runSimulation(dut, process, "test_core_multiplexer.vcd")
+
+    def test_rank_switch(self):
+        def generic_test(bms, expected_gap):
+            bank_machines, refresher, dut = self.prepare_testbench(nranks=2)
+
+            def process():
+                for n in bms:
+                    yield bank_machines[n].cmd.ba.eq(n)
+                    yield bank_machines[n].cmd.valid.eq(1)
+                    yield bank_machines[n].cmd.is_read.eq(1)
+                    yield bank_machines[n].cmd.cas.eq(1)
+
+                cycles = []
+                for cycle in range(32):
+                    yield Settle()
+                    if (yield from self.accepted(bank_machines)):
+                        cycles.append(cycle)
+                    yield
+
+                gaps = [b - a for a, b in zip(cycles, cycles[1:])]
+                self.assertGreater(len(gaps), 4)
+                self.assertEqual(set(gaps), {expected_gap})
+
+            runSimulation(dut, process, "test_core_multiplexer.vcd")
+
+        # Banks 0 and 1 of rank 0: reads are tCCD apart
+        generic_test([0, 1], 2)
+        # Bank 0 of ranks 0 and 1: reads alternate between ranks and wait tRTRS
+        # (tCCD + 2 DRAM clock cycles)
+        generic_test([0, 8], 3)
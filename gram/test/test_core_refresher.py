@@ -1,8 +1,10 @@
+import copy
+
 from nmigen import *
 from nmigen.hdl.ast import Past
 from nmigen.asserts import Assert, Assume
 
-from gram.core.refresher import RefreshExecuter, RefreshSequencer, RefreshTimer, RefreshPostponer, Refresher, ZQCSExecuter
+from gram.core.refresher import RefreshExecuter, RefreshSequencer, RefreshTimer, RefreshPostponer, RefreshScheduler, Refresher, ZQCSExecuter
 from gram.compat import *
 from gram.test.utils import *
 
@@ -31,6 +33,36 @@ class RefreshSequencerTestCase(FHDLTestCase):
         dut = RefreshSequencer(abits=14, babits=3, trp=trp, trfc=trfc, postponing=1)
         self.assertFormal(dut, mode="bmc", depth=trp+trfc+1)
 
+    def test_sequence(self):
+        def generic_test(trp, trfc, postponing):
+            dut = RefreshSequencer(abits=14, babits=3, trp=trp, trfc=trfc, postponing=postponing)
+
+            def process():
+                refs = []
+                yield dut.start.eq(1)
+                yield
+                yield dut.start.eq(0)
+                for cycle in range(postponing*(trp + trfc + 2)):
+                    yield Delay(1e-9)
+                    if (yield Cat(dut.cas, dut.ras, dut.we)) == 0b011:
+                        refs.append(cycle)
+                    if (yield dut.done):
+                        break
+                    yield
+                else:
+                    self.fail("Sequence not done")
+
+                # Precharge All and Auto Refresh every tRP + tRFC + 2 cycles, done tRFC after the last
+                # Auto Refresh
+                self.assertEqual(refs, [trp + i*(trp + trfc + 2) for i in range(postponing)])
+                self.assertEqual(cycle, refs[-1] + trfc)
+
+            runSimulation(dut, process, "test_refreshsequencer.vcd")
+
+        generic_test(1, 2, 1)
+        generic_test(1, 2, 4)
+        generic_test(5, 5, 8)
+
 class RefreshTimerTestCase(FHDLTestCase):
     def test_formal(self):
         def generic_test(tREFI):
@@ -38,6 +70,32 @@ class RefreshTimerTestCase(FHDLTestCase):
             self.assertFormal(dut, mode="bmc", depth=tREFI+1)
         [generic_test(_) for _ in [2, 5, 10]]
 
+    def test_runtime_period(self):
+        def generic_test(trefi, period):
+            dut = RefreshTimer(trefi, 2*trefi)
+
+            def process():
+                yield dut.trefi.eq(period)
+                yield dut.wait.eq(1)
+
+                # New period is taken into account on the next reload
+                while not (yield dut.done):
+                    yield
+                yield dut.wait.eq(0)
+                yield
+                yield dut.wait.eq(1)
+
+                for i in range(period-1):
+                    yield
+                    self.assertFalse((yield dut.done))
+                yield
+                self.assertTrue((yield dut.done))
+
+            runSimulation(dut, process, "test_core_refresher_refreshtimer.vcd")
+
+        generic_test(10, 5)
+        generic_test(10, 20)
+
 class RefreshPostponerTestCase(FHDLTestCase):
     def test_init(self):
         dut = RefreshPostponer(1)
@@ -85,6 +143,104 @@ class RefreshPostponerTestCase(FHDLTestCase):
 
         [generic_test(_) for _ in [1, 5, 10]]
 
+    def test_count(self):
+        dut = RefreshPostponer(4, 8)
+
+        def process():
+            counts = []
+            yield dut.req_i.eq(1)
+            for tick in range(12):
+                # Lowered after 2 postponed requests, raised after a generated one
+                if tick == 6:
+                    yield dut.postponing.eq(1)
+                if tick == 7:
+                    yield dut.postponing.eq(3)
+                yield; yield Delay(1e-9)
+                if (yield dut.req_o):
+                    counts.append((tick, (yield dut.count)))
+
+            self.assertEqual(counts, [(3, 4), (6, 3), (9, 3)])
+
+        runSimulation(dut, process, "test_refreshpostponer.vcd")
+
+class RefreshSchedulerTestCase(FHDLTestCase):
+    def test_postpone(self):
+        def generic_test(postponing):
+            dut = RefreshScheduler(postponing=postponing, pullin=8)
+
+            def process():
+                for i in range(postponing):
+                    self.assertFalse((yield dut.req_o))
+                    yield dut.tick.eq(1)
+                    yield
+                    yield dut.tick.eq(0)
+                    yield; yield Delay(1e-9)
+
+                self.assertTrue((yield dut.req_o))
+
+                yield dut.done.eq(1)
+                yield
+                yield dut.done.eq(0)
+                yield; yield Delay(1e-9)
+                self.assertFalse((yield dut.req_o))
+
+            runSimulation(dut, process, "test_core_refresher_refreshscheduler.vcd")
+
+        [generic_test(_) for _ in [1, 4, 8]]
+
+    def test_pullin(self):
+        def generic_test(pullin):
+            dut = RefreshScheduler(postponing=8, pullin=pullin)
+
+            def process():
+                yield dut.idle.eq(1)
+                for i in range(pullin):
+                    yield Delay(1e-9)
+                    self.assertTrue((yield dut.req_o))
+                    yield dut.done.eq(1)
+                    yield
+                    yield dut.done.eq(0)
+                    yield
+
+                yield Delay(1e-9)
+                self.assertFalse((yield dut.req_o))
+                self.assertEqual((yield dut.debt), -pullin)
+
+            runSimulation(dut, process, "test_core_refresher_refreshscheduler.vcd")
+
+        [generic_test(_) for _ in [0, 1, 8]]
+
+    def test_urgent(self):
+        dut = RefreshScheduler(postponing=8, pullin=8)
+
+        def process():
+            # Ticks are not dropped beyond the 8 refreshes that can be postponed
+            for i in range(10):
+                yield dut.tick.eq(1)
+                yield
+            yield dut.tick.eq(0)
+            yield; yield Delay(1e-9)
+            self.assertEqual((yield dut.debt), 10)
+            self.assertTrue((yield dut.urgent))
+
+            # Urgent as long as 8 refreshes are still owed after the current one
+            for urgent in [True, True, False]:
+                yield dut.done.eq(1)
+                yield Delay(1e-9)
+                self.assertEqual((yield dut.urgent), urgent)
+                yield
+                yield dut.done.eq(0)
+                yield
+            self.assertEqual((yield dut.debt), 7)
+
+        runSimulation(dut, process, "test_core_refresher_refreshscheduler.vcd")
+
+    def test_value_error(self):
+        with self.assertRaises(ValueError):
+            RefreshScheduler(postponing=9)
+        with self.assertRaises(ValueError):
+            RefreshScheduler(pullin=9)
+
 class RefresherTestCase(FHDLTestCase):
     class Obj:
         pass
@@ -114,6 +270,169 @@ class RefresherTestCase(FHDLTestCase):
 
         [generic_test(_) for _ in [1, 2, 4, 8]]
 
+    def test_runtime_postponing(self):
+        settings = copy.deepcopy(self.settings)
+        settings.timing.tZQCS = None
+        trefi = settings.timing.tREFI
+        dut = Refresher(settings, 100e6, postponing=1)
+
+        def process():
+            bursts = []
+            refs = 0
+            yield dut.cmd.ready.eq(1)
+            for cycle in range(20*trefi):
+                if cycle == 3*trefi + trefi//2:
+                    yield dut.postponing.eq(4)
+                if cycle == 9*trefi + trefi//2:
+                    yield dut.postponing.eq(2)
+                yield Delay(1e-9)
+                if (yield dut.cmd.valid):
+                    if (yield Cat(dut.cmd.cas, dut.cmd.ras, dut.cmd.we)) == 0b011:
+                        refs += 1
+                if (yield dut.cmd.last):
+                    bursts.append((cycle//trefi, refs))
+                    refs = 0
+                yield
+
+            # A burst of `postponing` refreshes every `postponing` periods. When postponing is
+            # lowered, the refreshes already postponed are all issued in the next burst.
+            self.assertEqual(bursts, [(1, 1), (2, 1), (3, 1), (7, 4), (10, 3), (12, 2), (14, 2),
+                                      (16, 2), (18, 2)])
+
+        runSimulation(dut, process, "test_refresher.vcd")
+
+    def test_enable(self):
+        settings = copy.deepcopy(self.settings)
+        settings.timing.tZQCS = None
+        trefi = settings.timing.tREFI
+        dut = Refresher(settings, 100e6)
+
+        def process():
+            refs = []
+            yield dut.cmd.ready.eq(1)
+            yield dut.enable.eq(0)
+            for cycle in range(8*trefi):
+                if cycle == 4*trefi + trefi//2:
+                    yield dut.enable.eq(1)
+                yield Delay(1e-9)
+                if (yield dut.cmd.valid):
+                    if (yield Cat(dut.cmd.cas, dut.cmd.ras, dut.cmd.we)) == 0b011:
+                        refs.append(cycle//trefi)
+                yield
+
+            # No refresh while disabled, then one per period
+            self.assertEqual(refs, [5, 6, 7])
+
+        runSimulation(dut, process, "test_refresher.vcd")
+
+    def test_tracking(self):
+        dut = Refresher(self.settings, 100e6, track_interval=3)
+
+        def process():
+            refreshes = 0
+            tracked = []
+            yield dut.cmd.ready.eq(1)
+            while refreshes < 7:
+                yield Delay(1e-9)
+                if (yield dut.track_req):
+                    self.assertTrue((yield dut.cmd.valid))
+                    self.assertFalse((yield dut.cmd.last))
+                    tracked.append(refreshes)
+                    for i in range(5):
+                        yield; yield Delay(1e-9)
+                        self.assertTrue((yield dut.track_req))
+                        self.assertTrue((yield dut.cmd.valid))
+                    yield dut.track_done.eq(1)
+                    yield Delay(1e-9)
+                if (yield dut.cmd.last):
+                    refreshes += 1
+                yield
+                yield dut.track_done.eq(0)
+
+            # Tracking happens after the 3rd and 6th refreshes, before releasing the controller
+            self.assertEqual(tracked, [2, 5])
+
+        runSimulation(dut, process, "test_refresher.vcd")
+
+    def test_staggered(self):
+        settings = copy.deepcopy(self.settings)
+        settings.phy.nranks = 2
+        settings.timing.tZQCS = None
+        dut = Refresher(settings, 100e6, staggered=True)
+
+        def process():
+            commands = []
+            yield dut.cmd.ready.eq(1)
+            while len(commands) < 8:
+                yield Delay(1e-9)
+                if (yield dut.cmd.valid):
+                    cmd = (yield Cat(dut.cmd.cas, dut.cmd.ras, dut.cmd.we))
+                    if cmd:
+                        commands.append((cmd, (yield dut.cmd.ba[-1])))
+                yield
+
+            # Each refresh is a single Precharge All followed by a single Auto Refresh, alternating
+            # between ranks every tREFI/2
+            prea = 0b110
+            ref = 0b011
+            self.assertEqual(commands, [(prea, 0), (ref, 0), (prea, 1), (ref, 1)]*2)
+
+        runSimulation(dut, process, "test_refresher.vcd")
+
+    def test_zqcs(self):
+        # ZQCS once per tREFI
+        settings = copy.deepcopy(self.settings)
+        settings.timing.tRP = 2
+        settings.timing.tZQCS = 4
+        trefi = settings.timing.tREFI
+        dut = Refresher(settings, clk_freq=trefi, zqcs_freq=1)
+
+        def process():
+            commands = []
+            yield dut.cmd.ready.eq(1)
+            for cycle in range(4*trefi):
+                yield Delay(1e-9)
+                if (yield dut.cmd.valid):
+                    cmd = (yield Cat(dut.cmd.cas, dut.cmd.ras, dut.cmd.we))
+                    if cmd:
+                        commands.append(cmd)
+                yield
+
+            # Each period is a single refresh followed by a single ZQ Short Calibration
+            prea = 0b110
+            ref = 0b011
+            zqcs = 0b100
+            self.assertEqual(commands, [prea, ref, prea, zqcs]*3)
+
+        runSimulation(dut, process, "test_refresher.vcd")
+
+    def test_stalled(self):
+        settings = copy.deepcopy(self.settings)
+        settings.timing.tZQCS = None
+        trefi = settings.timing.tREFI
+        dut = Refresher(settings, 100e6, postponing=1, opportunistic=True)
+
+        def process():
+            refs = []
+            grants = 0
+            # The controller is busy and does not grant refreshes for 10 periods
+            for cycle in range(13*trefi):
+                yield dut.cmd.ready.eq(cycle >= 10*trefi)
+                yield Delay(1e-9)
+                if (yield dut.cmd.valid & dut.cmd.ready):
+                    if (yield Cat(dut.cmd.cas, dut.cmd.ras, dut.cmd.we)) == 0b011:
+                        refs.append(grants)
+                if (yield dut.cmd.last):
+                    grants += 1
+                yield
+
+            # One refresh per period, the ones owed beyond the 8 that can be postponed are done
+            # back to back in the first grant
+            self.assertEqual(len(refs), 12)
+            self.assertEqual(refs[:4], [0, 0, 0, 1])
+
+        runSimulation(dut, process, "test_refresher.vcd")
+
 class ZQCSExecuterTestCase(FHDLTestCase):
     abits = 12
     babits = 3
@@ -129,24 +448,30 @@ class ZQCSExecuterTestCase(FHDLTestCase):
             yield dut.start.eq(0)
             yield
 
-            # Check for Precharge ALL command
-            for i in range(self.trp):
-                self.assertEqual((yield dut.a), 2**10)
-                self.assertEqual((yield dut.ba), 0)
-                self.assertFalse((yield dut.cas))
-                self.assertTrue((yield dut.ras))
-                self.assertTrue((yield dut.we))
-                self.assertFalse((yield dut.done))
+            # Check for Precharge ALL command, for one cycle
+            self.assertEqual((yield dut.a), 2**10)
+            self.assertEqual((yield dut.ba), 0)
+            self.assertFalse((yield dut.cas))
+            self.assertTrue((yield dut.ras))
+            self.assertTrue((yield dut.we))
+            self.assertFalse((yield dut.done))
+            for i in range(self.trp - 1):
                 yield
-
-            # Check for ZQCS command
-            for i in range(self.tzqcs):
-                self.assertFalse((yield dut.a[10]))
-                self.assertFalse((yield dut.cas))
-                self.assertFalse((yield dut.ras))
-                self.assertTrue((yield dut.we))
+                self.assertFalse((yield Cat(dut.cas, dut.ras, dut.we)))
                 self.assertFalse((yield dut.done))
+            yield
+
+            # Check for ZQCS command, for one cycle
+            self.assertFalse((yield dut.a[10]))
+            self.assertFalse((yield dut.cas))
+            self.assertFalse((yield dut.ras))
+            self.assertTrue((yield dut.we))
+            self.assertFalse((yield dut.done))
+            for i in range(self.tzqcs - 1):
                 yield
+                self.assertFalse((yield Cat(dut.cas, dut.ras, dut.we)))
+                self.assertFalse((yield dut.done))
+            yield
 
             self.assertTrue((yield dut.done))
 
@@ -169,3 +169,121 @@ class DFIInjectorTestCase(FHDLTestCase):
             self.assertFalse((yield dut.master.phases[0].reset))
 
         runSimulation(m, process, "test_dfiinjector.vcd")
+
+class MockCSR:
+    def __init__(self, width):
+        self.r_stb = Signal()
+        self.r_data = Signal(width)
+        self.w_stb = Signal()
+        self.w_data = Signal(width)
+
+class MockCSRBank:
+    def __init__(self):
+        self.csrs = []
+
+    def csr(self, width, access, **kwargs):
+        self.csrs.append(MockCSR(width))
+        return self.csrs[-1]
+
+class CommandListPlayerTestCase(FHDLTestCase):
+    def write_csr(self, csr, value):
+        yield csr.w_data.eq(value)
+        yield csr.w_stb.eq(1)
+        yield
+        yield csr.w_stb.eq(0)
+
+    def test_playback(self):
+        bank = MockCSRBank()
+        dut = CommandListPlayer(bank, addressbits=14, bankbits=3, nranks=1, databits=16, nphases=2, depth=8)
+        addr_csr, cmd_csr, address_csr, start_csr, status_csr = bank.csrs
+
+        # (phase, command, wait, address, bank)
+        entries = [
+            (0, 0b001111, 2, 0x200, 2), # MRS
+            (1, 0b001011, 0, 0x400, 0), # ZQCL
+            (1, 0b000101, 0, 0x010, 5), # Read
+        ]
+
+        def process():
+            yield from self.write_csr(addr_csr, 0)
+            for phase, command, wait, address, bankaddr in entries:
+                yield from self.write_csr(cmd_csr, command | (phase << 6) | (wait << 8))
+                yield from self.write_csr(address_csr, address | (bankaddr << 14))
+
+            yield from self.write_csr(start_csr, len(entries))
+
+            issued = []
+            for cycle in range(10):
+                yield Delay(1e-9)
+                for n, p in enumerate(dut.dfi.phases):
+                    if (yield p.cs):
+                        command = ((yield p.cs) | ((yield p.we) << 1) | ((yield p.cas) << 2) |
+                                   ((yield p.ras) << 3))
+                        issued.append((cycle, n, command, (yield p.address), (yield p.bank)))
+                yield
+
+            self.assertEqual(issued, [
+                (0, 0, 0b1111, 0x200, 2),
+                (3, 1, 0b1011, 0x400, 0),
+                (4, 1, 0b0101, 0x010, 5),
+            ])
+            self.assertFalse((yield dut.busy))
+
+        runSimulation(dut, process, "test_dfii_commandlistplayer.vcd")
+
+    def test_length(self):
+        bank = MockCSRBank()
+        dut = CommandListPlayer(bank, addressbits=14, bankbits=3, nranks=1, databits=16, nphases=2, depth=8)
+        addr_csr, cmd_csr, address_csr, start_csr, status_csr = bank.csrs
+
+        def play(length):
+            yield from self.write_csr(start_csr, length)
+            issued = 0
+            for cycle in range(32):
+                yield Delay(1e-9)
+                issued += (yield dut.dfi.phases[0].cs)
+                yield
+            self.assertFalse((yield dut.busy))
+            return issued
+
+        def process():
+            # Precharge All on every entry
+            yield from self.write_csr(addr_csr, 0)
+            for i in range(8):
+                yield from self.write_csr(cmd_csr, 0b001011)
+                yield from self.write_csr(address_csr, 0x400)
+
+            # Lengths above the depth are ignored, they would never complete
+            self.assertEqual((yield from play(9)), 0)
+            self.assertEqual((yield from play(15)), 0)
+            self.assertEqual((yield from play(8)), 8)
+
+        runSimulation(dut, process, "test_dfii_commandlistplayer.vcd")
+
+class ReadCaptureFIFOTestCase(FHDLTestCase):
+    def test_capture(self):
+        bank = MockCSRBank()
+        dfi = Interface(12, 3, 1, 16, 1)
+        dut = ReadCaptureFIFO(bank, dfi.phases[0], depth=4)
+        data_csr, level_csr = bank.csrs
+
+        def process():
+            # Burst of read data beats, the last one doesn't fit
+            for value in [0x1111, 0x2222, 0x3333, 0x4444, 0x5555]:
+                yield dfi.phases[0].rddata.eq(value)
+                yield dfi.phases[0].rddata_valid.eq(1)
+                yield
+            yield dfi.phases[0].rddata_valid.eq(0)
+            yield; yield Delay(1e-9)
+            self.assertEqual((yield level_csr.r_data), 4)
+
+            for value in [0x1111, 0x2222, 0x3333, 0x4444]:
+                self.assertEqual((yield data_csr.r_data), value)
+                yield data_csr.r_stb.eq(1)
+                yield
+                yield data_csr.r_stb.eq(0)
+                yield; yield Delay(1e-9)
+
+            self.assertEqual((yield level_csr.r_data), 0)
+
+        runSimulation(dut, process, "test_dfii_readcapturefifo.vcd")
@@ -0,0 +1,66 @@
+from nmigen import *
+
+from gram.common import PhySettings
+from gram.modules import MT41K256M16
+from gram.init import get_ddr3_mode_registers, InitSequencer
+from gram.test.utils import *
+
+class ModeRegistersTestCase(FHDLTestCase):
+    def test_libgram_defaults(self):
+        # ECP5DDRPHY at 100MHz with the default libgram profile
+        phy_settings = PhySettings(phytype="ECP5DDRPHY", memtype="DDR3", databits=16, dfi_databits=64,
+            nphases=2, rdphase=0, wrphase=1, rdcmdphase=1, wrcmdphase=0, cl=6, cwl=5,
+            read_latency=12, write_latency=3)
+        module = MT41K256M16(100e6, "1:2")
+
+        mrs = get_ddr3_mode_registers(phy_settings, module.timing_settings)
+        self.assertEqual(mrs, [0x320, 0x6, 0x200, 0])
+
+    def test_termination(self):
+        phy_settings = PhySettings(phytype="ECP5DDRPHY", memtype="DDR3", databits=16, dfi_databits=64,
+            nphases=2, rdphase=0, wrphase=1, rdcmdphase=1, wrcmdphase=0, cl=6, cwl=5,
+            read_latency=12, write_latency=3)
+        module = MT41K256M16(100e6, "1:2")
+
+        mrs = get_ddr3_mode_registers(phy_settings, module.timing_settings, ron=40, rtt_nom=None, rtt_wr=None)
+        self.assertEqual(mrs[1], 0)
+        self.assertEqual(mrs[2], 0)
+
+class InitSequencerTestCase(FHDLTestCase):
+    def test_sequence(self):
+        clk_freq = 1e6
+        dut = InitSequencer(addressbits=14, bankbits=3, nranks=1, databits=32, nphases=2,
+            clk_freq=clk_freq, mode_registers=[0x320, 0x6, 0x200, 0], trfc=1)
+
+        def process():
+            phase = dut.dfi.phases[0]
+            commands = []
+            cycle = 0
+            cke_cycle = None
+            reset_cycle = None
+
+            while not (yield dut.done):
+                self.assertFalse((yield phase.odt))
+                if reset_cycle is None and not (yield phase.reset):
+                    reset_cycle = cycle
+                if cke_cycle is None and (yield phase.clk_en):
+                    cke_cycle = cycle
+                if (yield phase.cs):
+                    commands.append(((yield phase.ras), (yield phase.cas), (yield phase.we),
+                                     (yield phase.bank), (yield phase.address)))
+                yield
+                cycle += 1
+
+            # RESET# held 200us, CKE low for 500us more
+            self.assertGreaterEqual(reset_cycle, 200e-6*clk_freq)
+            self.assertGreaterEqual(cke_cycle - reset_cycle, 500e-6*clk_freq)
+
+            self.assertEqual(commands, [
+                (1, 1, 1, 2, 0x200),
+                (1, 1, 1, 3, 0),
+                (1, 1, 1, 1, 0x6),
+                (1, 1, 1, 0, 0x320),
+                (0, 0, 1, 0, 0x400),
+            ])
+
+        runSimulation(dut, process, "test_init.vcd")
@@ -0,0 +1,76 @@
+from nmigen import *
+
+from gram.phy.dfi import Interface, Pipeline, ReadLatencyMeter
+from gram.test.utils import *
+
+class PipelineTestCase(FHDLTestCase):
+    def test_latency(self):
+        def generic_test(stages):
+            dut = Pipeline(addressbits=14, bankbits=3, nranks=1, databits=32, nphases=2, stages=stages)
+
+            def process():
+                yield dut.sink.phases[1].address.eq(0x1234)
+                yield dut.sink.phases[1].wrdata.eq(0xcafe)
+                yield dut.source.phases[0].rddata.eq(0xbeef)
+                yield Delay(1e-9)
+
+                for i in range(stages):
+                    self.assertEqual((yield dut.source.phases[1].address), 0)
+                    self.assertEqual((yield dut.source.phases[1].wrdata), 0)
+                    self.assertEqual((yield dut.sink.phases[0].rddata), 0)
+                    yield; yield Delay(1e-9)
+
+                self.assertEqual((yield dut.source.phases[1].address), 0x1234)
+                self.assertEqual((yield dut.source.phases[1].wrdata), 0xcafe)
+                self.assertEqual((yield dut.sink.phases[0].rddata), 0xbeef)
+
+            runSimulation(dut, process, "test_phy_dfi.vcd")
+
+        [generic_test(_) for _ in [1, 3]]
+
+    def test_reset_value(self):
+        dut = Pipeline(addressbits=14, bankbits=3, nranks=1, databits=32, nphases=2, stages=2)
+
+        def process():
+            # DRAM reset must stay asserted until driven by the master
+            self.assertTrue((yield dut.source.phases[0].reset))
+            yield dut.sink.phases[0].reset.eq(0)
+            yield; yield; yield Delay(1e-9)
+            self.assertFalse((yield dut.source.phases[0].reset))
+
+        runSimulation(dut, process, "test_phy_dfi.vcd")
+
+class ReadLatencyMeterTestCase(FHDLTestCase):
+    def test_latency(self):
+        dfi = Interface(addressbits=14, bankbits=3, nranks=1, databits=32, nphases=2)
+        dut = ReadLatencyMeter(dfi, max_latency=16)
+
+        def read(latency):
+            yield dfi.phases[1].rddata_en.eq(1)
+            yield
+            yield dfi.phases[1].rddata_en.eq(0)
+            for i in range(latency-1):
+                yield
+            yield dfi.phases[0].rddata_valid.eq(1)
+            yield
+            yield dfi.phases[0].rddata_valid.eq(0)
+            yield
+
+        def process():
+            self.assertEqual((yield dut.latency), 0)
+            yield from read(9)
+            self.assertEqual((yield dut.latency), 9)
+            yield from read(7)
+            self.assertEqual((yield dut.latency), 7)
+
+            # No read data: the measurement is abandoned
+            yield dfi.phases[1].rddata_en.eq(1)
+            yield
+            yield dfi.phases[1].rddata_en.eq(0)
+            for i in range(20):
+                yield
+            self.assertEqual((yield dut.latency), 7)
+            yield from read(3)
+            self.assertEqual((yield dut.latency), 3)
+
+        runSimulation(dut, process, "test_phy_dfi.vcd")
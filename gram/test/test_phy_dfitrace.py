@@ -0,0 +1,290 @@
+import io
+
+from nmigen import *
+from nmigen.sim import Simulator
+
+from gram.common import PhySettings
+from gram.modules import MT41K256M16
+from gram.phy.dfi import Interface
+from gram.phy.dfitrace import *
+from gram.phy.fakephy import FakePHY
+from gram.test.utils import *
+
+class DFIMonitorTestCase(FHDLTestCase):
+    def test_commands(self):
+        dfi = Interface(addressbits=14, bankbits=3, nranks=1, databits=32, nphases=2)
+        monitor = DFIMonitor(dfi)
+        m = Module()
+        m.domains.sync = ClockDomain("sync")
+        m.d.sync += Signal().eq(1)
+
+        def process():
+            yield
+            # ACT on phase 1
+            yield dfi.phases[1].cs.eq(1)
+            yield dfi.phases[1].ras.eq(1)
+            yield dfi.phases[1].bank.eq(5)
+            yield dfi.phases[1].address.eq(0x123)
+            yield
+            yield dfi.phases[1].cs.eq(0)
+            yield dfi.phases[1].ras.eq(0)
+            yield
+            # NOP is not recorded, then RD on phase 0
+            yield dfi.phases[0].cs.eq(1)
+            yield
+            yield dfi.phases[0].cas.eq(1)
+            yield dfi.phases[0].bank.eq(5)
+            yield dfi.phases[0].address.eq(0x8)
+            yield
+            yield dfi.phases[0].cs.eq(0)
+            yield
+
+        sim = Simulator(m)
+        sim.add_clock(1e-8)
+        sim.add_sync_process(monitor.process)
+        sim.add_sync_process(process)
+        sim.run()
+
+        self.assertEqual(monitor.commands, [
+            DFICommand(1, 1, "ACT", 5, 0x123),
+            DFICommand(4, 0, "RD", 5, 0x8),
+        ])
+
+class TraceFileTestCase(FHDLTestCase):
+    def test_roundtrip(self):
+        commands = [
+            DFICommand(10, 0, "ACT", 1, 0x1234),
+            DFICommand(13, 1, "WR", 1, 0x10),
+            DFICommand(20, 0, "PRE", 0, 0x400),
+        ]
+        f = io.StringIO()
+        write_trace(commands, f)
+        f.seek(0)
+        self.assertEqual(list(read_trace(f)), commands)
+
+class BinaryTraceTestCase(FHDLTestCase):
+    def test_roundtrip(self):
+        records = [
+            DFIRecord(3,    1, 1, 1, 0, 0, 0, 0, 5, 0x1234),
+            DFIRecord(5,    0, 1, 0, 1, 1, 0, 0, 5, 0x10),
+            DFIRecord(6,    1, 0, 0, 0, 0, 0, 1, 0, 0),
+            DFIRecord(1000, 0, 1, 1, 0, 1, 0, 0, 0, 0x400),
+        ]
+        f = io.BytesIO()
+        write_binary_trace(records, f, nphases=2)
+        self.assertEqual(list(read_binary_trace(f.getvalue())), records)
+        # 3 bytes of header, 2 to 5 bytes per record
+        self.assertEqual(len(f.getvalue()), 7 + 5 + 4 + 2 + 6)
+        self.assertEqual(list(record_commands(records)), [
+            DFICommand(3,    1, "ACT", 5, 0x1234),
+            DFICommand(5,    0, "WR",  5, 0x10),
+            DFICommand(1000, 0, "PRE", 0, 0x400),
+        ])
+
+    def test_chunks(self):
+        records = [DFIRecord(i*200, i % 2, 1, 0, 1, i % 3 == 0, 0, 0, i % 8, i*0x1234)
+                   for i in range(100)]
+        f = io.BytesIO()
+        write_binary_trace(records, f, nphases=2)
+        for chunk_size in (1, 3, 64):
+            f.seek(0)
+            self.assertEqual(list(read_binary_trace(f, chunk_size=chunk_size)), records)
+
+        # The trace is read as records are consumed
+        f.seek(0)
+        reader = read_binary_trace(f, chunk_size=64)
+        self.assertEqual(next(reader), records[0])
+        self.assertEqual(f.tell(), 64)
+
+    def test_bad_magic(self):
+        with self.assertRaises(ValueError):
+            list(read_binary_trace(b"DFIC\x01\x02\x01"))
+
+    def test_truncated(self):
+        f = io.BytesIO()
+        write_binary_trace([DFIRecord(3, 1, 1, 1, 0, 0, 0, 0, 5, 0x1234)], f, nphases=2)
+        with self.assertRaises(ValueError):
+            list(read_binary_trace(f.getvalue()[:-1]))
+        with self.assertRaises(ValueError):
+            list(read_binary_trace(f.getvalue()[:6]))
+
+    def test_record(self):
+        dfi = Interface(addressbits=14, bankbits=3, nranks=2, databits=32, nphases=2)
+        f = io.BytesIO()
+        recorder = DFITraceRecorder(dfi, f)
+        monitor = DFIMonitor(dfi)
+        m = Module()
+        m.domains.sync = ClockDomain("sync")
+        m.d.sync += Signal().eq(1)
+
+        def process():
+            yield
+            yield dfi.phases[1].cs.eq(0b11)
+            yield dfi.phases[1].ras.eq(1)
+            yield dfi.phases[1].bank.eq(5)
+            yield dfi.phases[1].address.eq(0x123)
+            yield
+            yield dfi.phases[1].cs.eq(0)
+            yield dfi.phases[1].ras.eq(0)
+            yield dfi.phases[0].rddata_en.eq(1)
+            yield
+            yield dfi.phases[0].rddata_en.eq(0)
+            yield
+
+        sim = Simulator(m)
+        sim.add_clock(1e-8)
+        sim.add_sync_process(recorder.process)
+        sim.add_sync_process(monitor.process)
+        sim.add_sync_process(process)
+        sim.run()
+
+        records = list(read_binary_trace(f.getvalue()))
+        self.assertEqual(records, [
+            DFIRecord(1, 1, 0b11, 1, 0, 0, 0, 0, 5, 0x123),
+            DFIRecord(2, 0, 0, 0, 0, 0, 1, 0, 0, 0),
+        ])
+        self.assertEqual(list(record_commands(records)), monitor.commands)
+
+    def test_replay(self):
+        settings = PhySettings(phytype="ECP5DDRPHY", memtype="DDR3", databits=16, dfi_databits=32,
+            nphases=2, rdphase=0, wrphase=1, rdcmdphase=1, wrcmdphase=0, cl=6, cwl=5,
+            read_latency=4, write_latency=1)
+        phy = FakePHY(MT41K256M16(100e6, "1:2"), settings, behavioural=True)
+        m = Module()
+        m.domains.sync = ClockDomain("sync")
+        m.submodules.phy = phy
+
+        # ACT, WR then RD of row 7, column 8 of bank 2, write data on both phases
+        f = io.BytesIO()
+        write_binary_trace([
+            DFIRecord(10, 0, 1, 1, 0, 0, 0, 0, 2, 7),
+            DFIRecord(14, 0, 1, 0, 1, 1, 0, 0, 2, 8),
+            DFIRecord(15, 0, 0, 0, 0, 0, 0, 1, 0, 0),
+            DFIRecord(15, 1, 0, 0, 0, 0, 0, 1, 0, 0),
+            DFIRecord(20, 0, 1, 0, 1, 0, 0, 0, 2, 8),
+        ], f, nphases=2)
+        f.seek(0)
+
+        replayer = DFITraceReplayer(phy.dfi, read_binary_trace(f),
+            wrdata=lambda record: 0xc0de0000 + record.phase)
+        rddata = []
+
+        def process():
+            for i in range(20):
+                yield; yield Delay(1e-9)
+                if (yield phy.dfi.phases[0].rddata_valid):
+                    rddata.append((yield Cat(*[p.rddata for p in phy.dfi.phases])))
+
+        sim = Simulator(m)
+        sim.add_clock(1e-8)
+        for p in phy.processes:
+            sim.add_sync_process(p)
+        sim.add_sync_process(replayer.process)
+        sim.add_sync_process(process)
+        sim.run()
+
+        self.assertEqual(rddata, [0xc0de0001c0de0000])
+
+class DFITraceCheckerTestCase(FHDLTestCase):
+    # 5ns DRAM clock, 2 phases: 10ns per system clock cycle
+    timings = {
+        "tCK": 5.0, "tRP": 15, "tRCD": 15, "tWR": 15, "tRFC": (None, 100), "tFAW": (None, 50),
+        "tRAS": 35, "tREFI": 1000, "tWTR": (4, 7.5), "tCCD": (4, None), "tRRD": (None, 10),
+        "tZQCS": (64, 80), "tRTW": (7, None),
+    }
+
+    def prepare(self):
+        return DFITraceChecker(nphases=2, timings=self.timings, refresh_mode=None, memtype="DDR3")
+
+    def test_legal(self):
+        checker = self.prepare()
+        checker.check([
+            DFICommand(0,  0, "ACT", 0, 0x10),
+            DFICommand(2,  0, "RD",  0, 0x0),
+            DFICommand(4,  0, "PRE", 0, 0x0),
+            DFICommand(6,  0, "ACT", 0, 0x10),
+        ])
+        self.assertEqual(checker.violations, [])
+
+    def test_bank_rules(self):
+        checker = self.prepare()
+        checker.check([
+            DFICommand(0,  0, "ACT", 3, 0x10),
+            DFICommand(1,  0, "RD",  3, 0x0),
+            # tRAS is checked although a read was issued in between
+            DFICommand(3,  0, "PRE", 3, 0x0),
+        ])
+        self.assertEqual([(v.bank, v.rule, v.required, v.actual) for v in checker.violations], [
+            (3, "ACT->RD (tRCD)", 15000, 10000),
+            (3, "ACT->PRE (tRAS)", 35000, 30000),
+        ])
+        self.assertIn("ACT->RD (tRCD) violation on bank 3: 10000ps < 15000ps", checker.report())
+
+    def test_rank_rules(self):
+        checker = self.prepare()
+        checker.check([
+            DFICommand(0,  0, "ACT", 0, 0x10),
+            DFICommand(1,  0, "ACT", 3, 0x10),
+            DFICommand(4,  0, "RD",  0, 0x0),
+            # tRTW applies to writes on any bank
+            DFICommand(5,  1, "WR",  3, 0x0),
+        ])
+        self.assertEqual([(v.bank, v.rule, v.required, v.actual) for v in checker.violations], [
+            (None, "RD->WR (tRTW)", 35000, 15000),
+        ])
+        self.assertIn("RD->WR (tRTW) violation: 15000ps < 35000ps", checker.report())
+
+    def test_all_banks(self):
+        checker = self.prepare()
+        checker.check([
+            DFICommand(0,  0, "PRE", 0, 0x400),
+            DFICommand(1,  0, "ACT", 6, 0x10),
+        ])
+        self.assertEqual([(v.bank, v.rule) for v in checker.violations], [(6, "PRE->ACT (tRP)")])
+
+    def test_tfaw(self):
+        checker = self.prepare()
+        checker.check([DFICommand(n, 0, "ACT", n, 0x0) for n in range(5)])
+        self.assertEqual([(v.bank, v.rule, v.required, v.actual) for v in checker.violations], [
+            (None, "tFAW", 50000, 40000),
+        ])
+
+    def test_trefi(self):
+        checker = self.prepare()
+        checker.check([
+            DFICommand(0,   0, "REF", 0, 0x0),
+            DFICommand(900, 0, "REF", 0, 0x0),
+            DFICommand(1801, 0, "REF", 0, 0x0),
+        ])
+        # Up to 9 tREFI between refreshes
+        self.assertEqual([(v.rule, v.required, v.actual) for v in checker.violations], [
+            ("tREFI", 9000000, 9010000),
+        ])
+
+        checker.finish(cycle=3000)
+        self.assertEqual(len(checker.violations), 2)
+
+    def test_slack(self):
+        checker = self.prepare()
+        checker.check([
+            DFICommand(0,  0, "ACT", 0, 0x10),
+            DFICommand(2,  0, "RD",  0, 0x0),
+            DFICommand(10, 0, "ACT", 1, 0x10),
+            DFICommand(12, 1, "RD",  1, 0x0),
+        ])
+        slack = {rs.rule: rs for rs in checker.slack()}
+
+        # tRCD is 3 tCK, reads came 4 and 5 tCK after their activates
+        trcd = slack["ACT->RD (tRCD)"]
+        self.assertEqual((trcd.timing, trcd.required, trcd.worst, trcd.slack, trcd.count),
+                         ("tRCD", 15000, 20000, 5000, 2))
+        self.assertEqual(trcd.histogram, {1: 1, 2: 1})
+
+        trrd = slack["ACT->ACT (tRRD)"]
+        self.assertEqual((trrd.worst, trrd.histogram), (100000, {16: 1}))
+
+        class TimingSettings:
+            tRCD = 2
+
+        report = checker.slack_report(TimingSettings())
+        self.assertRegex(report, r"ACT->RD \(tRCD\) +15000ps +20000ps +1tCK +2 +2  1:1 2:1")
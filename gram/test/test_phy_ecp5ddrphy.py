@@ -1,6 +1,6 @@
 from nmigen import *
 
-from gram.phy.ecp5ddrphy import _DQSBUFMSettingManager
+from gram.phy.ecp5ddrphy import _DQSBUFMSettingManager, _ReadDelayCalibration
 from gram.test.utils import *
 
 class DQSBUFMSettingManagerTestCase(FHDLTestCase):
@@ -51,3 +51,74 @@ class DQSBUFMSettingManagerTestCase(FHDLTestCase):
             self.assertEqual((yield dut.readclksel), 0b101)
 
         runSimulation(dut, process, "test_phy_ecp5ddrphy.vcd")
+
+class ReadDelayCalibrationTestCase(FHDLTestCase):
+    def run_sweep(self, window, auto_apply=False, track=False, initial=(5, 5)):
+        dut = _ReadDelayCalibration(addressbits=14, bankbits=3, nranks=1, databits=64, nphases=4,
+            ngroups=2, sys_clk_freq=100e6, rdphase=0, read_latency=12, nreads=4)
+        applied = [list(initial)]
+
+        def process():
+            for i in range(2):
+                yield dut.readclksel[i].eq(applied[0][i])
+            yield (dut.track if track else dut.start).eq(1)
+            yield dut.auto_apply.eq(auto_apply)
+            yield
+            yield (dut.track if track else dut.start).eq(0)
+            yield
+
+            track_done = False
+            for _ in range(2000):
+                burstdet = 0
+                for i in range(2):
+                    if (yield dut.rdly[i].w_stb):
+                        applied[0][i] = (yield dut.rdly[i].w_data)
+                    if (yield dut.dfi.phases[0].rddata_en) and applied[0][i] in window[i]:
+                        burstdet |= 1 << i
+                track_done |= bool((yield dut.track_done))
+                yield dut.burstdet.eq(burstdet)
+                yield
+                if (yield dut.done) or track_done:
+                    break
+
+            self.assertFalse((yield dut.busy))
+            if track:
+                self.assertTrue(track_done)
+                self.assertFalse((yield dut.done))
+            else:
+                self.assertTrue((yield dut.done))
+                for i in range(2):
+                    self.assertEqual((yield dut.bitmaps[i]), sum(1 << v for v in window[i]))
+
+        runSimulation(dut, process, "test_phy_ecp5ddrphy.vcd")
+        return applied[0]
+
+    def test_bitmap_restore(self):
+        self.assertEqual(self.run_sweep([range(2, 6), range(4, 8)], auto_apply=False), [5, 5])
+
+    def test_auto_apply(self):
+        self.assertEqual(self.run_sweep([range(2, 6), range(4, 8)], auto_apply=True), [3, 5])
+
+    def test_tracking(self):
+        # Centered: no change
+        self.assertEqual(self.run_sweep([range(2, 7), range(1, 6)], track=True, initial=(4, 3)), [4, 3])
+        # Drift: move away from the failing neighbour while the current value still passes
+        self.assertEqual(self.run_sweep([range(4, 8), range(0, 4)], track=True, initial=(4, 3)), [5, 2])
+        # Lost: the current value fails, move towards the closest passing value
+        self.assertEqual(self.run_sweep([range(5, 8), range(0, 3)], track=True, initial=(4, 3)), [5, 2])
+        self.assertEqual(self.run_sweep([range(6, 8), range(0, 2)], track=True, initial=(4, 3)), [5, 2])
+        # Edges: values out of range are considered failing
+        self.assertEqual(self.run_sweep([range(0, 4), range(4, 8)], track=True, initial=(0, 7)), [1, 6])
+
+    def test_tracking_two_values(self):
+        # A passing value next to the edge of the window is kept, it does not oscillate in a 2 values
+        # window
+        for initial in [(4, 2), (5, 3)]:
+            applied = self.run_sweep([range(4, 6), range(2, 4)], track=True, initial=initial)
+            self.assertEqual(applied, list(initial))
+            self.assertEqual(self.run_sweep([range(4, 6), range(2, 4)], track=True, initial=applied),
+                             list(initial))
+        # At the ends of the range as well
+        for initial in [(0, 7), (1, 6)]:
+            self.assertEqual(self.run_sweep([range(0, 2), range(6, 8)], track=True, initial=initial),
+                             list(initial))
@@ -0,0 +1,201 @@
+import os
+import tempfile
+
+from nmigen import *
+
+from gram.common import PhySettings
+from gram.modules import MT41K256M16
+from gram.phy.fakephy import FakePHY, SparseBankModel
+from gram.test.utils import *
+
+class SparseBankModelTestCase(FHDLTestCase):
+    nrows = 2**15
+    ncols = 2**10
+
+    def prepare(self, init=None):
+        return SparseBankModel(data_width=64, nrows=self.nrows, ncols=self.ncols, burst_length=2,
+            nphases=2, we_granularity=8, init=init)
+
+    def access(self, dut, row, col, data=None, mask=0):
+        yield dut.activate.eq(1)
+        yield dut.activate_row.eq(row)
+        yield
+        yield dut.activate.eq(0)
+        if data is None:
+            yield dut.read.eq(1)
+            yield dut.read_col.eq(col)
+            yield; yield Delay(1e-9)
+            result = (yield dut.read_data)
+            yield dut.read.eq(0)
+        else:
+            yield dut.write.eq(1)
+            yield dut.write_col.eq(col)
+            yield dut.write_data.eq(data)
+            yield dut.write_mask.eq(mask)
+            yield
+            yield dut.write.eq(0)
+            result = None
+        yield dut.precharge.eq(1)
+        yield
+        yield dut.precharge.eq(0)
+        return result
+
+    def test_address_walk(self):
+        dut = self.prepare()
+        addresses = [(0, 0)]
+        addresses += [(2**i, 0) for i in range(15)]
+        addresses += [(0, 2**i) for i in range(2, 10)]
+        addresses += [(self.nrows-1, self.ncols-4)]
+
+        def process():
+            for n, (row, col) in enumerate(addresses):
+                yield from self.access(dut, row, col, data=0x1000 + n)
+            for n, (row, col) in enumerate(addresses):
+                self.assertEqual((yield from self.access(dut, row, col)), 0x1000 + n)
+
+            # Untouched lines read as zero and don't use memory
+            self.assertEqual((yield from self.access(dut, 3, 0)), 0)
+            self.assertEqual(len(dut.lines), len(addresses))
+
+        runSimulation(dut, process, "test_phy_fakephy.vcd", processes=[dut.process])
+
+    def test_write_mask(self):
+        dut = self.prepare(init=[0x1122334455667788])
+
+        def process():
+            yield from self.access(dut, 0, 0, data=0xaaaaaaaaaaaaaaaa, mask=0b11110000)
+            self.assertEqual((yield from self.access(dut, 0, 0)), 0x11223344aaaaaaaa)
+
+        runSimulation(dut, process, "test_phy_fakephy.vcd", processes=[dut.process])
+
+class FakePHYTestCase(FHDLTestCase):
+    def prepare(self, **kwargs):
+        settings = PhySettings(phytype="ECP5DDRPHY", memtype="DDR3", databits=16, dfi_databits=32,
+            nphases=2, rdphase=0, wrphase=1, rdcmdphase=1, wrcmdphase=0, cl=6, cwl=5,
+            read_latency=4, write_latency=1)
+        dut = FakePHY(MT41K256M16(100e6, "1:2"), settings, **kwargs)
+        m = Module()
+        m.domains.sync = ClockDomain("sync")
+        m.submodules.phy = dut
+        return dut, m
+
+    def command(self, phase, bank=0, address=0, cs=0, ras=0, cas=0, we=0):
+        yield phase.bank.eq(bank)
+        yield phase.address.eq(address)
+        yield phase.cs.eq(cs)
+        yield phase.ras.eq(ras)
+        yield phase.cas.eq(cas)
+        yield phase.we.eq(we)
+
+    def access(self, dut, bank, row, col, data=None, mask=0, trace=None):
+        phase = dut.dfi.phases[0]
+        yield from self.command(phase, bank=bank, address=row, cs=1, ras=1)
+        yield
+        if data is None:
+            yield from self.command(phase, bank=bank, address=col, cs=1, cas=1)
+        else:
+            yield from self.command(phase, bank=bank, address=col, cs=1, cas=1, we=1)
+        yield
+        yield from self.command(phase)
+        # Write data is expected write latency cycles after the command
+        yield Cat(*[p.wrdata for p in dut.dfi.phases]).eq(data or 0)
+        yield Cat(*[p.wrdata_mask for p in dut.dfi.phases]).eq(mask)
+        result = None
+        for i in range(8):
+            yield; yield Delay(1e-9)
+            valid = (yield phase.rddata_valid)
+            rddata = (yield Cat(*[p.rddata for p in dut.dfi.phases]))
+            if trace is not None:
+                trace.append((valid, rddata))
+            if valid:
+                result = rddata
+        yield from self.command(phase, bank=bank, cs=1, ras=1, we=1)
+        yield
+        yield from self.command(phase)
+        yield
+        return result
+
+    def run_no_aliasing(self, **kwargs):
+        dut, m = self.prepare(**kwargs)
+        # Rows 0 and 1024 share their Memory address in the RTL bank model
+        rows = [0, 1024, 2**15-1]
+
+        def process():
+            for n, row in enumerate(rows):
+                yield from self.access(dut, 5, row, 8, data=0xc0de0000 + n)
+            for n, row in enumerate(rows):
+                self.assertEqual((yield from self.access(dut, 5, row, 8)), 0xc0de0000 + n)
+
+        runSimulation(m, process, "test_phy_fakephy.vcd", processes=dut.processes)
+
+    def test_no_aliasing_sparse(self):
+        self.run_no_aliasing(sparse=True)
+
+    def test_no_aliasing_behavioural(self):
+        self.run_no_aliasing(behavioural=True)
+
+    def test_behavioural_matches_rtl(self):
+        accesses = [
+            (0, 1, 0,  0x0123456789abcdef, 0),
+            (3, 2, 4,  0xfedcba9876543210, 0),
+            (0, 1, 0,  0xffffffffffffffff, 0b00001111),
+            (3, 7, 4,  None, 0),
+            (0, 1, 0,  None, 0),
+            (3, 2, 4,  None, 0),
+        ]
+
+        def run(**kwargs):
+            dut, m = self.prepare(**kwargs)
+            trace = []
+
+            def process():
+                for bank, row, col, data, mask in accesses:
+                    yield from self.access(dut, bank, row, col, data=data, mask=mask, trace=trace)
+
+            runSimulation(m, process, "test_phy_fakephy.vcd", processes=dut.processes)
+            return trace
+
+        rtl = run()
+        self.assertIn((1, 0xffffffff89abcdef), rtl)
+        self.assertEqual(run(behavioural=True), rtl)
+
+    def test_auto_precharge(self):
+        def run(**kwargs):
+            dut, m = self.prepare(**kwargs)
+            results = []
+
+            def process():
+                # Column commands with A10 set: the column must not spill into the row
+                yield from self.access(dut, 2, 0, 8 | 2**10, data=0x11111111)
+                yield from self.access(dut, 2, 1, 8, data=0x22222222)
+                results.append((yield from self.access(dut, 2, 0, 8 | 2**10)))
+                results.append((yield from self.access(dut, 2, 1, 8)))
+
+            runSimulation(m, process, "test_phy_fakephy.vcd", processes=dut.processes)
+            return results
+
+        rtl = run()
+        self.assertEqual(rtl, [0x11111111, 0x22222222])
+        self.assertEqual(run(sparse=True), rtl)
+        self.assertEqual(run(behavioural=True), rtl)
+
+    def test_init_image(self):
+        # Two rows of each bank, 256 lines of 64 bits per row
+        nlines = 2**10 // 4
+        words = list(range(1, 2*8*nlines*2 + 1))
+        image = b"".join(w.to_bytes(4, "little") for w in words)
+        line = lambda n: words[2*n] | (words[2*n+1] << 32)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "init.bin")
+            with open(path, "wb") as f:
+                f.write(image)
+
+            for init in [words, image, memoryview(image), path]:
+                dut, m = self.prepare(init=init, behavioural=True)
+                # Second row of bank 1
+                self.assertEqual(dut._storage[1].lines[nlines], line(9*nlines))
+
+                dut, m = self.prepare(init=init, behavioural=True, address_mapping="BANK_ROW_COL")
+                self.assertEqual(dut._storage[0].lines[nlines], line(nlines))
+                self.assertEqual(len(dut._storage[0].lines), len(words)//2)
@@ -17,10 +17,12 @@ from nmigen._toolchain import require_tool
 
 __all__ = ["FHDLTestCase", "runSimulation", "wb_read", "wb_write", "PulseCounter", "Delay"]
 
-def runSimulation(module, process, vcd_filename="anonymous.vcd", clock=1e-8):
+def runSimulation(module, process, vcd_filename="anonymous.vcd", clock=1e-8, processes=()):
     sim = Simulator(module)
     with sim.write_vcd(vcd_filename):
         sim.add_clock(clock)
+        for p in processes:
+            sim.add_sync_process(p)
         sim.add_sync_process(process)
         sim.run()
 
@@ -9,8 +9,11 @@ enum GramError {
 	GRAM_ERR_NONE = 0,
 	GRAM_ERR_UNDOCUMENTED,
 	GRAM_ERR_RDLY_MAX,
+	GRAM_ERR_DQS_GROUPS,
 };
 
+#define GRAM_MAX_DQS_GROUPS 8
+
 struct gramCoreRegs;
 struct gramPHYRegs;
 struct gramCtx {
@@ -20,9 +23,14 @@ struct gramCtx {
 	void *user_data;
 };
 
+/*
+ * rdly[] replaces the rdly_p0 and rdly_p1 fields of earlier versions:
+ * rdly[0] and rdly[1] hold their values. The layout changed, profiles
+ * stored by earlier versions must be converted or regenerated.
+ */
 struct gramProfile {
-	uint8_t rdly_p0;
-	uint8_t rdly_p1;
+	uint8_t dqs_groups; /* Number of DQS groups (databits/8), 0 means 2 */
+	uint8_t rdly[GRAM_MAX_DQS_GROUPS];
 	uint32_t mode_registers[4];
 };
 
@@ -6,19 +6,11 @@
 #include "dfii.h"
 #include "helpers.h"
 
-static void set_rdly(const struct gramCtx *ctx, unsigned int phase, unsigned int rdly) {
+static void set_rdly(const struct gramCtx *ctx, unsigned int group, unsigned int rdly) {
 #ifdef GRAM_RW_FUNC
-	if (phase == 0) {
-		gram_write(ctx, (void*)&(ctx->phy->rdly_p0), rdly);
-	} else if (phase == 1) {
-		gram_write(ctx, (void*)&(ctx->phy->rdly_p1), rdly);
-	}
+	gram_write(ctx, (void*)&(ctx->phy->rdly[group]), rdly);
 #else
-	if (phase == 0) {
-		ctx->phy->rdly_p0 = rdly;
-	} else if (phase == 1) {
-		ctx->phy->rdly_p1 = rdly;
-	}
+	ctx->phy->rdly[group] = rdly;
 #endif
 }
 
@@ -40,98 +32,81 @@ bool gram_read_burstdet(const struct gramCtx *ctx, int phase) {
 
 int gram_generate_calibration(const struct gramCtx *ctx, struct gramProfile *profile) {
 	unsigned char rdly;
-	unsigned char min_rdly_p0, min_rdly_p1;
-	unsigned char max_rdly_p0 = 7, max_rdly_p1 = 7;
+	unsigned char min_rdly[GRAM_MAX_DQS_GROUPS];
+	unsigned char max_rdly[GRAM_MAX_DQS_GROUPS];
+	unsigned int group, groups = dqs_groups(profile);
 	uint32_t tmp;
 	volatile uint32_t *ram = ctx->ddr_base;
 	size_t i;
 
-	dfii_setsw(ctx, true);
-
-	(void)tmp;
-
-	// Find minimal rdly
-	for (rdly = 0; rdly < 8; rdly++) {
-		profile->rdly_p0 = rdly;
-		gram_load_calibration(ctx, profile);
-		gram_reset_burstdet(ctx);
-
-		for (i = 0; i < 128; i++) {
-			tmp = ram[i];
-		}
-
-		if (gram_read_burstdet(ctx, 0)) {
-			min_rdly_p0 = rdly;
-			break;
-		} else if (rdly == 7) {
-			return GRAM_ERR_RDLY_MAX;
-		}
-	}
-
-	for (rdly = 0; rdly < 8; rdly++) {
-		profile->rdly_p1 = rdly;
-		gram_load_calibration(ctx, profile);
-		gram_reset_burstdet(ctx);
-
-		for (i = 0; i < 128; i++) {
-			tmp = ram[i];
-		}
-
-		if (gram_read_burstdet(ctx, 1)) {
-			min_rdly_p1 = rdly;
-			break;
-		} else if (rdly == 7) {
-			return GRAM_ERR_RDLY_MAX;
-		}
+	if (groups > GRAM_MAX_DQS_GROUPS) {
+		return GRAM_ERR_DQS_GROUPS;
 	}
 
-	// Find maximal rdly
-	for (rdly = min_rdly_p0+1; rdly < 8; rdly++) {
-		profile->rdly_p0 = rdly;
-		gram_load_calibration(ctx, profile);
-		gram_reset_burstdet(ctx);
-
-		for (i = 0; i < 128; i++) {
-			tmp = ram[i];
-		}
-
-		if (!gram_read_burstdet(ctx, 0)) {
-			max_rdly_p0 = rdly - 1;
-			break;
-		} else if (rdly == 7) {
-			return GRAM_ERR_RDLY_MAX;
-		}
-	}
+	dfii_setsw(ctx, true);
 
-	for (rdly = min_rdly_p1+1; rdly < 8; rdly++) {
-		profile->rdly_p1 = rdly;
-		gram_load_calibration(ctx, profile);
-		gram_reset_burstdet(ctx);
+	(void)tmp;
 
-		for (i = 0; i < 128; i++) {
-			tmp = ram[i];
+	for (group = 0; group < groups; group++) {
+		max_rdly[group] = 7;
+
+		// Find minimal rdly
+		for (rdly = 0; rdly < 8; rdly++) {
+			profile->rdly[group] = rdly;
+			gram_load_calibration(ctx, profile);
+			gram_reset_burstdet(ctx);
+
+			for (i = 0; i < 128; i++) {
+				tmp = ram[i];
+			}
+
+			if (gram_read_burstdet(ctx, group)) {
+				min_rdly[group] = rdly;
+				break;
+			} else if (rdly == 7) {
+				return GRAM_ERR_RDLY_MAX;
+			}
 		}
 
-		if (!gram_read_burstdet(ctx, 1)) {
-			max_rdly_p1 = rdly - 1;
-			break;
-		} else if (rdly == 7) {
-			return GRAM_ERR_RDLY_MAX;
+		// Find maximal rdly
+		for (rdly = min_rdly[group]+1; rdly < 8; rdly++) {
+			profile->rdly[group] = rdly;
+			gram_load_calibration(ctx, profile);
+			gram_reset_burstdet(ctx);
+
+			for (i = 0; i < 128; i++) {
+				tmp = ram[i];
+			}
+
+			if (!gram_read_burstdet(ctx, group)) {
+				max_rdly[group] = rdly - 1;
+				break;
+			} else if (rdly == 7) {
+				return GRAM_ERR_RDLY_MAX;
+			}
 		}
 	}
 
 	dfii_setsw(ctx, false);
 
 	// Store average rdly value
-	profile->rdly_p0 = (min_rdly_p0+max_rdly_p0)/2;
-	profile->rdly_p1 = (min_rdly_p1+max_rdly_p1)/2;
+	for (group = 0; group < groups; group++) {
+		profile->rdly[group] = (min_rdly[group]+max_rdly[group])/2;
+	}
 
 	return GRAM_ERR_NONE;
 }
 
 void gram_load_calibration(const struct gramCtx *ctx, const struct gramProfile *profile) {
+	unsigned int group, groups = dqs_groups(profile);
+
+	if (groups > GRAM_MAX_DQS_GROUPS) {
+		groups = GRAM_MAX_DQS_GROUPS;
+	}
+
 	dfii_setsw(ctx, true);
-	set_rdly(ctx, 0, profile->rdly_p0);
-	set_rdly(ctx, 1, profile->rdly_p1);
+	for (group = 0; group < groups; group++) {
+		set_rdly(ctx, group, profile->rdly[group]);
+	}
 	dfii_setsw(ctx, false);
 }
@@ -1,6 +1,8 @@
 #ifndef HELPERS_H
 #define HELPERS_H
 
+#include <gram.h>
+
 __attribute__((unused)) static inline void cdelay(int i) {
 	while(i > 0) {
 		__asm__ volatile("nop");
@@ -8,4 +10,9 @@ __attribute__((unused)) static inline void cdelay(int i) {
 	}
 }
 
+/* Profiles not setting dqs_groups target a 16-bit PHY */
+__attribute__((unused)) static inline unsigned int dqs_groups(const struct gramProfile *profile) {
+	return profile->dqs_groups ? profile->dqs_groups : 2;
+}
+
 #endif /* HELPERS_H */
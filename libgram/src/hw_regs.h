@@ -3,8 +3,7 @@
 
 struct gramPHYRegs {
 	uint32_t burstdet;
-	uint32_t rdly_p0;
-	uint32_t rdly_p1;
+	uint32_t rdly[]; /* One per DQS group */
 } __attribute__((packed));
 
 struct DFII_Phase {
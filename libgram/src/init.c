@@ -1,11 +1,16 @@
 #include <gram.h>
 #include "dfii.h"
+#include "helpers.h"
 
 int gram_init(struct gramCtx *ctx, const struct gramProfile *profile, void *ddr_base, void *core_base, void *phy_base) {
 	ctx->ddr_base = ddr_base;
 	ctx->core = core_base;
 	ctx->phy = phy_base;
 
+	if (dqs_groups(profile) > GRAM_MAX_DQS_GROUPS) {
+		return GRAM_ERR_DQS_GROUPS;
+	}
+
 	dfii_setsw(ctx, true);
 	dfii_initseq(ctx, profile);
 	gram_load_calibration(ctx, profile);